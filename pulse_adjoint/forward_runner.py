@@ -37,9 +37,17 @@ from pulse.dolfin_utils import RegionalParameter
 from .heart_problem import PassiveHeartProblem, ActiveHeartProblem
 from .dolfinimport import *
 from .optimization_targets import *
+from .optimization_targets import assemble_geometry_metric
 from .adjoint_contraction_args import *
 
-from .utils import Text, list_sum, Object, TablePrint, UnableToChangePressureExeption
+from .utils import (
+    Text,
+    list_sum,
+    Object,
+    TablePrint,
+    UnableToChangePressureExeption,
+    StateCache,
+)
 
 
 class BasicForwardRunner(object):
@@ -73,7 +81,8 @@ class BasicForwardRunner(object):
         self.params = params
 
         self.meshvol = dolfin.Constant(
-            dolfin.assemble(dolfin.Constant(1.0) * dolfin.dx(solver_parameters["mesh"])), name="mesh volume"
+            assemble_geometry_metric(dolfin.dx(solver_parameters["mesh"])),
+            name="mesh volume",
         )
 
         # Initialize target functions
@@ -84,6 +93,17 @@ class BasicForwardRunner(object):
 
         self.optimization_targets = optimization_targets
 
+        # If set, the states are written to file during
+        # the forward solve instead of kept in memory
+        self.state_writer = None
+
+    def _save_state(self, phm):
+
+        if self.state_writer is None:
+            self.states.append(phm.solver.state.copy(True))
+        else:
+            self.state_writer.append(phm.solver.state)
+
     def _print_head(self):
         """
         Print the top line for the output of the forward solve
@@ -166,7 +186,7 @@ class BasicForwardRunner(object):
 
             # And we save it for later reference
             phm.solver.solve()
-            self.states.append(phm.solver.state.copy(True))
+            self._save_state(phm)
 
         # Print the functional
         logger.info(self._print_functional())
@@ -190,7 +210,7 @@ class BasicForwardRunner(object):
         for it, p in enumerate(self.bcs["pressure"][1:], start=1):
 
             sol = next(phm)
-            self.states.append(phm.solver.state.copy(True))
+            self._save_state(phm)
 
             if (
                 self.params["passive_weights"] == "all"
@@ -500,12 +520,24 @@ class PassiveForwardRunner(BasicForwardRunner):
                 self.opt_weights[k] = v
 
         self.paramvec = paramvec
+
+        # Converged states from previous evaluations,
+        # used as initial guess for the newton solver
+        self.warm_start = params["passive_warm_start"]
+        self.state_cache = StateCache(params["passive_warm_start_cache_size"])
+
         self.cphm = self.get_phm(return_state=False)
 
     def __call__(self, m, annotate=False):
 
         self.assign_material_parameters(m)
-        self.cphm = self.get_phm(annotate, return_state=False)
+
+        if self.warm_start:
+            control = numpy_mpi.gather_broadcast(self.paramvec.vector().get_local())
+            self.reset_phm(annotate, self.state_cache.nearest(control))
+        else:
+            self.cphm = self.get_phm(annotate, return_state=False)
+
         dolfin.parameters["adjoint"]["stop_annotating"] = not annotate
         try:
             forward_result = BasicForwardRunner.solve_the_forward_problem(
@@ -519,8 +551,27 @@ class PassiveForwardRunner(BasicForwardRunner):
             logger.warning(ex)
             raise SolverDidNotConverge
         else:
+            if self.warm_start and forward_result["states"]:
+                self.state_cache.add(
+                    control,
+                    [dolfin.Vector(w.vector()) for w in forward_result["states"]],
+                )
             return forward_result, False
 
+    def reset_phm(self, annotate=True, initial_guesses=None):
+        """
+        Reuse the current heart problem for a new evaluation, starting
+        from the first pressure.
+
+        :param bool annotate: annotate the forward solve
+        :param list initial_guesses: list of vectors, one for each pressure,
+                                     used as initial guess for the newton solver
+        """
+
+        dolfin.parameters["adjoint"]["stop_annotating"] = True
+        self.cphm.reset(initial_guesses)
+        dolfin.parameters["adjoint"]["stop_annotating"] = not annotate
+
     def assign_material_parameters(self, m):
 
         self.paramvec.assign(m)
@@ -32,9 +32,10 @@ import dolfin_adjoint
 
 from .adjoint_contraction_args import *
 
-from .utils import Text, UnableToChangePressureExeption
+from .utils import Text, UnableToChangePressureExeption, result_file_lock
 from pulse.iterate import iterate, delist
 from pulse import numpy_mpi
+from pulse.mechanicsproblem import SolverDidNotConverge
 
 def create_mechanics_problem(solver_parameters):
     import pulse
@@ -105,7 +106,7 @@ class BasicHeartProblem(collections.Iterator):
         # Mechanical solver Active strain Holzapfel and Ogden
         self.solver = create_mechanics_problem(solver_parameters)
 
-    def increase_pressure(self):
+    def _next_pressure(self):
 
         p_lv_next = next(self.lv_pressure_gen)
         if self.has_rv:
@@ -116,10 +117,27 @@ class BasicHeartProblem(collections.Iterator):
             target = p_lv_next
             control = self.p_lv
 
+        return target, control
+
+    def increase_pressure(self):
+
+        target, control = self._next_pressure()
         iterate(problem=self.solver,
                 target=target,
                 control=control, continuation=True)
 
+    def reset_pressure(self):
+        """
+        Start over again from the first pressure
+        """
+
+        self._init_pressures(self.lv_pressure, self.p_lv, "lv")
+        self.p_lv.assign(dolfin_adjoint.Constant(float(self.lv_pressure[0])))
+
+        if self.has_rv:
+            self._init_pressures(self.rv_pressure, self.p_rv, "rv")
+            self.p_rv.assign(dolfin_adjoint.Constant(float(self.rv_pressure[0])))
+
     def get_state(self, copy=True):
         """
         Return a copy of the state
@@ -163,6 +181,10 @@ def get_max(f):
     return numpy_mpi.gather_broadcast(f.vector().get_local()).max()
 
 
+def get_array(f):
+    return numpy_mpi.gather_broadcast(f.vector().get_local())
+
+
 def get_max_diff(f1, f2):
 
     diff = f1.vector() - f2.vector()
@@ -184,11 +206,28 @@ class ActiveHeartProblem(BasicHeartProblem):
             if dolfin.mpi_comm_world().rank == 0:
                 os.remove(fname)
 
+        # States and gammas from the continuation that can be used
+        # as initial guess for the newton solver. The most recent
+        # ones are kept in memory, and the older ones are optionally
+        # written to file
+        self.stored_states = collections.deque(
+            maxlen=max(params["active_state_store_size"], 1)
+        )
+        self.spill_to_disk = params["active_state_spill_to_disk"]
+        # Number of stored states used as initial guesses
+        self.nearest_states = params["active_state_nearest"]
+        self._nspilled = 0
+        # Gathered values of the spilled gammas, so that the states
+        # can be ranked without reading them from file
+        self._spilled_gammas = []
+
         BasicHeartProblem.__init__(self, bcs, solver_parameters, pressure)
 
         # Load the state from the previous iteration
         w_temp = dolfin_adjoint.Function(self.solver.state_space, name="w_temp")
-        with dolfin.HDF5File(dolfin.mpi_comm_world(), params["sim_file"], "r") as h5file:
+        with result_file_lock, dolfin.HDF5File(
+            dolfin.mpi_comm_world(), params["sim_file"], "r"
+        ) as h5file:
 
             # Get previous state
             if params["active_contraction_iteration_number"] == 0:
@@ -220,60 +259,75 @@ class ActiveHeartProblem(BasicHeartProblem):
 
     def get_number_of_stored_states(self):
 
-        fname = "active_state_{}.h5".format(self.acin)
-        if os.path.isfile(fname):
-            i = 0
-            with dolfin.HDF5File(dolfin.mpi_comm_world(), fname, "r") as h5file:
-                group_exist = h5file.has_dataset("0")
-                while group_exist:
-                    i += 1
-                    group_exist = h5file.has_dataset(str(i))
-
-            return i
+        return len(self.stored_states) + self._nspilled
 
-        else:
-            return 0
-
-    def store_states(self, states, gammas):
+    def _spill_states(self, states, gammas):
 
         fname = "active_state_{}.h5".format(self.acin)
         file_mode = "a" if os.path.isfile(fname) else "w"
-        key = self.get_number_of_stored_states()
 
         gamma_group = "{}/gamma"
         state_group = "{}/state"
 
+        # The HDF5 library is not thread safe, and the results
+        # may be written in the background at the same time
+        with result_file_lock, dolfin.HDF5File(
+            dolfin.mpi_comm_world(), fname, file_mode
+        ) as h5file:
+
+            for (w, g) in zip(states, gammas):
+                h5file.write(w, state_group.format(self._nspilled))
+                h5file.write(g, gamma_group.format(self._nspilled))
+                self._spilled_gammas.append(get_array(g))
+                self._nspilled += 1
+
+    def store_states(self, states, gammas):
+
         assert len(states) == len(
             gammas
         ), "Number of states does not math number of gammas"
 
-        with dolfin.HDF5File(dolfin.mpi_comm_world(), fname, file_mode) as h5file:
+        spilled_states = []
+        spilled_gammas = []
+        for (w, g) in zip(states, gammas):
 
-            for (w, g) in zip(states, gammas):
-                h5file.write(w, state_group.format(key))
-                h5file.write(g, gamma_group.format(key))
-                key += 1
+            if len(self.stored_states) == self.stored_states.maxlen:
+                # The oldest state will be removed from memory
+                w_old, g_old, _ = self.stored_states[0]
+                spilled_states.append(w_old)
+                spilled_gammas.append(g_old)
 
-    def load_states(self):
+            self.stored_states.append((w.copy(True), g.copy(True), get_array(g)))
 
-        fname = "active_state_{}.h5".format(self.acin)
-        if not os.path.isfile(fname):
-            return [], []
+        if self.spill_to_disk and spilled_states:
+            self._spill_states(spilled_states, spilled_gammas)
 
-        nstates = self.get_number_of_stored_states()
+    def _load_spilled_states(self, indices=None):
+        """
+        Read the spilled states and gammas with the given indices
+        from file (all if `indices` is None). Return a dictionary
+        from the index to the state and gamma.
+        """
+
+        fname = "active_state_{}.h5".format(self.acin)
+        if indices is None:
+            indices = range(self._nspilled)
+        if len(indices) == 0 or not os.path.isfile(fname):
+            return {}
 
         gamma_group = "{}/gamma"
         state_group = "{}/state"
 
-        states = []
-        gammas = []
+        spilled = {}
 
         w = self.solver.state.copy(True)
         g = self.solver.material.activation.copy(True)
 
-        with dolfin.HDF5File(dolfin.mpi_comm_world(), fname, "r") as h5file:
+        with result_file_lock, dolfin.HDF5File(
+            dolfin.mpi_comm_world(), fname, "r"
+        ) as h5file:
 
-            for i in range(nstates):
+            for i in indices:
 
                 try:
                     h5file.read(w, state_group.format(i))
@@ -283,14 +337,59 @@ class ActiveHeartProblem(BasicHeartProblem):
                     logger.info("State {} does not exist".format(i))
 
                 else:
-                    states.append(w.copy(True))
-                    gammas.append(g.copy(True))
+                    spilled[i] = (w.copy(True), g.copy(True))
+
+        return spilled
+
+    def load_states(self, gamma=None, k=0):
+        """
+        Load the stored states and gammas. If `gamma` is given,
+        the states are sorted by the l2 distance between the stored
+        gammas and `gamma`, and only the `k` nearest are returned
+        (all if `k` is zero).
+        """
+
+        if gamma is None:
+            spilled = self._load_spilled_states()
+            states = [spilled[i][0] for i in sorted(spilled)]
+            gammas = [spilled[i][1] for i in sorted(spilled)]
+            for (w, g, _) in self.stored_states:
+                states.append(w)
+                gammas.append(g)
+            return states, gammas
+
+        # Rank all the stored gammas, the spilled ones first.
+        # Only the selected spilled states are read from file
+        arrs = self._spilled_gammas + [g_arr for (_, _, g_arr) in self.stored_states]
+        if len(arrs) == 0:
+            return [], []
+
+        gamma_arr = get_array(gamma)
+        dist = [np.linalg.norm(g_arr - gamma_arr) for g_arr in arrs]
+        idx = np.argsort(dist, kind="mergesort")
+        if k > 0:
+            idx = idx[:k]
+
+        spilled = self._load_spilled_states([i for i in idx if i < self._nspilled])
+
+        states = []
+        gammas = []
+        for i in idx:
+            if i < self._nspilled:
+                if i not in spilled:
+                    # Could not be read from file
+                    continue
+                w, g = spilled[i]
+            else:
+                w, g, _ = self.stored_states[i - self._nspilled]
+            states.append(w)
+            gammas.append(g)
 
         return states, gammas
 
     def next_active(self, gamma_current, gamma, assign_prev_state=True, steps=None):
 
-        old_states, old_gammas = self.load_states()
+        old_states, old_gammas = self.load_states(gamma_current, self.nearest_states)
 
         states, gammas = iterate(
             problem=self.solver,
@@ -317,13 +416,88 @@ class PassiveHeartProblem(BasicHeartProblem):
     """
     Runs a biventricular simulation of the diastolic phase of the cardiac
     cycle. The simulation is driven by LV pressures and is quasi-static.
+
+    If a list of initial guesses is provided (one state vector for
+    each pressure), the newton solver will first try to solve directly
+    at the next pressure starting from the initial guess. If this fails
+    we fall back to the usual continuation in the pressure.
     """
 
+    def __init__(self, bcs, solver_parameters, pressure, initial_guesses=None):
+
+        BasicHeartProblem.__init__(self, bcs, solver_parameters, pressure)
+        self.initial_guesses = initial_guesses
+        self._step = 0
+
+    def reset(self, initial_guesses=None):
+        """
+        Go back to the first pressure and reset the state to zero,
+        or to the first initial guess if provided, so that the problem
+        can be reused for a new set of material parameters.
+        """
+
+        self.reset_pressure()
+        self.initial_guesses = initial_guesses
+        self._step = 0
+
+        self.solver.state.vector().zero()
+        has_guess = self._assign_initial_guess(0)
+
+        try:
+            self.solver.solve()
+        except SolverDidNotConverge:
+            if not has_guess:
+                raise
+            logger.debug("Initial guess failed. Start from zero")
+            self.initial_guesses = None
+            self.solver.state.vector().zero()
+            self.solver.solve()
+
+    def _assign_initial_guess(self, step):
+
+        if self.initial_guesses is None or step >= len(self.initial_guesses):
+            return False
+
+        self.solver.state.vector().zero()
+        self.solver.state.vector().axpy(1.0, self.initial_guesses[step])
+        return True
+
+    def _warm_start(self, target, control):
+
+        w_old = self.solver.state.vector().copy()
+        if not self._assign_initial_guess(self._step):
+            return False
+
+        target_lst = list(target) if self.has_rv else [target]
+        control_lst = list(control) if self.has_rv else [control]
+        control_old = [float(c) for c in control_lst]
+
+        for c, t in zip(control_lst, target_lst):
+            c.assign(dolfin_adjoint.Constant(float(t)))
+
+        try:
+            self.solver.solve()
+        except SolverDidNotConverge:
+            logger.debug("Warm start failed. Use continuation")
+            self.solver.state.vector().zero()
+            self.solver.state.vector().axpy(1.0, w_old)
+            for c, t in zip(control_lst, control_old):
+                c.assign(dolfin_adjoint.Constant(t))
+            return False
+
+        return True
+
     def __next__(self):
         """
         Increase the pressure and solve the system
         """
 
-        self.increase_pressure()
+        self._step += 1
+        target, control = self._next_pressure()
+
+        if not self._warm_start(target, control):
+            iterate(problem=self.solver,
+                    target=target,
+                    control=control, continuation=True)
 
         return self.get_state(False)
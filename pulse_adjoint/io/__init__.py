@@ -1,2 +1,8 @@
-from .store_results import write_opt_results_to_h5
+from .store_results import (
+    write_opt_results_to_h5,
+    StateWriter,
+    AsyncResultWriter,
+    get_async_writer,
+    flush_async_writes,
+)
 from .utils import contract_point_exists, passive_inflation_exists
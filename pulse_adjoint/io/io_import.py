@@ -35,6 +35,13 @@ except ImportError:
 
 import os
 import yaml
+import threading
+
+try:
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
 
 try:
     import mpi4py
@@ -51,7 +58,14 @@ import numpy as np
 import dolfin
 import dolfin_adjoint
 from pulse.numpy_mpi import *
-from ..utils import Text
+from ..utils import (
+    Text,
+    result_file_lock,
+    locked_result_file,
+    load_manifest,
+    lookup_manifest,
+    update_manifest,
+)
 from ..adjoint_contraction_args import (
     logger,
     ACTIVE_CONTRACTION,
@@ -24,12 +24,280 @@
 # SIMULA RESEARCH LABORATORY MAKES NO REPRESENTATIONS AND EXTENDS NO
 # WARRANTIES OF ANY KIND, EITHER IMPLIED OR EXPRESSED, INCLUDING, BUT
 # NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY OR FITNESS
+import atexit
+
 from .io_import import *
 from .utils import *
 
 
+class StateWriter(object):
+    """
+    Write the states to the result file while the forward model
+    is solved, instead of keeping all of them in memory until the
+    end. At most `buffer_size` states are kept in memory before they
+    are written. The states are written to a temporary group, and
+    are moved to `h5group` when the results are committed.
+
+    **Example of use**::
+
+      writer = StateWriter(h5name, h5group, solver)
+      writer.start()
+      for w in states:
+          writer.append(w)
+      writer.commit()
+
+    :param str h5name: Name of the result file
+    :param str h5group: Group where the states should be stored
+    :param solver: The mechanics problem
+    :param int buffer_size: Number of states kept in memory
+    :param comm: MPI communicator
+
+    """
+
+    def __init__(
+        self, h5name, h5group, solver, buffer_size=5, comm=dolfin.mpi_comm_world()
+    ):
+
+        self.h5name = h5name
+        self.h5group = h5group
+        # Keep this outside h5group, since h5group is
+        # deleted before the final results are written
+        self.tmp_group = "{}_tmp_states".format(h5group.rstrip("/"))
+        # Do not touch the state of the solver while it is solving
+        self._state = dolfin.Function(solver.state.function_space())
+        self.buffer_size = max(buffer_size, 1)
+        self.comm = comm
+
+        self._buffer = []
+        self._nstates = 0
+
+    def __len__(self):
+        return self._nstates
+
+    @locked_result_file
+    def start(self):
+        """
+        Prepare for a new forward run
+        """
+        self._buffer = []
+        self._nstates = 0
+        if os.path.isfile(self.h5name):
+            check_and_delete(self.h5name, self.tmp_group, self.comm)
+
+    def append(self, w):
+        """
+        Add a new state
+
+        :param w: The state
+        :type w: :py:class:`dolfin.Function`
+        """
+
+        self._buffer.append((self._nstates, dolfin.Vector(w.vector())))
+        self._nstates += 1
+
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+
+    @locked_result_file
+    def flush(self):
+        """
+        Write the states in memory to file
+        """
+
+        if len(self._buffer) == 0:
+            return
+
+        filedir = os.path.abspath(os.path.dirname(self.h5name))
+        if not os.path.exists(filedir) and self.comm.rank == 0:
+            os.makedirs(filedir)
+
+        file_mode = "a" if os.path.isfile(self.h5name) else "w"
+
+        with dolfin.HDF5File(self.comm, self.h5name, file_mode) as h5file:
+
+            for i, w in self._buffer:
+
+                self._state.vector().zero()
+                self._state.vector().axpy(1.0, w)
+                h5file.write(
+                    self._state, "/".join([self.tmp_group, "states/{}".format(i)])
+                )
+
+                u, p = self._state.split(deepcopy=True)
+                h5file.write(
+                    u, "/".join([self.tmp_group, "displacement/{}".format(i)])
+                )
+                h5file.write(
+                    p, "/".join([self.tmp_group, "lagrange_multiplier/{}".format(i)])
+                )
+
+        self._buffer = []
+
+    @locked_result_file
+    def commit(self):
+        """
+        Write the remaining states, and move all the
+        states to their final location
+        """
+
+        self.flush()
+        if self._nstates == 0:
+            return
+
+        with open_h5py(self.h5name, "a", self.comm) as h5file:
+
+            if parallel_h5py or self.comm.rank == 0:
+                for name in ["states", "displacement", "lagrange_multiplier"]:
+                    group = "/".join([self.h5group, name]) if self.h5group else name
+                    if group in h5file:
+                        del h5file[group]
+                    h5file.move("/".join([self.tmp_group, name]), group)
+
+                del h5file[self.tmp_group]
+
+    @locked_result_file
+    def discard(self):
+        """
+        Remove all the states from this run
+        """
+
+        self._buffer = []
+        self._nstates = 0
+        if os.path.isfile(self.h5name):
+            check_and_delete(self.h5name, self.tmp_group, self.comm)
+
+
+class AsyncResultWriter(object):
+    """
+    Write dictionaries of numpy arrays to the result file in a
+    background thread, so that the optimization can continue while
+    the results are written. Any access to the result file (or any
+    other HDF5 file, since the HDF5 library is not thread safe) from
+    the main thread should hold `result_file_lock`. The lock only works
+    within one process, so this is only used in serial (see
+    :func:`get_async_writer`).
+
+    Call `flush` to wait until everything is written, e.g at
+    the end of each phase.
+
+    :param comm: MPI communicator
+
+    """
+
+    def __init__(self, comm=dolfin.mpi_comm_world()):
+
+        self.comm = comm
+        self._queue = queue.Queue()
+        self._thread = None
+        self._errors = []
+
+    def _start(self):
+
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="AsyncResultWriter")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+
+                h5name, h5group, data, layout, compression = item
+                with result_file_lock:
+                    with h5py.File(h5name, "a") as h5file:
+                        write_numpy_dict(h5file, data, h5group, layout, compression)
+                    update_manifest(h5name, self.comm)
+
+            except Exception as ex:
+                logger.error("Failed to write results: {}".format(ex))
+                self._errors.append(ex)
+
+            finally:
+                self._queue.task_done()
+
+    def put(self, data, h5name, h5group, layout="default", compression="gzip"):
+        """
+        Write the data in the background
+
+        :param dict data: Dictionary with (gathered) numpy arrays
+        :param str h5name: Name of the file
+        :param str h5group: Group in the file
+        :param str layout: Layout of the data in the file
+        :param str compression: Compression for the packed layout
+
+        """
+
+        if self.comm.rank == 0:
+            self._start()
+            self._queue.put((h5name, h5group, data, layout, compression))
+
+    def flush(self):
+        """
+        Wait until all the data is written
+        """
+
+        if self._thread is not None:
+            self._queue.join()
+
+        dolfin.MPI.barrier(self.comm)
+
+        if self._errors:
+            ex = self._errors[0]
+            self._errors = []
+            raise ex
+
+    def close(self):
+
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+
+_async_writer = None
+
+
+def get_async_writer(comm=dolfin.mpi_comm_world()):
+    """
+    Return the asynchronous result writer, or None if running
+    in parallel. The other processes read the result file while
+    it is written, which is not safe with HDF5.
+    """
+    global _async_writer
+
+    if dolfin.MPI.size(comm) > 1:
+        logger.debug("Asynchronous writing is only supported in serial")
+        return None
+
+    if _async_writer is None:
+        _async_writer = AsyncResultWriter()
+        # Make sure everything is written before we exit
+        atexit.register(_async_writer.close)
+
+    return _async_writer
+
+
+def flush_async_writes():
+    """
+    Wait until all results in the background are written
+    """
+    if _async_writer is not None:
+        _async_writer.flush()
+
+
+@locked_result_file
 def write_opt_results_to_h5(
-    h5group, params, for_result_opt, solver, opt_result, comm=dolfin.mpi_comm_world()
+    h5group,
+    params,
+    for_result_opt,
+    solver,
+    opt_result,
+    comm=dolfin.mpi_comm_world(),
+    state_writer=None,
+    async_writer=None,
 ):
 
     h5name = params["sim_file"]
@@ -59,7 +327,7 @@ def write_opt_results_to_h5(
             for_result_opt["optimal_control"], "/".join([h5group, "optimal_control"])
         )
 
-        # States
+        # States (unless they are already written by the state writer)
         for i, w in enumerate(for_result_opt["states"]):
 
             solver.state.vector().zero()
@@ -70,6 +338,9 @@ def write_opt_results_to_h5(
             h5file.write(u, "/".join([h5group, "displacement/{}".format(i)]))
             h5file.write(p, "/".join([h5group, "lagrange_multiplier/{}".format(i)]))
 
+    if state_writer is not None:
+        state_writer.commit()
+
     data = {
         "initial_control": for_result_opt["initial_control"],
         "bcs": for_result_opt["bcs"],
@@ -87,6 +358,15 @@ def write_opt_results_to_h5(
             data[k]["weights"] = v.weights_arr
 
     gathered_data = gather_dictionary(data)
+
+    layout = params["h5_layout"]
+    compression = params["h5_compression"]
+
+    if async_writer is not None and not parallel_h5py:
+        # The data is gathered, so we can write it in the background
+        async_writer.put(gathered_data, h5name, h5group, layout, compression)
+        return
+
     numpy_dict_to_h5(
         gathered_data,
         h5name,
@@ -94,7 +374,10 @@ def write_opt_results_to_h5(
         comm,
         overwrite_file=False,
         overwrite_group=False,
+        layout=layout,
+        compression=compression,
     )
+    update_manifest(h5name, comm)
 
     # dict2h5_hpc(data, h5name, h5group, comm,
     #             overwrite_file = False, overwrite_group = False)
@@ -27,24 +27,29 @@
 from .io_import import *
 
 
+@locked_result_file
 def passive_inflation_exists(params):
 
     if not os.path.exists(params["sim_file"]):
         return False
 
-    h5file = open_h5py(params["sim_file"], "r")
     key = PASSIVE_INFLATION_GROUP
 
+    exist = lookup_manifest(params["sim_file"], key)
+    if exist is None:
+        h5file = open_h5py(params["sim_file"], "r")
+        exist = key in list(h5file.keys())
+        h5file.close()
+
     # Check if pv point is already computed
-    if key in list(h5file.keys()):
+    if exist is not False:
         logger.info(Text.green("Passive inflation, {}".format("fetched from database")))
-        h5file.close()
         return True
     logger.info(Text.blue("Passive inflation, {}".format("Run Optimization")))
-    h5file.close()
     return False
 
 
+@locked_result_file
 def contract_point_exists(params):
 
     if not os.path.exists(params["sim_file"]):
@@ -52,11 +57,42 @@ def contract_point_exists(params):
         raise IOError("Need state from passive inflation")
         return False
 
-    h5file = open_h5py(params["sim_file"], "r")
     key1 = ACTIVE_CONTRACTION
     key2 = CONTRACTION_POINT.format(params["active_contraction_iteration_number"])
     key3 = PASSIVE_INFLATION_GROUP
 
+    groups = load_manifest(params["sim_file"])
+    if groups is not None:
+
+        if key3 not in groups:
+            logger.info(Text.red("Run passive inflation before systole"))
+            raise IOError("Need state from passive inflation")
+
+        info = groups.get("/".join([key1, key2]))
+        if params["phase"] == PHASES[0] or info is None or "pressure" not in info:
+            logger.info(
+                Text.blue(
+                    "Contract point {}, {}".format(
+                        params["active_contraction_iteration_number"],
+                        "Run Optimization",
+                    )
+                )
+            )
+            return False
+
+        logger.info(
+            Text.green(
+                "Contract point {}, pressure = {:.3f} {}".format(
+                    params["active_contraction_iteration_number"],
+                    info["pressure"],
+                    "fetched from database",
+                )
+            )
+        )
+        return True
+
+    h5file = open_h5py(params["sim_file"], "r")
+
     if not key3 in list(h5file.keys()):
         logger.info(Text.red("Run passive inflation before systole"))
         raise IOError("Need state from passive inflation")
@@ -173,11 +209,17 @@ def open_h5py(h5name, file_mode="a", comm=dolfin.mpi_comm_world()):
         return h5py.File(h5name, file_mode)
 
 
+@locked_result_file
 def check_and_delete(h5name, h5group, comm=dolfin.mpi_comm_world()):
 
+    if lookup_manifest(h5name, h5group) is False:
+        return
+
+    deleted = False
     with open_h5py(h5name, "a", comm) as h5file:
         if h5group in h5file:
 
+            deleted = True
             if parallel_h5py:
 
                 logger.debug("Deleting existing group: '{}'".format(h5group))
@@ -189,6 +231,9 @@ def check_and_delete(h5name, h5group, comm=dolfin.mpi_comm_world()):
                     logger.debug("Deleting existing group: '{}'".format(h5group))
                     del h5file[h5group]
 
+    if deleted:
+        update_manifest(h5name, comm)
+
 
 def dict2h5_hpc(
     d,
@@ -197,6 +242,8 @@ def dict2h5_hpc(
     comm=dolfin.mpi_comm_world(),
     overwrite_file=True,
     overwrite_group=True,
+    layout="default",
+    compression="gzip",
 ):
     """Create a HDF5 file and put the
     data in the dictionary in the 
@@ -208,9 +255,24 @@ def dict2h5_hpc(
 
     :param d: Dictionary to be saved
     :param h5fname: Name of the file where you want to save
-    
+    :param str layout: 'default' (one dataset per array) or
+                       'packed' (see :func:`write_numpy_dict`)
+    :param str compression: Compression for the packed layout
     
     """
+    if layout != "default":
+        # Gather everything and let rank 0 write the packed layout
+        return numpy_dict_to_h5(
+            gather_dictionary(d),
+            h5name,
+            h5group,
+            comm,
+            overwrite_file,
+            overwrite_group,
+            layout,
+            compression,
+        )
+
     if overwrite_file:
         if os.path.isfile(h5name):
             os.remove(h5name)
@@ -330,6 +392,83 @@ def dict2h5_hpc(
         comm.Barrier()
 
 
+def _is_time_series(a):
+    """Check if the dictionary is a series of non-empty 1D arrays
+    of equal length with keys 0, 1, ..., n-1, that can be packed
+    into a single 2D array
+    """
+
+    if len(a) < 2:
+        return False
+
+    keys = [str(k) for k in a.keys()]
+    if sorted(keys) != sorted([str(i) for i in range(len(a))]):
+        return False
+
+    shapes = set()
+    for v in a.values():
+        if not isinstance(v, np.ndarray) or v.ndim != 1:
+            return False
+        shapes.add(v.shape)
+
+    # Empty arrays cannot be chunked
+    return len(shapes) == 1 and shapes.pop() != (0,)
+
+
+def write_numpy_dict(h5file, d, h5group="", layout="default", compression="gzip"):
+    """Write a dictionary with numpy arrays to an open h5py file,
+    with the same hierarchy as the dictionary.
+
+    With the 'packed' layout, time series (dictionaries with keys
+    0, 1, ..., n-1 and 1D arrays of equal length) are stored as one
+    chunked and compressed 2D dataset that can be extended along
+    the first axis, instead of one dataset per time step. Such
+    datasets have the attribute 'packed' set.
+
+    :param h5file: An open h5py file
+    :param dict d: Dictionary with numpy arrays
+    :param str h5group: Group where the data is stored
+    :param str layout: 'default' or 'packed'
+    :param str compression: Compression for the packed layout, e.g 'gzip' or 'lzf'
+
+    """
+
+    for key, val in d.items():
+
+        group = "/".join([h5group, str(key)]) if h5group else str(key)
+        if group in h5file:
+            del h5file[group]
+
+        if layout == "packed" and isinstance(val, dict) and _is_time_series(val):
+
+            data = np.array([val[k] for k in sorted(val, key=lambda k: int(k))])
+            dset = h5file.create_dataset(
+                group,
+                data=data,
+                maxshape=(None, data.shape[1]),
+                chunks=(min(data.shape[0], 64), data.shape[1]),
+                compression=compression,
+            )
+            dset.attrs["packed"] = True
+
+        elif isinstance(val, dict):
+            write_numpy_dict(h5file, val, group, layout, compression)
+
+        elif layout == "packed" and np.size(val) > 1 and np.ndim(val) == 1:
+
+            data = np.asarray(val)
+            h5file.create_dataset(
+                group,
+                data=data,
+                maxshape=(None,),
+                chunks=(min(data.shape[0], 1024),),
+                compression=compression,
+            )
+
+        else:
+            h5file.create_dataset(group, data=np.asarray(val))
+
+
 def numpy_dict_to_h5(
     d,
     h5name,
@@ -337,6 +476,8 @@ def numpy_dict_to_h5(
     comm=dolfin.mpi_comm_world(),
     overwrite_file=True,
     overwrite_group=True,
+    layout="default",
+    compression="gzip",
 ):
     """Create a HDF5 file and put the
     data in the dictionary in the 
@@ -348,7 +489,9 @@ def numpy_dict_to_h5(
 
     :param d: Dictionary to be saved
     :param h5fname: Name of the file where you want to save
-    
+    :param str layout: 'default' (one dataset per array) or
+                       'packed' (see :func:`write_numpy_dict`)
+    :param str compression: Compression for the packed layout
     
     """
     if overwrite_file:
@@ -363,7 +506,11 @@ def numpy_dict_to_h5(
     if file_mode == "a" and overwrite_group and h5group != "":
         check_and_delete(h5name, h5group, comm)
 
-    if comm.rank == 0:
+    if comm.rank == 0 and layout != "default":
+        with h5py.File(h5name, file_mode) as h5file:
+            write_numpy_dict(h5file, d, h5group, layout, compression)
+
+    elif comm.rank == 0:
         with h5py.File(h5name, file_mode) as h5file:
 
             def dict2h5(a, group):
@@ -606,6 +606,7 @@ class OptimalControl(object):
         opt_result["nfev"] = self.rd.iter
         opt_result["nit"] = self.rd.iter
         opt_result["njev"] = self.rd.nr_der_calls
+        opt_result["njev_saved"] = self.rd.nr_saved_der_calls
         opt_result["ncrash"] = self.rd.nr_crashes
         opt_result["run_time"] = run_time
         opt_result["controls"] = self.rd.controls_lst
@@ -613,5 +614,8 @@ class OptimalControl(object):
         opt_result["forward_times"] = self.rd.forward_times
         opt_result["backward_times"] = self.rd.backward_times
         opt_result["grad_norm"] = self.rd.grad_norm
+        opt_result["memo_hits"] = self.rd.memo_hits
+        opt_result["memo_misses"] = self.rd.memo_misses
+        opt_result["memo_rerecords"] = self.rd.memo_rerecords
 
         return self.rd, opt_result
@@ -47,6 +47,72 @@ from .adjoint_contraction_args import logger
 
 __all__ = ["RegionalStrainTarget", "FullStrainTarget", "VolumeTarget", "Regularization"]
 
+# Assembled geometric quantities, such as the mesh volume, the volume
+# of each region and the endocardial area, keyed by the mesh and the
+# measure. These are shared between the targets, so that they are not
+# reassembled for every contract point.
+_geometry_metrics = {}
+
+
+def clear_geometry_metrics():
+    """Remove all the cached geometric quantities
+    """
+    _geometry_metrics.clear()
+
+
+def mesh_function_key(f):
+    """Return a key for a mesh function that changes with the
+    markers. The id of the python object can be reused by a new
+    mesh function after the old one is garbage collected, so
+    the key consists of the dolfin id and a hash of the values.
+    """
+    import hashlib
+
+    arr = np.ascontiguousarray(f.array())
+    return (f.id(), hashlib.sha1(arr.tobytes()).hexdigest())
+
+
+def assemble_geometry_metric(dmu, subdomain_id=None):
+    """Return the size (volume or area) of the domain given by
+    the measure. The value is only assembled the first time, as
+    long as the mesh (including the coordinates) and the
+    subdomain data are unchanged.
+
+    :param dmu: The measure
+    :type dmu: :py:class:`ufl.Measure`
+    :param int subdomain_id: The subdomain to integrate over
+    :returns: The volume or area
+    :rtype: float
+
+    """
+
+    if subdomain_id is not None:
+        dmu = dmu(int(subdomain_id))
+
+    if dmu.ufl_domain() is None:
+        # We do not know which mesh this is
+        return dolfin.assemble(dolfin.Constant(1.0) * dmu)
+
+    mesh = dmu.ufl_domain().ufl_cargo()
+    subdomain_data = dmu.subdomain_data()
+    key = (
+        mesh.id(),
+        mesh.hash(),
+        dmu.integral_type(),
+        None if subdomain_data is None else mesh_function_key(subdomain_data),
+        str(dmu.subdomain_id()),
+    )
+
+    # Make sure that all processes agree, since
+    # assemble needs to be called on all of them
+    hit = float(key in _geometry_metrics)
+    if dolfin.MPI.min(mesh.mpi_comm(), hit) > 0:
+        return _geometry_metrics[key]
+
+    value = dolfin.assemble(dolfin.Constant(1.0) * dmu)
+    _geometry_metrics[key] = value
+    return value
+
 
 class OptimizationTarget(object):
     """Base class for optimization target
@@ -73,8 +139,7 @@ class OptimizationTarget(object):
 
         # The volume of the mesh
         self.meshvol = dolfin.Constant(
-            dolfin.assemble(dolfin.Constant(1.0) * dolfin.dx(mesh)),
-            name="mesh volume"
+            assemble_geometry_metric(dolfin.dx(mesh)), name="mesh volume"
         )
 
         # Test and trial functions for the target space
@@ -187,6 +252,7 @@ class RegionalStrainTarget(OptimizationTarget):
         F_ref=None,
         approx="original",
         map_strain=False,
+        batched=False,
     ):
         """
         Initialize regional strain target
@@ -208,6 +274,11 @@ class RegionalStrainTarget(OptimizationTarget):
             Which strain tensor to use, e.g gradu, E, C, F
         F_ref: :py:class:`dolfin.Function`
             Tensor to map strains to reference
+        batched: bool
+            If True, the strains and functional values in all regions
+            are computed with a single solve, using a vector valued
+            real space with one component per region and basis
+            function. This reduces the size of the adjoint tape.
         
         """
         self._name = "Regional Strain"
@@ -263,16 +334,41 @@ class RegionalStrainTarget(OptimizationTarget):
             self.weights_arr = weights
 
         self.target_space = dolfin.VectorFunctionSpace(mesh, "R", 0, dim=self.nbasis)
+        self.batched = batched
+        if batched:
+            self.batch_space = dolfin.VectorFunctionSpace(
+                mesh, "R", 0, dim=self.nregions * self.nbasis
+            )
+            self.batch_realspace = dolfin.VectorFunctionSpace(
+                mesh, "R", 0, dim=self.nregions
+            )
         self.weight_space = dolfin.TensorFunctionSpace(mesh, "R", 0)
         self.dmu = dmu
 
         self.meshvols = [
-            dolfin.Constant(dolfin.assemble(dolfin.Constant(1.0) * dmu(int(i))), name="mesh volume")
+            dolfin.Constant(assemble_geometry_metric(dmu, i), name="mesh volume")
             for i in self.regions
         ]
 
         OptimizationTarget.__init__(self, mesh)
 
+        # Target data with shape (time, region, basis)
+        self.data = np.zeros((0, self.nregions, self.nbasis))
+
+        if batched:
+            self._trial = dolfin.TrialFunction(self.batch_space)
+            self._test = dolfin.TestFunction(self.batch_space)
+            self._trial_r = dolfin.TrialFunction(self.batch_realspace)
+            self._test_r = dolfin.TestFunction(self.batch_realspace)
+
+    def _region_component(self, f, i):
+        """Return the components of a batched function
+        that belongs to region number i
+        """
+        return dolfin.as_vector(
+            [f[i * self.nbasis + j] for j in range(self.nbasis)]
+        )
+
     def print_head(self):
         return "\t{:<10}".format("I_strain")
 
@@ -286,6 +382,21 @@ class RegionalStrainTarget(OptimizationTarget):
         self.results["func_value"].append(self.func_value)
         target = []
         simulated = []
+
+        if self.batched:
+            target_arr = numpy_mpi.gather_broadcast(self.target_fun.vector().get_local())
+            simulated_arr = numpy_mpi.gather_broadcast(
+                self.simulated_fun.vector().get_local()
+            )
+            for i in range(self.nregions):
+                idx = slice(i * self.nbasis, (i + 1) * self.nbasis)
+                target.append(target_arr[idx])
+                simulated.append(simulated_arr[idx])
+
+            self.results["target"].append(target)
+            self.results["simulated"].append(simulated)
+            return
+
         for i in range(self.nregions):
 
             target.append(dolfin.Vector(self.target_fun[i].vector()))
@@ -295,26 +406,48 @@ class RegionalStrainTarget(OptimizationTarget):
         self.results["simulated"].append(simulated)
 
     def load_target_data(self, target_data, n):
-        """Load the target data
+        """Load the target data. The data is stored in an
+        array of shape (time, region, basis). Regions without
+        data get a zero target.
 
         :param dict target_data: The data
         :param int n: Index
 
         """
-        strains = []
-        for i in self.regions:
-            f = dolfin_adjoint.Function(self.target_space)
+        arr = np.zeros((1, self.nregions, self.nbasis))
+        for k, i in enumerate(self.regions):
             if int(i) in target_data:
-                numpy_mpi.assign_to_vector(f.vector(), np.array(target_data[int(i)][n]))
-                strains.append(f)
+                arr[0, k] = target_data[int(i)][n]
 
-        self.data.append(strains)
+        self.data = np.concatenate((self.data, arr))
 
     def set_target_functions(self):
         """
         Initialize the functions
 
         """
+        if self.batched:
+            self.target_fun = dolfin_adjoint.Function(
+                self.batch_space, name="Target Strains"
+            )
+            self.simulated_fun = dolfin_adjoint.Function(
+                self.batch_space, name="Simulated Strains"
+            )
+            self.functional = dolfin_adjoint.Function(
+                self.batch_realspace, name="Strains Functional"
+            )
+        else:
+            self._set_region_functions()
+
+        self.weights = [
+            dolfin_adjoint.Function(self.weight_space, name="Strains Weights_{}".format(i + 1))
+            for i in range(self.nregions)
+        ]
+
+        self._set_weights()
+        self._set_form()
+
+    def _set_region_functions(self):
 
         self.target_fun = [
             dolfin_adjoint.Function(self.target_space, name="Target Strains_{}".format(i + 1))
@@ -331,14 +464,6 @@ class RegionalStrainTarget(OptimizationTarget):
             for i in range(self.nregions)
         ]
 
-        self.weights = [
-            dolfin_adjoint.Function(self.weight_space, name="Strains Weights_{}".format(i + 1))
-            for i in range(self.nregions)
-        ]
-
-        self._set_weights()
-        self._set_form()
-
     def _set_weights(self):
 
         for i in range(self.nregions):
@@ -348,12 +473,29 @@ class RegionalStrainTarget(OptimizationTarget):
 
     def _set_form(self):
 
+        if self.batched:
+            self._form = [
+                (
+                    dolfin.dot(
+                        self.weights[i],
+                        self._region_component(self.simulated_fun, i)
+                        - self._region_component(self.target_fun, i),
+                    )
+                )
+                ** 2
+                for i in range(self.nregions)
+            ]
+            return
+
         self._form = [
             (dolfin.dot(self.weights[i], self.simulated_fun[i] - self.target_fun[i])) ** 2
             for i in range(self.nregions)
         ]
 
     def get_value(self):
+        if self.batched:
+            return sum(numpy_mpi.gather_broadcast(self.functional.vector().get_local()))
+
         return sum(
             [
                 numpy_mpi.gather_broadcast(self.functional[i].vector().get_local())[0]
@@ -365,12 +507,26 @@ class RegionalStrainTarget(OptimizationTarget):
         """Assing target regional strain
 
         :param target: Target regional strain
-        :type target: list of :py:class:`dolfin.Function`
+        :type target: :py:class:`numpy.ndarray` of shape (region, basis)
         """
 
         logger.debug("Assign target for {}".format(self._name))
-        for fun, target in zip(self.target_fun, target):
-            fun.assign(target, annotate=annotate)
+        if self.batched:
+            funs = [self.target_fun]
+            arrs = [np.asarray(target).flatten()]
+        else:
+            funs = self.target_fun
+            arrs = target
+
+        for fun, arr in zip(funs, arrs):
+            if annotate:
+                # Assign through a function so that dolfin-adjoint
+                # records the new value of the target
+                f = dolfin_adjoint.Function(fun.function_space())
+                numpy_mpi.assign_to_vector(f.vector(), arr)
+                fun.assign(f, annotate=True)
+            else:
+                numpy_mpi.assign_to_vector(fun.vector(), arr)
 
     def assign_simulated(self, u):
         """Assing simulated regional strain
@@ -407,6 +563,32 @@ class RegionalStrainTarget(OptimizationTarget):
 
             tensor_diag = dolfin.as_vector([dolfin.inner(tensor * e, e) for e in self.crl_basis])
 
+            if self.batched:
+                # Project the strains in all regions at once
+                a = list_sum(
+                    [
+                        dolfin.inner(
+                            self._region_component(self._trial, i),
+                            self._region_component(self._test, i),
+                        )
+                        * self.dmu(int(r))
+                        for i, r in enumerate(self.regions)
+                    ]
+                )
+                L = list_sum(
+                    [
+                        dolfin.inner(self._region_component(self._test, i), tensor_diag)
+                        * self.dmu(int(r))
+                        for i, r in enumerate(self.regions)
+                    ]
+                )
+                dolfin_adjoint.solve(
+                    a == L,
+                    self.simulated_fun,
+                    solver_parameters={"linear_solver": "gmres"},
+                )
+                return
+
             # Make a project for dolfin-adjoint recording
             for i, r in enumerate(self.regions):
 
@@ -423,6 +605,22 @@ class RegionalStrainTarget(OptimizationTarget):
     def assign_functional(self):
 
         logger.debug("Assign functional for {}".format(self._name))
+        if self.batched:
+            a = list_sum(
+                [
+                    self._trial_r[i] * self._test_r[i] / self.meshvol * dolfin.dx
+                    for i in range(self.nregions)
+                ]
+            )
+            L = list_sum(
+                [
+                    self._test_r[i] * self._form[i] / self.meshvols[i] * self.dmu(int(r))
+                    for i, r in enumerate(self.regions)
+                ]
+            )
+            dolfin_adjoint.solve(a == L, self.functional)
+            return
+
         for i, r in enumerate(self.regions):
             dolfin_adjoint.solve(
                 self._trial_r * self._test_r / self.meshvol * dolfin.dx
@@ -431,6 +629,10 @@ class RegionalStrainTarget(OptimizationTarget):
             )
 
     def get_functional(self):
+        if self.batched:
+            functional = list_sum([self.functional[i] for i in range(self.nregions)])
+            return (functional / self.meshvol) * dolfin.dx
+
         return (list_sum(self.functional) / self.meshvol) * dolfin.dx
 
 
@@ -505,7 +707,7 @@ class VolumeTarget(OptimizationTarget):
         self.chamber = chamber
 
         self.target_space = dolfin.FunctionSpace(mesh, "R", 0)
-        self.endoarea = dolfin.Constant(dolfin.assemble(dolfin.Constant(1.0) * dmu), name="endo area")
+        self.endoarea = dolfin.Constant(assemble_geometry_metric(dmu), name="endo area")
 
         assert approx in ["project", "interpolate", "original"]
         self.approx = approx
@@ -601,7 +803,9 @@ class Regularization(object):
             else dolfin.MeshFunction("size_t", mesh, mesh.geometry().dim(), mesh.domains())
         )
 
-        self.meshvol = dolfin.Constant(dolfin.assemble(dolfin.Constant(1.0) * dolfin.dx(mesh)), name="mesh volume")
+        self.meshvol = dolfin.Constant(
+            assemble_geometry_metric(dolfin.dx(mesh)), name="mesh volume"
+        )
         self._regtype = regtype
         # A real space for projecting the functional
         self._realspace = dolfin.FunctionSpace(mesh, "R", 0)
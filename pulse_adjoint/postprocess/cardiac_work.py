@@ -25,6 +25,7 @@
 # WARRANTIES OF ANY KIND, EITHER IMPLIED OR EXPRESSED, INCLUDING, BUT
 # NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY OR FITNESS
 from .args import *
+from .utils import LocalProjector
 
 
 class CardiacWork(object):
@@ -120,6 +121,10 @@ class CardiacWork(object):
         self._V = V
         self._W = W
 
+        # Both spaces are discontinuous, so we can project locally
+        self._project_V = LocalProjector(V)
+        self._project_W = LocalProjector(W)
+
         self.reset()
         self._print_head()
 
@@ -152,6 +157,7 @@ class CardiacWork(object):
 
         self._strain_tensor_prev = dolfin.Function(self._V, name="strain_tensor_prev")
         self._stress_tensor_prev = dolfin.Function(self._V, name="stress_tensor_prev")
+        self._work_sum = dolfin.Function(self._W, name="work")
         self._work = []
         self._power = []
 
@@ -177,12 +183,11 @@ class CardiacWork(object):
         # Compute power
         P = self._compute_power(S, dE)
 
-        self._power.append(P.copy())
+        self._power.append(P)
 
         # The work is just the cumulative sum
-        from ..utils import list_sum
-
-        self._work.append(list_sum(self._power))
+        self._work_sum.vector().axpy(1.0, P.vector())
+        self._work.append(self._work_sum.copy(deepcopy=True))
 
         # self._print_line()
         self._assign_prev()
@@ -195,14 +200,12 @@ class CardiacWork(object):
 
     def _assign_prev(self):
 
-        S = dolfin.project(self._stress_tensor, self._V)
-        E = dolfin.project(self._strain_tensor, self._V)
-        self._strain_tensor_prev.assign(E)
-        self._stress_tensor_prev.assign(S)
+        self._project_V(self._stress_tensor, self._stress_tensor_prev)
+        self._project_V(self._strain_tensor, self._strain_tensor_prev)
 
     def _compute_power(self, S, dE):
 
-        return dolfin.project(dolfin.inner(S, dE), self._W)
+        return self._project_W(dolfin.inner(S, dE))
 
     def _print_head(self):
 
@@ -286,6 +289,7 @@ class CardiacWorkEcho(CardiacWork):
 
         self._strain_tensor_prev = dolfin.Function(self._V, name="strain_tensor_prev")
         self._stress_tensor_prev = 0.0
+        self._work_sum = dolfin.Function(self._W, name="work")
         self._work = []
         self._power = []
 
@@ -312,8 +316,7 @@ class CardiacWorkEcho(CardiacWork):
 
     def _assign_prev(self):
 
-        E = dolfin.project(self._strain_tensor, self._V)
-        self._strain_tensor_prev.assign(E)
+        self._project_V(self._strain_tensor, self._strain_tensor_prev)
         self._stress_tensor_prev = self._stress_tensor
 
 
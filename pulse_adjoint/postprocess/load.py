@@ -38,6 +38,7 @@ from copy import deepcopy
 import numpy as np
 from .args import *
 from . import utils
+from ..utils import load_manifest
 
 
 attributes = [
@@ -408,10 +409,210 @@ def get_unloaded_data(params):
     plt.show()
 
 
-def load_dict_from_h5(fname, h5group=""):
+class _H5Source(object):
+    """
+    A read only handle to a HDF5 file that is shared by all the
+    groups of a :class:`LazyH5Dict`. The file is opened the first
+    time it is needed, unless an open file is given.
+    """
+
+    def __init__(self, fname, h5file=None):
+        self.fname = fname
+        self._h5file = h5file
+
+    @property
+    def h5file(self):
+        import h5py
+
+        if self._h5file is None or not self._h5file.id.valid:
+            self._h5file = h5py.File(self.fname, "r")
+        return self._h5file
+
+    def close(self):
+        if self._h5file is not None and self._h5file.id.valid:
+            self._h5file.close()
+        self._h5file = None
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+def _load_dataset(dset):
+    """
+    Load a dataset. Packed time series are
+    unpacked into a dictionary.
+    """
+
+    t = np.array(dset)
+
+    if dset.attrs.get("packed", False):
+        # Time series stored as a 2D array. Unpack it
+        # so that we get the same dictionary as for
+        # the default layout
+        t = {str(i): t[i] for i in range(t.shape[0])}
+
+    return t
+
+
+class LazyH5Dict(dict):
+    """
+    A dictionary view of a group in a HDF5 file. Nothing is
+    read before it is accessed. Subgroups become new views and
+    datasets are loaded (see :func:`_load_dataset`) the first time
+    they are accessed, and then kept in the dictionary. All the
+    views share one open file. Use :meth:`dataset` to read only
+    a part of a large dataset.
+
+    Items can be added and removed as in a normal dictionary,
+    without changing the file. Use :meth:`to_dict` to load everything.
+
+    :param source: The file
+    :type source: :class:`_H5Source` or str
+    :param str h5group: The group
+
+    """
+
+    def __init__(self, source, h5group=""):
+        dict.__init__(self)
+
+        if not isinstance(source, _H5Source):
+            source = _H5Source(source)
+
+        self._source = source
+        self._h5group = h5group
+        group = source.h5file[h5group] if h5group else source.h5file
+        self._keys = [str(k) for k in group.keys()]
+
+    def _load(self, key):
+
+        import h5py
+
+        path = "/".join([self._h5group, key]) if self._h5group else key
+        item = self._source.h5file[path]
+
+        if isinstance(item, h5py.Group):
+            return LazyH5Dict(self._source, path)
+        return _load_dataset(item)
+
+    def dataset(self, key):
+        """
+        Return the h5py dataset for the given key without loading
+        it, so that it can be sliced. The dataset is only valid
+        while the file is open.
+        """
+        if key not in self._keys:
+            raise KeyError(key)
+
+        path = "/".join([self._h5group, key]) if self._h5group else key
+        return self._source.h5file[path]
+
+    def __getitem__(self, key):
+
+        if not dict.__contains__(self, key):
+            if key not in self._keys:
+                raise KeyError(key)
+            dict.__setitem__(self, key, self._load(key))
+
+        return dict.__getitem__(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self._keys:
+            self._keys.append(key)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        self._keys.remove(key)
+        if dict.__contains__(self, key):
+            dict.__delitem__(self, key)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(list(self._keys))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return "LazyH5Dict({}:{}, keys={})".format(
+            self._source.fname, self._h5group or "/", self._keys
+        )
+
+    def __reduce__(self):
+        return (dict, (self.to_dict(),))
+
+    def __deepcopy__(self, memo):
+        from copy import deepcopy
+
+        return deepcopy(self.to_dict(), memo)
+
+    def keys(self):
+        return list(self._keys)
+
+    def values(self):
+        return [self[k] for k in self._keys]
+
+    def items(self):
+        return [(k, self[k]) for k in self._keys]
+
+    def get(self, key, default=None):
+        return self[key] if key in self._keys else default
+
+    def setdefault(self, key, default=None):
+        if key not in self._keys:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        if key not in self._keys:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        value = self[key]
+        del self[key]
+        return value
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def copy(self):
+        return dict(self.items())
+
+    def to_dict(self):
+        """
+        Load everything into a normal dictionary of numpy arrays
+        """
+
+        d = {}
+        for key, value in self.items():
+            if isinstance(value, LazyH5Dict):
+                value = value.to_dict()
+            d[key] = value
+        return d
+
+    def close(self):
+        """
+        Close the file. It is reopened if more data is needed
+        """
+        self._source.close()
+
+
+def load_dict_from_h5(fname, h5group="", lazy=False):
     """
     Load the given h5file into
     a dictionary
+
+    :param str fname: Name of the file
+    :param str h5group: Group to load
+    :param bool lazy: If True, return a :class:`LazyH5Dict` that only
+                      reads the data that is accessed.
     """
     import h5py
 
@@ -419,34 +620,136 @@ def load_dict_from_h5(fname, h5group=""):
 
     # Just some error handling in case file is broken
     try:
-        f = h5py.File(fname, "r")
+        h5file = h5py.File(fname, "r")
     except:
         return {}
-    f.close()
 
-    with h5py.File(fname, "r") as h5file:
+    if h5group != "" and h5group not in h5file:
+        msg = "h5group {} does not exist in h5file {}".format(fname, h5group)
+        logger.warning(msg)
+        h5file.close()
+        return None
+
+    # The file stays open for the lazy dictionary
+    d = LazyH5Dict(_H5Source(fname, h5file), h5group)
+    if lazy:
+        return d
 
-        def h52dict(hdf):
-            if isinstance(hdf, h5py._hl.group.Group):
-                t = {}
+    t = d.to_dict()
+    d.close()
+    return t
 
-                for key in list(hdf.keys()):
-                    t[str(key)] = h52dict(hdf[key])
 
-            elif isinstance(hdf, h5py._hl.dataset.Dataset):
-                t = np.array(hdf)
+def save_dict_to_npz(d, fname, **attrs):
+    """
+    Save a nested dictionary to a .npz file. Leaves that can be
+    converted to numeric numpy arrays are stored as arrays, and all
+    other leaves are stored as json. The type of the keys (e.g int
+    for regions) is preserved. The file is written to a temporary
+    file that is renamed, so that it is never partially written.
 
-            return t
+    :param dict d: The dictionary
+    :param str fname: Name of the file
+    :param attrs: Extra json serializable values to store with the data
+                  (see :func:`load_npz_attrs`)
 
-        if h5group != "":
-            if h5group in h5file:
-                d = h52dict(h5file[h5group])
+    """
+    import json
+
+    index = []
+    arrays = {}
+
+    def to_json(v):
+        # Nested lists of arrays (e.g. ragged time series)
+        if isinstance(v, np.ndarray):
+            return [to_json(x) for x in v] if v.ndim > 0 else v.item()
+        if isinstance(v, (list, tuple)):
+            return [to_json(x) for x in v]
+        if isinstance(v, dict):
+            return {str(k): to_json(x) for k, x in v.items()}
+        if isinstance(v, np.generic):
+            return v.item()
+        return v
+
+    def flatten(a, path):
+
+        if len(a) == 0:
+            index.append({"path": path, "dict": True})
+
+        for k, v in a.items():
+
+            p = path + [k.item() if isinstance(k, np.generic) else k]
+
+            if isinstance(v, dict):
+                flatten(v, p)
+                continue
+
+            arr = None
+            if isinstance(v, (np.ndarray, list, tuple)):
+                try:
+                    arr = np.asarray(v)
+                except ValueError:
+                    arr = None
+
+            if arr is not None and arr.dtype.kind in "biuf":
+                name = "arr_{}".format(len(arrays))
+                arrays[name] = arr
+                index.append({"path": p, "array": name})
             else:
-                msg = "h5group {} does not exist in h5file {}".format(fname, h5group)
-                logger.warning(msg)
-                return None
-        else:
-            d = h52dict(h5file)
+                index.append({"path": p, "value": to_json(v)})
+
+    flatten(d, [])
+
+    arrays["__index__"] = np.array(json.dumps(index))
+    arrays["__attrs__"] = np.array(json.dumps(attrs))
+
+    tmpname = "{}.{}.tmp".format(fname, os.getpid())
+    with open(tmpname, "wb") as f:
+        np.savez(f, **arrays)
+    os.rename(tmpname, fname)
+
+
+def load_npz_attrs(fname):
+    """
+    Load the extra values stored with :func:`save_dict_to_npz`.
+    Return an empty dictionary if the file does not exist
+    or is broken.
+    """
+    import json
+
+    try:
+        with np.load(fname) as f:
+            return json.loads(str(f["__attrs__"]))
+    except (IOError, OSError, KeyError, ValueError):
+        return {}
+
+
+def load_dict_from_npz(fname):
+    """
+    Load a dictionary saved with :func:`save_dict_to_npz`.
+    Arrays are returned as lists.
+    """
+    import json
+
+    d = {}
+    with np.load(fname) as f:
+        index = json.loads(str(f["__index__"]))
+
+        for item in index:
+
+            if "dict" in item:
+                value = {}
+            elif "array" in item:
+                value = f[item["array"]].tolist()
+            else:
+                value = item["value"]
+
+            a = d
+            for k in item["path"][:-1]:
+                a = a.setdefault(k, {})
+
+            if item["path"]:
+                a[item["path"][-1]] = value
 
     return d
 
@@ -567,22 +870,47 @@ def get_data(params, patient=None):
         raise IOError("File {} does not exist".format(params["sim_file"]))
 
     ####### Containers and keys
-    all_data = load_dict_from_h5(params["sim_file"])
+    # Only the data that is used is read from the file
+    all_data = load_dict_from_h5(params["sim_file"], lazy=True)
+    # Groups in the file (None if there is no manifest)
+    groups = load_manifest(params["sim_file"])
+
+    def subgroups(path):
+        """The names of the groups in the given group"""
+        if groups is None:
+            d = all_data
+            for key in path.split("/") if path else []:
+                d = d[key]
+            return list(d.keys())
+
+        depth = path.count("/") + 1 if path else 0
+        prefix = path + "/" if path else ""
+        return [
+            g.split("/")[-1]
+            for g in groups
+            if g.startswith(prefix) and g.count("/") == depth
+        ]
 
-    passive = (
-        {} if "passive_inflation" not in all_data else all_data["passive_inflation"]
-    )
-    active = (
-        {} if "active_contraction" not in all_data else all_data["active_contraction"]
-    )
-    active_keys = sorted(
-        list(active.keys()), key=lambda t: int(t.rsplit("contract_point_")[-1])
-    )
+    def close_data():
+        # The file is opened by dolfin as well. It
+        # is reopened if more data is read
+        if isinstance(all_data, LazyH5Dict):
+            all_data.close()
 
     main_active_group = "active_contraction"
     passive_group = "passive_inflation"
     active_group = "/".join([main_active_group, "contract_point_{}"])
 
+    top_groups = subgroups("")
+    passive = {} if passive_group not in top_groups else all_data[passive_group]
+    active = (
+        {} if main_active_group not in top_groups else all_data[main_active_group]
+    )
+    active_keys = sorted(
+        subgroups(main_active_group) if active else [],
+        key=lambda t: int(t.rsplit("contract_point_")[-1]),
+    )
+
     opt_res = {
         "run_time": [],
         "nit": [],
@@ -607,7 +935,8 @@ def get_data(params, patient=None):
     ###### Create proper functions and objects
 
     if patient is None:
-        patient = get_patient_geometry_from_results(params, "unloaded" in all_data)
+        unloaded = "unloaded" in top_groups
+        patient = get_patient_geometry_from_results(params, unloaded)
 
     from .utils import init_spaces
 
@@ -693,9 +1022,9 @@ def get_data(params, patient=None):
             data["unload"]["ed_rv_volume"] = {}
 
         unload_iters = []
-        for k in list(all_data.keys()):
+        for k in top_groups:
             if k.isdigit():
-                if "passive_inflation" in all_data[k]:
+                if passive_group in subgroups(k):
                     unload_iters.append(k)
                 else:
                     msg = (
@@ -706,7 +1035,8 @@ def get_data(params, patient=None):
 
         unload_iters = sorted(unload_iters, key=lambda t: int(t))
 
-        if not unload_iters or "passive_inflation" not in all_data[unload_iters[0]]:
+        if not unload_iters:
+            close_data()
             return {}, patient
 
         data["unload"]["target_volumes"] = all_data[unload_iters[0]][
@@ -720,7 +1050,7 @@ def get_data(params, patient=None):
         unload_subiters = {}
         for k in unload_iters:
             its = []
-            for i in list(all_data[k].keys()):
+            for i in subgroups(k):
                 if i.isdigit():
                     its.append(i)
             unload_subiters[k] = sorted(its, key=lambda t: int(t))
@@ -739,6 +1069,7 @@ def get_data(params, patient=None):
                     "passive_inflation"
                 ]["rv_volume"]["simulated"]
 
+        close_data()
         with dolfin.HDF5File(
             dolfin.mpi_comm_world(), params["sim_file"], "r"
         ) as h5file:
@@ -813,6 +1144,7 @@ def get_data(params, patient=None):
     if not passive:
         msg = "No passive data found. Return... "
         print(msg)
+        close_data()
         return data, patient
 
     pressures = passive["bcs"]["pressure"]
@@ -829,6 +1161,7 @@ def get_data(params, patient=None):
         else:
             interpolation_points.append(i)
 
+    close_data()
     with h5py.File(params["sim_file"], "r") as h5file:
 
         if "optimization_results" in h5file[passive_group]:
@@ -20,7 +20,7 @@ and plot the results easily.
 # You should have received a copy of the GNU Lesser General Public License
 # along with PULSE-ADJOINT. If not, see <http://www.gnu.org/licenses/>.
 from scipy import stats
-import os, yaml
+import os, yaml, json, hashlib
 from ..setup_optimization import (
     setup_adjoint_contraction_parameters,
     setup_general_parameters,
@@ -72,10 +72,16 @@ class PostProcess(object):
         The data is stored in a yaml file and 
         will be loaded if it exist and recompute is False. 
         If recompute is True, then the feature will be recomputed
+    nprocs: int
+        Number of processes used to compute the features. The
+        patients are independent, and with nprocs > 1 each patient
+        is computed by a separate (serial) process.
     
     """
 
-    def __init__(self, fname, geoname, pname, outdir, tmp_dir=None, recompute=False):
+    def __init__(
+        self, fname, geoname, pname, outdir, tmp_dir=None, recompute=False, nprocs=1
+    ):
 
         logger.info("Load file {}".format(fname))
 
@@ -86,6 +92,7 @@ class PostProcess(object):
         self.set_feature_keys()
 
         self._recompute = recompute
+        self._nprocs = nprocs
         self._outdir = outdir
         self._keys = list(self._data.keys())
         # self._mesh_path = mesh_path
@@ -114,42 +121,85 @@ class PostProcess(object):
 
         """
 
-        self._data = load.load_dict_from_h5(fname)
+        # Data is only read from the file when it is used
+        self._data = load.load_dict_from_h5(fname, lazy=True)
+
+    def _tmp_results_path(self, patient_name, key):
+
+        name = "_".join([patient_name, key]) + ".npz"
+        return "/".join([self._tmp_resdir, name])
+
+    def _tmp_results_hash(self, patient_name, key):
+        """
+        Hash of everything the results for the given patient and
+        key are computed from. All the results depend on the
+        parameters and the files, and the mechanical features
+        also depend on which features that are computed.
+        """
+
+        def default(obj):
+            if hasattr(obj, "vector"):
+                return obj.vector().get_local().tolist()
+            if hasattr(obj, "values"):
+                return np.asarray(obj.values()).tolist()
+            if hasattr(obj, "to_dict"):
+                return obj.to_dict()
+            if isinstance(obj, np.ndarray):
+                return obj.tolist()
+            if isinstance(obj, np.generic):
+                return obj.item()
+            return str(obj)
+
+        params = getattr(self, "_params", None)
+        if params is not None and not isinstance(params, dict):
+            params = params.to_dict()
+
+        def mtime(fname):
+            return os.path.getmtime(fname) if os.path.isfile(fname) else None
+
+        inputs = {
+            "patient": patient_name,
+            "key": key,
+            "params": params,
+            "geometry": mtime(self._geoname),
+            "results": mtime(self._fname),
+        }
+        if key == "features_scalar":
+            inputs["feature_keys"] = list(getattr(self, "_feature_keys", []))
+
+        s = json.dumps(inputs, sort_keys=True, default=default)
+        return hashlib.sha1(s.encode("utf-8")).hexdigest()
 
     def _data_exist(self, patient_name, key):
+        """
+        Check if there are temporary results for the given patient and
+        key that are computed from the current data and parameters
+        """
 
-        name = "_".join([patient_name, key]) + ".yml"
-        return os.path.isfile("/".join([self._tmp_resdir, name]))
+        path = self._tmp_results_path(patient_name, key)
+        if not os.path.isfile(path):
+            return False
 
-    def _load_tmp_results(self, patient_name, key, d):
+        attrs = load.load_npz_attrs(path)
+        if attrs.get("hash") != self._tmp_results_hash(patient_name, key):
+            logger.info("Temporary results {} are outdated".format(path))
+            return False
+
+        return True
 
-        name = "_".join([patient_name, key]) + ".yml"
-        path = "/".join([self._tmp_resdir, name])
+    def _load_tmp_results(self, patient_name, key, d):
 
-        with open(path, "rb") as parfile:
-            data = yaml.load(parfile)
+        path = self._tmp_results_path(patient_name, key)
+        data = load.load_dict_from_npz(path)
 
         d.update(**data)
 
     def _save_tmp_results(self, patient_name, key, d):
 
-        name = "_".join([patient_name, key]) + ".yml"
-        path = "/".join([self._tmp_resdir, name])
-
-        def listize(dic):
-            d1 = {}
-            for k, v in list(dic.items()):
-                if isinstance(v, dict):
-                    d1[k] = listize(v)
-                elif isinstance(v, np.ndarray):
-                    d1[k] = v.tolist()
-                else:
-                    d1[k] = v
-            return d1
-
-        d1 = listize(d)
-        with open(path, "wb") as f:
-            yaml.dump(d1, f, default_flow_style=False)
+        path = self._tmp_results_path(patient_name, key)
+        load.save_dict_to_npz(
+            d, path, hash=self._tmp_results_hash(patient_name, key)
+        )
 
     def _update_results(self, data):
         """ Update results
@@ -334,387 +384,465 @@ class PostProcess(object):
 
         data = {}
         self._passive_filling_duration = {}
-        for patient_name in self._keys:
 
-            val = self.get_data(patient_name)
+        nprocs = min(self._nprocs, len(self._keys))
+        if nprocs > 1:
+            results = self._compute_pool(nprocs, args)
+        else:
+            results = self._compute_serial(args)
 
-            data[patient_name] = {}
+        for patient_name, (d, passive_filling_duration, features) in results:
+            data[patient_name] = d
+            self._passive_filling_duration[patient_name] = passive_filling_duration
+            if features:
+                self._update_features(features)
 
-            params, patient = self._setup_compute(patient_name)
-            self._passive_filling_duration[
-                patient_name
-            ] = patient.passive_filling_duration
-
-            def compute_echo_work(patient, params):
-                strain = {}
-                load.load_measured_strain(strain, patient, "measured_strain")
-                try:
-                    # Not all the patients have meausred work
-                    measured_work = {
-                        k: np.transpose(v)[2].tolist() for k, v in patient.work.items()
-                    }
-                except:
-                    # Compute work as how it would be measured from the strains
-                    measured_work = {}
-                    pressure = (
-                        patient.pressure[1:] if params["unload"] else patient.pressure
-                    )
-                    for r, s in strain["measured_strain"]["longitudinal"].items():
+        self._update_results(data)
 
-                        measured_work[r] = utils.compute_cardiac_work_echo(
-                            pressure, s, flip=True
-                        )
+    def _compute_serial(self, args):
 
-                return measured_work
+        return [
+            (patient_name, self._compute_patient(patient_name, *args))
+            for patient_name in self._keys
+        ]
 
-            if "measurements" in args:
+    def _compute_pool(self, nprocs, args):
+        """
+        Compute the features for all the patients, with one process
+        per patient and at most `nprocs` processes at the same time.
+        Each process runs dolfin in serial. The processes are forked,
+        so this is only done when running in serial, otherwise the
+        patients are computed one after the other.
+        """
 
-                d = {}
+        import multiprocessing
 
-                d["measured_volume"] = patient.volume
-                d["pressure"] = patient.pressure
+        global _compute_problem
 
-                load.load_measured_strain(d, patient, "measured_strain")
+        if dolfin.MPI.size(dolfin.mpi_comm_world()) > 1:
+            logger.warning(
+                "Parallel postprocessing of patients is only "
+                "supported when running in serial"
+            )
+            return self._compute_serial(args)
+        _compute_problem = (self, args)
 
-                if hasattr(patient, "rv_volume"):
-                    d["measured_volume_rv"] = patient.rv_volume  # \
-                    # + patient["data"]["rv_volume_offset"]
-                    d["rv_pressure"] = patient.rv_pressure  # \
-                    # + patient["data"]["rv_pressure_offset"]
+        logger.info("Postprocess {} patients on {} processes".format(
+            len(self._keys), nprocs))
 
-                d["measured_work"] = compute_echo_work(patient, params)
-                data[patient_name].update(**d)
+        # Do not share the open result file with the workers
+        if isinstance(self._data, load.LazyH5Dict):
+            self._data.close()
 
-            if "volume" in args:
+        try:
+            ctx = multiprocessing.get_context("fork")
+        except AttributeError:
+            # Python 2 always forks
+            ctx = multiprocessing
 
-                if self._data_exist(patient_name, "volume") and not self._recompute:
-                    self._load_tmp_results(patient_name, "volume", data[patient_name])
+        pool = ctx.Pool(nprocs, maxtasksperchild=1)
+        try:
+            results = pool.map(_compute_worker, self._keys, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+            _compute_problem = None
 
-                else:
-                    logger.info("Compute volume")
+        # The parameters are updated for each patient. Keep the
+        # ones from the last patient as when computing in serial
+        self._params = results[-1][2]
 
-                    d = {}
+        return [r[:2] for r in results]
 
-                    # LV
-                    d["measured_volume"] = patient.volume
-                    d["simulated_volume"] = utils.get_volumes(
-                        val["displacements"],
-                        patient,
-                        "lv",
-                        self._params["volume_approx"],
-                    )
-                    d["pressure"] = patient.pressure
+    def _compute_patient(self, patient_name, *args):
+        """
+        Compute the features for one patient.
+        See :meth:`PostProcess.compute`
 
-                    # RV
-                    if hasattr(patient, "rv_volume"):
-                        d["measured_volume_rv"] = patient.rv_volume
+        :returns: The computed data, the passive filling duration
+                  and the mechanical features
+        :rtype: tuple
 
-                        d["simulated_volume_rv"] = utils.get_volumes(
-                            val["displacements"],
-                            patient,
-                            "rv",
-                            self._params["volume_approx"],
-                        )
+        """
 
-                        d["rv_pressure"] = patient.rv_pressure
+        val = self.get_data(patient_name)
 
-                    self._save_tmp_results(patient_name, "volume", d)
-                    data[patient_name].update(**d)
+        data = {patient_name: {}}
+        features_out = {}
 
-            if "strain" in args:
-                if self._data_exist(patient_name, "strain") and not self._recompute:
-                    self._load_tmp_results(patient_name, "strain", data[patient_name])
+        params, patient = self._setup_compute(patient_name)
 
-                else:
+        def compute_echo_work(patient, params):
+            strain = {}
+            load.load_measured_strain(strain, patient, "measured_strain")
+            try:
+                # Not all the patients have meausred work
+                measured_work = {
+                    k: np.transpose(v)[2].tolist() for k, v in patient.work.items()
+                }
+            except:
+                # Compute work as how it would be measured from the strains
+                measured_work = {}
+                pressure = (
+                    patient.pressure[1:] if params["unload"] else patient.pressure
+                )
+                for r, s in strain["measured_strain"]["longitudinal"].items():
 
-                    logger.info("Compute strain")
-                    d = {}
-                    d["simulated_strain"] = utils.get_regional_strains(
-                        val["displacements"], patient, **params
+                    measured_work[r] = utils.compute_cardiac_work_echo(
+                        pressure, s, flip=True
                     )
 
-                    load.load_measured_strain(d, patient, "measured_strain")
+            return measured_work
 
-                    self._save_tmp_results(patient_name, "strain", d)
-                    data[patient_name].update(**d)
+        if "measurements" in args:
 
-            if "time_varying_elastance" in args:
+            d = {}
 
-                if (
-                    self._data_exist(patient_name, "time_varying_elastance")
-                    and not self._recompute
-                ):
-                    self._load_tmp_results(
-                        patient_name, "time_varying_elastance", data[patient_name]
-                    )
+            d["measured_volume"] = patient.volume
+            d["pressure"] = patient.pressure
 
-                else:
-                    logger.info("Compute time_varying_elastance")
-                    d = utils.compute_time_varying_elastance(patient, params, val)
-                    self._save_tmp_results(patient_name, "time_varying_elastance", d)
-                    data[patient_name].update(**d)
+            load.load_measured_strain(d, patient, "measured_strain")
 
-            if "emax" in args:
+            if hasattr(patient, "rv_volume"):
+                d["measured_volume_rv"] = patient.rv_volume  # \
+                # + patient["data"]["rv_volume_offset"]
+                d["rv_pressure"] = patient.rv_pressure  # \
+                # + patient["data"]["rv_pressure_offset"]
 
-                if self._data_exist(patient_name, "emax") and not self._recompute:
-                    self._load_tmp_results(patient_name, "emax", data[patient_name])
+            d["measured_work"] = compute_echo_work(patient, params)
+            data[patient_name].update(**d)
 
-                else:
-                    logger.info("Compute emax")
+        if "volume" in args:
 
-                    d = {
-                        "emax": utils.compute_emax(
-                            patient, params, val, self._valve_times[patient_name]
-                        )
-                    }
+            if self._data_exist(patient_name, "volume") and not self._recompute:
+                self._load_tmp_results(patient_name, "volume", data[patient_name])
 
-                    self._save_tmp_results(patient_name, "emax", d)
-                    data[patient_name].update(**d)
+            else:
+                logger.info("Compute volume")
 
-            if "end_systolic_elastance" in args:
+                d = {}
 
-                if (
-                    self._data_exist(patient_name, "end_systolic_elastance")
-                    and not self._recompute
-                ):
-                    self._load_tmp_results(
-                        patient_name, "end_systolic_elastance", data[patient_name]
+                # LV
+                d["measured_volume"] = patient.volume
+                d["simulated_volume"] = utils.get_volumes(
+                    val["displacements"],
+                    patient,
+                    "lv",
+                    self._params["volume_approx"],
+                )
+                d["pressure"] = patient.pressure
+
+                # RV
+                if hasattr(patient, "rv_volume"):
+                    d["measured_volume_rv"] = patient.rv_volume
+
+                    d["simulated_volume_rv"] = utils.get_volumes(
+                        val["displacements"],
+                        patient,
+                        "rv",
+                        self._params["volume_approx"],
                     )
 
-                else:
-                    logger.info("Compute end_systolic_elastance")
+                    d["rv_pressure"] = patient.rv_pressure
 
-                    es = self._es[patient_name]
+                self._save_tmp_results(patient_name, "volume", d)
+                data[patient_name].update(**d)
 
-                    state = val["states"][str(es)]
-                    gamma = val["gammas"][str(es)]
+        if "strain" in args:
+            if self._data_exist(patient_name, "strain") and not self._recompute:
+                self._load_tmp_results(patient_name, "strain", data[patient_name])
 
-                    matparams = val["material_parameters"]
+            else:
 
-                    if params["matparams_space"] == "regional":
-                        sfun = merge_control(patient, params["merge_passive_control"])
-                        mat = RegionalParameter(sfun)
-                        mat.vector()[:] = matparams["a"]
-                    else:
-                        family, degree = params["matparams_space"].split("_")
-                        mat_space = dolfin.FunctionSpace(
-                            moving_mesh, family, int(degree)
-                        )
-                        mat = dolfin.Function(mat_space, name="material_parameter_a")
-                        mat.vector()[:] = matparams["a"]
-
-                    matparams["a"] = mat
-
-                    for k in ["a_f", "b", "b_f"]:
-                        v = dolfin.Constant(matparams[k][0])
-                        matparams[k] = v
-
-                    d = {}
-                    if patient.is_biv():
-                        pressure = (patient.pressure[es], patient.rv_pressure[es])
-
-                        d["end_systolic_elastance_rv"] = utils.compute_elastance(
-                            state,
-                            pressure,
-                            gamma,
-                            patient,
-                            params,
-                            matparams,
-                            chamber="rv",
-                        )
+                logger.info("Compute strain")
+                d = {}
+                d["simulated_strain"] = utils.get_regional_strains(
+                    val["displacements"], patient, **params
+                )
 
-                    else:
-                        pressure = patient.pressure[es]
+                load.load_measured_strain(d, patient, "measured_strain")
+
+                self._save_tmp_results(patient_name, "strain", d)
+                data[patient_name].update(**d)
+
+        if "time_varying_elastance" in args:
+
+            if (
+                self._data_exist(patient_name, "time_varying_elastance")
+                and not self._recompute
+            ):
+                self._load_tmp_results(
+                    patient_name, "time_varying_elastance", data[patient_name]
+                )
 
-                    d["end_systolic_elastance"] = utils.compute_elastance(
-                        state, pressure, gamma, patient, params, matparams, chamber="lv"
+            else:
+                logger.info("Compute time_varying_elastance")
+                d = utils.compute_time_varying_elastance(patient, params, val)
+                self._save_tmp_results(patient_name, "time_varying_elastance", d)
+                data[patient_name].update(**d)
+
+        if "emax" in args:
+
+            if self._data_exist(patient_name, "emax") and not self._recompute:
+                self._load_tmp_results(patient_name, "emax", data[patient_name])
+
+            else:
+                logger.info("Compute emax")
+
+                d = {
+                    "emax": utils.compute_emax(
+                        patient, params, val, self._valve_times[patient_name]
                     )
+                }
 
-                    self._save_tmp_results(patient_name, "end_systolic_elastance", d)
-                    data[patient_name].update(**d)
+                self._save_tmp_results(patient_name, "emax", d)
+                data[patient_name].update(**d)
 
-            if "gamma_mean" or "gamma_regional" in args:
+        if "end_systolic_elastance" in args:
 
-                dX = dolfin.Measure(
-                    "dx", subdomain_data=patient.sfun, domain=patient.mesh
+            if (
+                self._data_exist(patient_name, "end_systolic_elastance")
+                and not self._recompute
+            ):
+                self._load_tmp_results(
+                    patient_name, "end_systolic_elastance", data[patient_name]
                 )
-                regions = [int(r) for r in set(patient.sfun.array())]
 
-                gs = val["gammas"]
-                gamma_lst = [gs[k] for k in sorted(gs, key=utils.asint)]
+            else:
+                logger.info("Compute end_systolic_elastance")
 
-                if params["gamma_space"] == "regional":
-                    sfun = merge_control(patient, params["merge_active_control"])
-                    gamma = RegionalParameter(sfun)
-                else:
-                    gamma_space = dolfin.FunctionSpace(patient.mesh, "CG", 1)
-                    gamma = dolfin.Function(gamma_space, name="Contraction Parameter")
-
-                if "gamma_mean" in args:
-                    if (
-                        self._data_exist(patient_name, "gamma_mean")
-                        and not self._recompute
-                    ):
-                        self._load_tmp_results(
-                            patient_name, "gamma_mean", data[patient_name]
-                        )
+                es = self._es[patient_name]
 
-                    else:
-                        logger.info("Compute mean gamma")
-                        d = {
-                            "gamma_mean": utils.get_global(
-                                dX, gamma, gamma_lst, regions, params["T_ref"]
-                            )
-                        }
-                        self._save_tmp_results(patient_name, "gamma_mean", d)
-                        data[patient_name].update(**d)
-
-                if "gamma_regional" in args:
-                    if (
-                        self._data_exist(patient_name, "gamma_regional")
-                        and not self._recompute
-                    ):
-                        self._load_tmp_results(
-                            patient_name, "gamma_regional", data[patient_name]
-                        )
+                state = val["states"][str(es)]
+                gamma = val["gammas"][str(es)]
 
-                    else:
-                        logger.info("Compute regional gamma")
-                        d = {
-                            "gamma_regional": utils.get_regional(
-                                dX, gamma, gamma_lst, regions, params["T_ref"]
-                            )
-                        }
-                        self._save_tmp_results(patient_name, "gamma_regional", d)
-                        data[patient_name].update(**d)
-
-            if "geometric_distance" in args:
-
-                if self._data_exist(patient_name, "geometric_distance"):
-                    self._load_tmp_results(
-                        patient_name, "geometric_distance", data[patient_name]
-                    )
+                matparams = val["material_parameters"]
+
+                if params["matparams_space"] == "regional":
+                    sfun = merge_control(patient, params["merge_passive_control"])
+                    mat = RegionalParameter(sfun)
+                    mat.vector()[:] = matparams["a"]
                 else:
-                    logger.info("Compute geometric distance")
-                    vtk_output = "/".join(
-                        [self._outdir, "surface_files2", patient_name]
+                    family, degree = params["matparams_space"].split("_")
+                    mat_space = dolfin.FunctionSpace(
+                        moving_mesh, family, int(degree)
                     )
-                    d = utils.compute_geometric_distance(
-                        patient, val["displacements"], vtk_output
+                    mat = dolfin.Function(mat_space, name="material_parameter_a")
+                    mat.vector()[:] = matparams["a"]
+
+                matparams["a"] = mat
+
+                for k in ["a_f", "b", "b_f"]:
+                    v = dolfin.Constant(matparams[k][0])
+                    matparams[k] = v
+
+                d = {}
+                if patient.is_biv():
+                    pressure = (patient.pressure[es], patient.rv_pressure[es])
+
+                    d["end_systolic_elastance_rv"] = utils.compute_elastance(
+                        state,
+                        pressure,
+                        gamma,
+                        patient,
+                        params,
+                        matparams,
+                        chamber="rv",
                     )
-                    self._save_tmp_results(patient_name, "geometric_distance", d)
-                    data[patient_name].update(**d)
 
-            if "data_mismatch" in args:
+                else:
+                    pressure = patient.pressure[es]
+
+                d["end_systolic_elastance"] = utils.compute_elastance(
+                    state, pressure, gamma, patient, params, matparams, chamber="lv"
+                )
+
+                self._save_tmp_results(patient_name, "end_systolic_elastance", d)
+                data[patient_name].update(**d)
+
+        if "gamma_mean" or "gamma_regional" in args:
 
-                if self._data_exist(patient_name, "data_mismatch"):
+            dX = dolfin.Measure(
+                "dx", subdomain_data=patient.sfun, domain=patient.mesh
+            )
+            regions = [int(r) for r in set(patient.sfun.array())]
+
+            gs = val["gammas"]
+            gamma_lst = [gs[k] for k in sorted(gs, key=utils.asint)]
+
+            if params["gamma_space"] == "regional":
+                sfun = merge_control(patient, params["merge_active_control"])
+                gamma = RegionalParameter(sfun)
+            else:
+                gamma_space = dolfin.FunctionSpace(patient.mesh, "CG", 1)
+                gamma = dolfin.Function(gamma_space, name="Contraction Parameter")
+
+            if "gamma_mean" in args:
+                if (
+                    self._data_exist(patient_name, "gamma_mean")
+                    and not self._recompute
+                ):
                     self._load_tmp_results(
-                        patient_name, "data_mismatch", data[patient_name]
+                        patient_name, "gamma_mean", data[patient_name]
                     )
+
                 else:
-                    logger.info("Compute data mismatch")
-                    d = utils.copmute_data_mismatch(
-                        val["displacements"],
-                        patient["geometry"],
-                        patient["data"]["volume"],
-                        patient["data"]["strain"],
+                    logger.info("Compute mean gamma")
+                    d = {
+                        "gamma_mean": utils.get_global(
+                            dX, gamma, gamma_lst, regions, params["T_ref"]
+                        )
+                    }
+                    self._save_tmp_results(patient_name, "gamma_mean", d)
+                    data[patient_name].update(**d)
+
+            if "gamma_regional" in args:
+                if (
+                    self._data_exist(patient_name, "gamma_regional")
+                    and not self._recompute
+                ):
+                    self._load_tmp_results(
+                        patient_name, "gamma_regional", data[patient_name]
                     )
 
-                    self._save_tmp_results(patient_name, "data_mismatch", d)
+                else:
+                    logger.info("Compute regional gamma")
+                    d = {
+                        "gamma_regional": utils.get_regional(
+                            dX, gamma, gamma_lst, regions, params["T_ref"]
+                        )
+                    }
+                    self._save_tmp_results(patient_name, "gamma_regional", d)
                     data[patient_name].update(**d)
 
-            if "vtk_simulation" in args or "mechanical_features" in args:
+        if "geometric_distance" in args:
 
-                output = "/".join(
-                    [os.path.dirname(self._geoname), "features", patient_name + ".h5"]
+            if self._data_exist(patient_name, "geometric_distance"):
+                self._load_tmp_results(
+                    patient_name, "geometric_distance", data[patient_name]
                 )
+            else:
+                logger.info("Compute geometric distance")
+                vtk_output = "/".join(
+                    [self._outdir, "surface_files2", patient_name]
+                )
+                d = utils.compute_geometric_distance(
+                    patient, val["displacements"], vtk_output
+                )
+                self._save_tmp_results(patient_name, "geometric_distance", d)
+                data[patient_name].update(**d)
 
-                if not os.path.isfile(output) or self._recompute:
-                    logger.info("Compute meachanical features")
-                    d = {
-                        "features_scalar": utils.copmute_mechanical_features(
-                            patient, params, val, output, keys=self._feature_keys
-                        )
-                    }
-                    self._save_tmp_results(patient_name, "features_scalar", d)
+        if "data_mismatch" in args:
 
+            if self._data_exist(patient_name, "data_mismatch"):
                 self._load_tmp_results(
-                    patient_name, "features_scalar", data[patient_name]
+                    patient_name, "data_mismatch", data[patient_name]
+                )
+            else:
+                logger.info("Compute data mismatch")
+                d = utils.copmute_data_mismatch(
+                    val["displacements"],
+                    patient["geometry"],
+                    patient["data"]["volume"],
+                    patient["data"]["strain"],
                 )
-                features = {patient_name: load.load_dict_from_h5(output)}
 
-                self._update_features(features)
+                self._save_tmp_results(patient_name, "data_mismatch", d)
+                data[patient_name].update(**d)
 
-            if "mechanical_features_scalar" in args:
+        if any(
+            [
+                a in args
+                for a in [
+                    "vtk_simulation",
+                    "mechanical_features",
+                    "mechanical_features_scalar",
+                ]
+            ]
+        ):
 
-                if not os.path.isfile(output) or self._recompute:
-                    logger.info("Compute meachanical features")
-                    d = {
-                        "features_scalar": utils.copmute_mechanical_features(
-                            patient, params, val, output, keys=self._feature_keys
-                        )
-                    }
-                    self._save_tmp_results(patient_name, "features_scalar", d)
+            output = "/".join(
+                [os.path.dirname(self._geoname), "features", patient_name + ".h5"]
+            )
 
+            if (
+                self._data_exist(patient_name, "features_scalar")
+                and os.path.isfile(output)
+                and not self._recompute
+            ):
                 self._load_tmp_results(
                     patient_name, "features_scalar", data[patient_name]
                 )
 
-            if any([a.startswith("cardiac_work") for a in args]):
+            else:
+                logger.info("Compute meachanical features")
+                d = {
+                    "features_scalar": utils.copmute_mechanical_features(
+                        patient, params, val, output, keys=self._feature_keys
+                    )
+                }
+                self._save_tmp_results(patient_name, "features_scalar", d)
+                data[patient_name].update(**d)
 
-                try:
-                    idx = np.where([a.startswith("cardiac_work") for a in args])[0][0]
-                    string = args[idx]
-                    _, case, wp = string.split(":")
+            if "vtk_simulation" in args or "mechanical_features" in args:
+                features = {patient_name: load.load_dict_from_h5(output)}
+                features_out.update(**features)
 
-                except:
-                    string = "cardiac_work:comp_long:SE"
-                    _, case, wp = string.split(":")
+        if any([a.startswith("cardiac_work") for a in args]):
 
-                assert (
-                    wp in work_pairs
-                ), "Illegal work pair: {}. Legal inputs:{}".format(wp, work_pairs)
-                assert case in cases, "Illegal case: {}. Legal inputs:{}".format(
-                    case, cases
-                )
+            try:
+                idx = np.where([a.startswith("cardiac_work") for a in args])[0][0]
+                string = args[idx]
+                _, case, wp = string.split(":")
+
+            except:
+                string = "cardiac_work:comp_long:SE"
+                _, case, wp = string.split(":")
+
+            assert (
+                wp in work_pairs
+            ), "Illegal work pair: {}. Legal inputs:{}".format(wp, work_pairs)
+            assert case in cases, "Illegal case: {}. Legal inputs:{}".format(
+                case, cases
+            )
 
-                if self._data_exist(patient_name, string) and not self._recompute:
-                    self._load_tmp_results(patient_name, string, data[patient_name])
+            if self._data_exist(patient_name, string) and not self._recompute:
+                self._load_tmp_results(patient_name, string, data[patient_name])
 
-                else:
+            else:
 
-                    if 0:  # string == 'cardiac_work:comp_long:pgradu':
+                if 0:  # string == 'cardiac_work:comp_long:pgradu':
 
-                        strain = utils.get_regional_strains(
-                            val["displacements"], patient, **params
-                        )
-                        work = {}
-                        pressure = (
-                            patient.pressure[1:]
-                            if params["unload"]
-                            else patient.pressure
-                        )
-                        for r, s_ in strain["longitudinal"].items():
+                    strain = utils.get_regional_strains(
+                        val["displacements"], patient, **params
+                    )
+                    work = {}
+                    pressure = (
+                        patient.pressure[1:]
+                        if params["unload"]
+                        else patient.pressure
+                    )
+                    for r, s_ in strain["longitudinal"].items():
 
-                            s = s_[1:] if params["unload"] else s_
-                            work[r] = utils.compute_cardiac_work_echo(
-                                pressure, s, flip=True
-                            )
+                        s = s_[1:] if params["unload"] else s_
+                        work[r] = utils.compute_cardiac_work_echo(
+                            pressure, s, flip=True
+                        )
 
-                        data[patient_name]["work_pgradu_comp_long"] = work
-                    else:
+                    data[patient_name]["work_pgradu_comp_long"] = work
+                else:
 
-                        logger.info("Compute cardiac work")
-                        d = utils.compute_cardiac_work(patient, params, val, case, wp)
+                    logger.info("Compute cardiac work")
+                    d = utils.compute_cardiac_work(patient, params, val, case, wp)
 
-                        self._save_tmp_results(patient_name, string, d)
-                        data[patient_name].update(**d)
+                    self._save_tmp_results(patient_name, string, d)
+                    data[patient_name].update(**d)
 
-                data[patient_name]["measured_work"] = compute_echo_work(patient, params)
-                # data[patient_name]["measured_work"] \
-                # ={k:np.transpose(v)[2].tolist() for k, v in patient.work.iteritems()}
+            data[patient_name]["measured_work"] = compute_echo_work(patient, params)
+            # data[patient_name]["measured_work"] \
+            # ={k:np.transpose(v)[2].tolist() for k, v in patient.work.iteritems()}
 
-        self._update_results(data)
+        return data[patient_name], patient.passive_filling_duration, features_out
 
     def get_solver(self, patient_name, idx=0):
 
@@ -1851,3 +1979,31 @@ class PostProcess(object):
 
     def set_feature_keys(self, *args):
         self._feature_keys = args
+
+
+# The postprocessor and arguments used by the workers in PostProcess.compute
+_compute_problem = None
+
+
+def _picklable_params(params):
+    """
+    Copy of the parameters that can be sent between processes,
+    where the dolfin functions are replaced by their values
+    """
+    if hasattr(params, "to_dict"):
+        params = params.to_dict()
+
+    if isinstance(params, dict):
+        return {k: _picklable_params(v) for k, v in params.items()}
+
+    if isinstance(params, dolfin.Function):
+        return params.vector().get_local()
+
+    return params
+
+
+def _compute_worker(patient_name):
+
+    postprocess, args = _compute_problem
+    result = postprocess._compute_patient(patient_name, *args)
+    return patient_name, result, _picklable_params(postprocess._params)
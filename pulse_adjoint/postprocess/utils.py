@@ -30,6 +30,7 @@ to compute the different features that we want to visualise.
 # WARRANTIES OF ANY KIND, EITHER IMPLIED OR EXPRESSED, INCLUDING, BUT
 # NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY OR FITNESS
 from .args import *
+from pulse import numpy_mpi
 
 
 def default_mechanical_features():
@@ -168,6 +169,162 @@ def compute_apical_registration(mesh, patient, endo_surf_apex):
     return u
 
 
+class RegionAveragingOperator(object):
+    """
+    Compute averages over the regions of a mesh.
+
+    For a function space, the operator is a sparse matrix that maps
+    the dofs of a function to its mean value in each region. It is
+    built once per space, so the means of a whole time series is one
+    sparse matrix product with the (ndofs x ntimes) array of vectors.
+    Expressions that do not live in a space are integrated against the
+    piecewise constant test functions, and the cell integrals are
+    summed over each region.
+
+    Use :func:`get_averaging_operator` to get a cached operator.
+
+    :param dx: Volume measure marked according to the regions
+    :param list regions: The regions
+
+    """
+
+    def __init__(self, dx, regions):
+
+        self.dx = dx
+        self.regions = list(regions)
+        self.sfun = dx.subdomain_data()
+        self.mesh = dx.ufl_domain().ufl_cargo()
+        self.comm = self.mesh.mpi_comm()
+
+        self._matrices = {}
+
+        # Map from the dofs in the DG0 space to the regions
+        V0 = dolfin.FunctionSpace(self.mesh, "DG", 0)
+        self._q = dolfin.TestFunction(V0)
+        dofmap = V0.dofmap()
+        start, end = dofmap.ownership_range()
+        n = end - start
+        sfun_arr = self.sfun.array()
+        region_index = {r: i for i, r in enumerate(self.regions)}
+        self._cell_region = np.zeros(n, dtype=int)
+        for cell in dolfin.cells(self.mesh):
+            dof = dofmap.cell_dofs(cell.index())[0]
+            if dof < n:
+                self._cell_region[dof] = region_index.get(
+                    int(sfun_arr[cell.index()]), len(self.regions)
+                )
+
+        self.volumes = self._region_sums(dolfin.Constant(1.0))
+        self.volume = float(np.sum(self.volumes))
+
+    def mpi_sum(self, arr):
+        """
+        Sum the array over all the processes
+        """
+
+        if dolfin.MPI.size(self.comm) == 1:
+            return arr
+        return np.reshape(
+            [dolfin.MPI.sum(self.comm, float(v)) for v in np.ravel(arr)], arr.shape
+        )
+
+    def _region_sums(self, fun):
+
+        cell_integrals = dolfin.assemble(fun * self._q * self.dx).array()
+        sums = np.bincount(
+            self._cell_region,
+            weights=cell_integrals[: len(self._cell_region)],
+            minlength=len(self.regions) + 1,
+        )[: len(self.regions)]
+
+        return self.mpi_sum(sums)
+
+    def matrix(self, V):
+        """
+        The sparse (nregions x ndofs) matrix that maps the
+        dofs of a function in V to its mean in each region
+        """
+        from scipy import sparse
+
+        key = V.id()
+        if key not in self._matrices:
+
+            v = dolfin.TestFunction(V)
+            rows, cols, vals = [], [], []
+            for i, (vol, r) in enumerate(zip(self.volumes, self.regions)):
+                row = dolfin.assemble(v * self.dx(r)).get_local()
+                # Only the dofs in the region are nonzero
+                (nz,) = np.nonzero(row)
+                rows.append(np.full(len(nz), i, dtype=int))
+                cols.append(nz)
+                vals.append(row[nz] / vol)
+
+            self._matrices[key] = sparse.csr_matrix(
+                (np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                shape=(len(self.regions), len(row)),
+            )
+
+        return self._matrices[key]
+
+    def regional(self, V, arrs):
+        """
+        Mean value in each region of the functions in V with the given
+        vectors. `arrs` is a single vector or a list of vectors, and the
+        result is a (nregions) or (nregions x ntimes) array.
+        """
+
+        X = np.asarray(arrs, dtype=float)
+        return self.mpi_sum(self.matrix(V).dot(X.T))
+
+    def average(self, V, arrs):
+        """
+        Mean value over all the regions of the functions in V with
+        the given vectors
+        """
+
+        return self.volumes.dot(self.regional(V, arrs)) / self.volume
+
+    def quad(self, fun):
+        """
+        Mean value in each region, and over all the
+        regions, of an expression
+        """
+
+        sums = self._region_sums(fun)
+        return sums / self.volumes, np.sum(sums) / self.volume
+
+
+_averaging_operators = []
+
+
+def get_averaging_operator(dx, regions):
+    """
+    Get the region averaging operator for the given measure and
+    regions. The operator is built once per mesh, cell function
+    and regions. The key includes a hash of the mesh coordinates
+    and of the markers, so a new operator is built if the mesh
+    is moved (e.g with dolfin.ALE.move) or the markers change.
+    """
+    from ..optimization_targets import mesh_function_key
+
+    sfun = dx.subdomain_data()
+    mesh = dx.ufl_domain().ufl_cargo()
+    regions = list(regions)
+    key = (mesh.id(), mesh.hash(), mesh_function_key(sfun), regions)
+
+    for op_key, op in _averaging_operators:
+        if op_key == key:
+            return op
+
+    op = RegionAveragingOperator(dx, regions)
+    _averaging_operators.append((key, op))
+    # Do not keep too many meshes alive
+    if len(_averaging_operators) > 4:
+        _averaging_operators.pop(0)
+
+    return op
+
+
 def get_regional(dx, fun, fun_lst, regions=list(range(1, 18)), T_ref=1.0):
     """Return the average value of the function 
     in each segment
@@ -185,40 +342,25 @@ def get_regional(dx, fun, fun_lst, regions=list(range(1, 18)), T_ref=1.0):
         else:
             return np.multiply(T_ref, fun_lst)
 
-    meshvols = get_meshvols(dx, regions)
-    lst = []
-    for f in fun_lst:
-        fun.vector()[:] = f
-        lst_i = []
-        for t, i in enumerate(regions):
-            lst_i.append(T_ref * dolfin.assemble((fun / meshvols[t]) * dx(i)))
-
-        lst.append(lst_i)
+    op = get_averaging_operator(dx, regions)
+    lst = T_ref * op.regional(fun.function_space(), fun_lst)
 
     if len(fun_lst) == 1:
-        return np.array(lst[0])
+        return lst[:, 0]
 
-    return np.array(lst).T
+    return lst
 
 
 def get_meshvols(dx, regions):
 
-    meshvols = []
-    for i in regions:
-        meshvols.append(dolfin.Constant(dolfin.assemble(dolfin.Constant(1.0) * dx(i))))
-    return meshvols
+    op = get_averaging_operator(dx, regions)
+    return [dolfin.Constant(v) for v in op.volumes]
 
 
 def get_regional_quad(dx, fun, regions):
 
-    meshvols = get_meshvols(dx, regions)
-
-    lst = []
-    for i, r in enumerate(regions):
-
-        lst.append(dolfin.assemble((fun / meshvols[i]) * dx(r)))
-
-    return np.array(lst).T
+    op = get_averaging_operator(dx, regions)
+    return op.quad(fun)[0]
 
 
 def get_global_quad(dx, fun):
@@ -240,29 +382,14 @@ def get_global(dx, fun, fun_lst, regions=list(range(1, 18)), T_ref=1.0):
 
     """
 
-    meshvols = []
-
-    for i in regions:
-        meshvols.append(dolfin.assemble(dolfin.Constant(1.0) * dx(i)))
+    op = get_averaging_operator(dx, regions)
 
-    meshvol = np.sum(meshvols)
-
-    fun_mean = []
-    for f in fun_lst:
-
-        fun.vector()[:] = f
-
-        if fun.value_size() > 1:
-            fun_tot = np.sum(np.multiply(fun.vector().array(), meshvols))
-
-        else:
-            fun_tot = 0
-            for i in regions:
-                fun_tot += dolfin.assemble((fun) * dx(i))
-
-        fun_mean.append(T_ref * fun_tot / meshvol)
+    if fun.value_size() > 1:
+        fun_tot = np.dot(np.asarray(fun_lst, dtype=float), op.volumes)
+    else:
+        fun_tot = op.volume * op.average(fun.function_space(), fun_lst)
 
-    return fun_mean
+    return list(T_ref * fun_tot / op.volume)
 
 
 def update_nested_dict(d, u):
@@ -330,7 +457,151 @@ def compute_inner_cavity_volume(mesh, ffun, marker, u=None, approx="project"):
     return target.simulated_fun.vector().array()[0]
 
 
-def get_volumes(disps, patient, chamber="lv", approx="project"):
+class ApproxDisplacement(object):
+    """
+    Approximate displacements in the CG2 space as in the optimization
+    targets, without annotation. With `approx="project"` the projection
+    onto the linear space is a matrix-vector product and a solve with a
+    mass matrix that is factorized once.
+
+    :param mesh: The mesh
+    :param str approx: How to approximate the displacement,
+                       'project', 'interpolate' or 'original'
+
+    """
+
+    def __init__(self, mesh, approx="project"):
+
+        assert approx in ["project", "interpolate", "original"]
+        self.approx = approx
+
+        self.V = dolfin.VectorFunctionSpace(mesh, "CG", 2)
+        self.u = dolfin.Function(self.V)
+
+        if approx == "original":
+            self.u_int = self.u
+            return
+
+        V1 = dolfin.VectorFunctionSpace(mesh, "CG", 1)
+        self.u_int = dolfin.Function(V1)
+
+        if approx == "project":
+            v = dolfin.TestFunction(V1)
+            self._B = dolfin.assemble(
+                dolfin.inner(dolfin.TrialFunction(self.V), v) * dolfin.dx(mesh)
+            )
+            M = dolfin.assemble(
+                dolfin.inner(dolfin.TrialFunction(V1), v) * dolfin.dx(mesh)
+            )
+            self._solver = dolfin.LUSolver(M)
+            try:
+                self._solver.parameters["reuse_factorization"] = True
+            except (KeyError, RuntimeError):
+                # Newer versions of dolfin reuse the factorization by default
+                pass
+            self._b = dolfin.Vector()
+            self._B.init_vector(self._b, 0)
+
+    def assign(self, u_arr):
+        """
+        Assign the displacement, and update the approximation `u_int`
+        """
+
+        self.u.vector()[:] = u_arr
+
+        if self.approx == "project":
+            self._B.mult(self.u.vector(), self._b)
+            self._solver.solve(self.u_int.vector(), self._b)
+        elif self.approx == "interpolate":
+            self.u_int.interpolate(self.u)
+
+        return self.u_int
+
+
+class CavityVolumeEvaluator(object):
+    """
+    Compute the cavity volume for many displacements.
+
+    The volume is computed in the same way as in
+    :func:`compute_inner_cavity_volume`, but the volume form
+    is compiled once, and the displacement is approximated
+    with :class:`ApproxDisplacement`.
+
+    :param mesh: The mesh
+    :param ffun: Facet function
+    :param int marker: The marker of the endocardium
+    :param str approx: How to approximate the displacement,
+                       'project', 'interpolate' or 'original'
+
+    """
+
+    def __init__(self, mesh, ffun, marker, approx="project"):
+
+        self.disp = ApproxDisplacement(mesh, approx)
+        u_int = self.disp.u_int
+
+        X = dolfin.SpatialCoordinate(mesh)
+        N = dolfin.FacetNormal(mesh)
+        F = dolfin.grad(u_int) + dolfin.Identity(3)
+        J = dolfin.det(F)
+        vol = (-1.0 / 3.0) * dolfin.dot(X + u_int, J * dolfin.inv(F).T * N)
+
+        dS = dolfin.Measure("exterior_facet", subdomain_data=ffun, domain=mesh)(marker)
+        self._form = dolfin.Form(vol * dS)
+
+    def __call__(self, u_arr):
+        """
+        Return the volume for the displacement with the given vector
+        """
+
+        self.disp.assign(u_arr)
+        return dolfin.assemble(self._form)
+
+    def volumes(self, disps, nprocs=1):
+        """
+        Return the volumes for a list of displacement vectors.
+        With nprocs > 1 the time points are split into chunks
+        that are computed in parallel (only in serial).
+        """
+
+        disps = list(disps)
+        nprocs = min(nprocs, len(disps))
+
+        if nprocs > 1 and dolfin.MPI.size(dolfin.mpi_comm_world()) == 1:
+            import multiprocessing
+
+            global _volume_evaluator
+            _volume_evaluator = self
+
+            chunks = np.array_split(np.arange(len(disps)), nprocs)
+            pool = multiprocessing.Pool(nprocs)
+            try:
+                vols = pool.map(
+                    _volume_worker, [[disps[i] for i in chunk] for chunk in chunks]
+                )
+            finally:
+                pool.close()
+                pool.join()
+                _volume_evaluator = None
+
+            return [v for chunk in vols for v in chunk]
+
+        return [self(u_arr) for u_arr in disps]
+
+
+# The evaluator used by the workers in CavityVolumeEvaluator.volumes
+_volume_evaluator = None
+
+
+def _volume_worker(disps):
+    return [_volume_evaluator(u_arr) for u_arr in disps]
+
+
+def get_volume_evaluator(patient, chamber="lv", approx="project"):
+    """
+    Get a :class:`CavityVolumeEvaluator` for the given chamber
+    ('lv' or 'rv'). Return None if the patient has no such chamber.
+    """
 
     if chamber == "lv":
 
@@ -346,32 +617,152 @@ def get_volumes(disps, patient, chamber="lv", approx="project"):
         assert chamber == "rv"
 
         if "ENDO_RV" not in patient.markers:
-            return []
+            return None
 
         marker = patient.markers["ENDO_RV"][0]
 
-    V = dolfin.VectorFunctionSpace(patient.mesh, "CG", 2)
-    u = dolfin.Function(V)
+    return CavityVolumeEvaluator(patient.mesh, patient.ffun, marker, approx)
 
-    ffun = patient.ffun
 
-    volumes = []
+def get_volumes(disps, patient, chamber="lv", approx="project", nprocs=1):
+
+    evaluator = get_volume_evaluator(patient, chamber, approx)
+    if evaluator is None:
+        return []
+
     if isinstance(disps, dict):
         times = sorted(list(disps.keys()), key=asint)
     else:
         times = list(range(len(disps)))
-    for t in times:
-        us = disps[t]
-        u.vector()[:] = us
 
-        volumes.append(
-            compute_inner_cavity_volume(patient.mesh, ffun, marker, u, approx)
-        )
+    return evaluator.volumes([disps[t] for t in times], nprocs)
+
+
+class RegionalStrainEvaluator(object):
+    """
+    Compute the regional strains for many displacements, without
+    annotation.
+
+    The strains are the same as in
+    :class:`pulse_adjoint.optimization_targets.RegionalStrainTarget`,
+    i.e the mean value of the strain components in each region.
+    The strain form is compiled once, for all the basis functions,
+    against the piecewise constant test functions. The regional means
+    are then the sums of the cell integrals over each region divided
+    by the region volumes (the regional mass matrices are just the
+    region volumes). The assembled vector is reused between the
+    time points.
 
-    return volumes
+    :param mesh: The mesh
+    :param dx: Volume measure marked according to the regions
+    :param list crl_basis: The basis functions
+    :param list regions: The regions
+    :param F_ref: Tensor to map strains to reference
+    :param str approx: How to approximate the displacement
+    :param str tensor: Strain tensor, 'gradu' or 'E'
+    :param bool map_strain: Map the basis functions to the reference
 
+    """
 
-def get_regional_strains(
+    def __init__(
+        self,
+        mesh,
+        dx,
+        crl_basis,
+        regions,
+        F_ref=None,
+        approx="original",
+        tensor="gradu",
+        map_strain=False,
+    ):
+
+        assert tensor in ["gradu", "E"]
+        dim = mesh.geometry().dim()
+        I = dolfin.Identity(dim)
+        F_ref = F_ref if F_ref is not None else I
+
+        if map_strain:
+            from ..unloading.utils import normalize_vector_field
+
+            crl_basis = [normalize_vector_field(dolfin.project(F_ref * e)) for e in crl_basis]
+
+        self.nbasis = len(crl_basis)
+        assert self.nbasis > 0, "Number of basis functions must be greater than zero"
+
+        self.regions = list(regions)
+        self.operator = get_averaging_operator(dx, self.regions)
+
+        self.disp = ApproxDisplacement(mesh, approx)
+        u_int = self.disp.u_int
+
+        F = (dolfin.grad(u_int) + I) * dolfin.inv(F_ref)
+        J = dolfin.det(F)
+        if tensor == "gradu":
+            T = pow(J, -float(1) / dim) * F - I
+        else:
+            C = pow(J, -float(2) / dim) * F.T * F
+            T = 0.5 * (C - I)
+
+        tensor_diag = dolfin.as_vector([dolfin.inner(T * e, e) for e in crl_basis])
+
+        V0 = dolfin.VectorFunctionSpace(mesh, "DG", 0, dim=self.nbasis)
+        q = dolfin.TestFunction(V0)
+        self._form = dolfin.Form(dolfin.inner(tensor_diag, q) * dolfin.dx(mesh))
+        self._b = dolfin.assemble(self._form)
+
+        # The dofs of each component in each cell
+        sfun_arr = dx.subdomain_data().array()
+        region_index = {r: i for i, r in enumerate(self.regions)}
+        dofs, cell_region = [], []
+        start, end = V0.dofmap().ownership_range()
+        for cell in dolfin.cells(mesh):
+            cdofs = [V0.sub(k).dofmap().cell_dofs(cell.index())[0] for k in range(self.nbasis)]
+            if cdofs[0] >= end - start:
+                continue
+            dofs.append(cdofs)
+            cell_region.append(region_index.get(int(sfun_arr[cell.index()]), len(self.regions)))
+
+        self._dofs = np.array(dofs, dtype=int).T
+        self._cell_region = np.array(cell_region, dtype=int)
+
+    def __call__(self, u_arr, out=None):
+        """
+        Return the strains for the displacement with the given
+        vector, as an array of shape (nregions, nbasis)
+        """
+
+        if out is None:
+            out = np.zeros((len(self.regions), self.nbasis))
+
+        self.disp.assign(u_arr)
+        dolfin.assemble(self._form, tensor=self._b)
+        arr = self._b.array()
+
+        for k in range(self.nbasis):
+            sums = np.bincount(
+                self._cell_region,
+                weights=arr[self._dofs[k]],
+                minlength=len(self.regions) + 1,
+            )[: len(self.regions)]
+            out[:, k] = self.operator.mpi_sum(sums) / self.operator.volumes
+
+        return out
+
+    def strains(self, disps):
+        """
+        Return the strains for a list of displacement vectors,
+        as an array of shape (ntimes, nregions, nbasis)
+        """
+
+        disps = list(disps)
+        out = np.zeros((len(disps), len(self.regions), self.nbasis))
+        for i, u_arr in enumerate(disps):
+            self(u_arr, out[i])
+
+        return out
+
+
+def get_regional_strain_array(
     disps,
     patient,
     unload=False,
@@ -383,8 +774,14 @@ def get_regional_strains(
     *args,
     **kwargs
 ):
+    """
+    Compute the regional strains for all the displacements.
 
-    from pulse_adjoint.optimization_targets import RegionalStrainTarget
+    :returns: The strains as an array of shape (ntimes, nregions, nbasis),
+              the regions and the names of the basis functions
+    :rtype: tuple
+
+    """
 
     dX = dolfin.Measure("dx", subdomain_data=patient.sfun, domain=patient.mesh)
 
@@ -417,9 +814,6 @@ def get_regional_strains(
             else:
                 u0 = dolfin.interpolate(u0, V)
 
-        else:
-            u_int = dolfin.interpolate(u0, V)
-
         F_ref = dolfin.grad(u0) + dolfin.Identity(3)
 
     else:
@@ -428,53 +822,59 @@ def get_regional_strains(
     if almansi:
         strain_tensor = "almansi"
 
-    crl_basis = {}
+    crl_basis = []
     basis_keys = []
     for att in ["circumferential", "radial", "longitudinal"]:
         if hasattr(patient, att):
             basis_keys.append(att)
+            crl_basis.append(getattr(patient, att))
 
-            crl_basis[att] = getattr(patient, att)
+    # All the processes need the same regions
+    regions = [
+        int(r) for r in sorted(set(numpy_mpi.gather_broadcast(patient.sfun.array())))
+    ]
 
-    target = RegionalStrainTarget(
+    # Everything is done with plain dolfin, so nothing is annotated
+    evaluator = RegionalStrainEvaluator(
         patient.mesh,
-        crl_basis,
         dX,
+        crl_basis,
+        regions,
         F_ref=F_ref,
         approx=strain_approx,
         tensor=strain_tensor,
         map_strain=map_strain,
     )
-    target.set_target_functions()
-
-    regions = target.regions
-
-    strain_dict = {}
-
-    for d in basis_keys:
-        strain_dict[d] = {int(i): [] for i in regions}
-
-    V = dolfin.VectorFunctionSpace(patient.mesh, "CG", 2)
-    u = dolfin.Function(V)
 
     if isinstance(disps, dict):
         times = sorted(list(disps.keys()), key=asint)
     else:
         times = list(range(len(disps)))
 
-    for t in times:
-        us = disps[t]
-        u.vector()[:] = us
+    strains = evaluator.strains([disps[t] for t in times])
 
-        target.assign_simulated(u)
+    return strains, regions, basis_keys
 
-        for i, d in enumerate(basis_keys):
-            for j, r in enumerate(regions):
-                strain_dict[d][r].append(target.simulated_fun[j].vector().array()[i])
 
-    # error = np.sum([np.subtract(patient.strain[i].T[0],strain_dict["circumferential"][i][1:])**2 for i in range(3)], 0)
-    # print error
-    # exit()
+def get_regional_strains(disps, patient, *args, **kwargs):
+    """
+    Compute the regional strains for all the displacements.
+    See :func:`get_regional_strain_array`
+
+    :returns: The strains as a dictionary with the
+              basis functions, regions and times as keys
+    :rtype: dict
+
+    """
+
+    strains, regions, basis_keys = get_regional_strain_array(
+        disps, patient, *args, **kwargs
+    )
+
+    strain_dict = {}
+    for i, d in enumerate(basis_keys):
+        strain_dict[d] = {r: strains[:, j, i].tolist() for j, r in enumerate(regions)}
+
     return strain_dict
 
 
@@ -704,7 +1104,140 @@ def compute_elastance(
         return np.mean(np.divide(np.diff(ps), np.diff(vs)))
 
 
-def compute_geometric_distance(patient, us, vtk_output):
+def _closest_point_on_triangles(p, a, b, c):
+    """
+    Closest point to p on the triangles (a, b, c), all arrays
+    of shape (n, 3). See Ericson, Real-Time Collision Detection, 5.1.5
+    """
+
+    def dot(x, y):
+        return np.einsum("ij,ij->i", x, y)
+
+    ab = b - a
+    ac = c - a
+    ap = p - a
+    bp = p - b
+    cp = p - c
+
+    d1, d2 = dot(ab, ap), dot(ac, ap)
+    d3, d4 = dot(ab, bp), dot(ac, bp)
+    d5, d6 = dot(ab, cp), dot(ac, cp)
+
+    va = d3 * d6 - d5 * d4
+    vb = d5 * d2 - d1 * d6
+    vc = d1 * d4 - d3 * d2
+
+    def div(x, y):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.nan_to_num(x / y)[:, None]
+
+    # The checks are applied in reverse order of priority,
+    # so that the first region that holds wins
+
+    # Inside the face
+    denom = va + vb + vc
+    q = a + ab * div(vb, denom) + ac * div(vc, denom)
+
+    # Edge BC
+    e1, e2 = d4 - d3, d5 - d6
+    mask = (va <= 0) & (e1 >= 0) & (e2 >= 0)
+    q = np.where(mask[:, None], b + (c - b) * div(e1, e1 + e2), q)
+
+    # Vertex C
+    mask = (d6 >= 0) & (d5 <= d6)
+    q = np.where(mask[:, None], c, q)
+
+    # Edge AC
+    mask = (vb <= 0) & (d2 >= 0) & (d6 <= 0)
+    q = np.where(mask[:, None], a + ac * div(d2, d2 - d6), q)
+
+    # Edge AB
+    mask = (vc <= 0) & (d1 >= 0) & (d3 <= 0)
+    q = np.where(mask[:, None], a + ab * div(d1, d1 - d3), q)
+
+    # Vertex B
+    mask = (d3 >= 0) & (d4 <= d3)
+    q = np.where(mask[:, None], b, q)
+
+    # Vertex A
+    mask = (d1 <= 0) & (d2 <= 0)
+    q = np.where(mask[:, None], a, q)
+
+    return q
+
+
+def surface_distance(points, surf_points, triangles=None, k=8):
+    """
+    Distance from each point to a surface.
+
+    If `triangles` is None, the distance is the distance to the closest
+    vertex of the surface. Otherwise the distance is the exact
+    distance to the triangles around the `k` closest vertices.
+
+    :param points: Array of shape (n, 3) with the points
+    :param surf_points: Array of shape (m, 3) with the surface vertices
+    :param triangles: Array of shape (ncells, 3) with the surface triangles
+    :param int k: Number of closest vertices used to find the triangles
+    :returns: The distances
+    :rtype: numpy.ndarray
+
+    """
+    from scipy.spatial import cKDTree
+
+    points = np.asarray(points, dtype=float)
+    surf_points = np.asarray(surf_points, dtype=float)
+    tree = cKDTree(surf_points)
+
+    if triangles is None:
+        dist, _ = tree.query(points)
+        return dist
+
+    triangles = np.asarray(triangles, dtype=int)
+    k = min(k, len(surf_points))
+    _, idx = tree.query(points, k=k)
+    idx = np.reshape(idx, (len(points), k))
+
+    # The triangles around each vertex
+    ntri = np.bincount(triangles.ravel(), minlength=len(surf_points))
+    order = np.argsort(triangles.ravel(), kind="mergesort")
+    vertex_triangles = order // 3
+    offsets = np.concatenate([[0], np.cumsum(ntri)])
+
+    # All the candidate (point, triangle) pairs
+    pt, tri = [], []
+    for j in range(k):
+        v = idx[:, j]
+        n = ntri[v]
+        pt.append(np.repeat(np.arange(len(points)), n))
+        start = np.repeat(offsets[v], n)
+        local = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+        tri.append(vertex_triangles[start + local])
+
+    pt = np.concatenate(pt)
+    tri = np.concatenate(tri)
+
+    a, b, c = [surf_points[triangles[tri, i]] for i in range(3)]
+    q = _closest_point_on_triangles(points[pt], a, b, c)
+    d = np.linalg.norm(points[pt] - q, axis=1)
+
+    dist = np.full(len(points), np.inf)
+    np.minimum.at(dist, pt, d)
+
+    # Points where the closest vertex has no triangles
+    mask = np.isinf(dist)
+    if np.any(mask):
+        dist[mask] = tree.query(points[mask])[0]
+
+    return dist
+
+
+def _surface_distance_worker(args):
+    return surface_distance(*args)
+
+
+def compute_geometric_distance(
+    patient, us, vtk_output=None, exact=False, nprocs=1, write_vtk=True
+):
     """Compute the distance between the vertices from the simulation
     and the vertices from the segmented surfaces of the endocardium.
     For each vertex in the simulated surface :math:`a \in \Xi_{\mathrm{sim}}`,
@@ -720,18 +1253,36 @@ def compute_geometric_distance(patient, us, vtk_output):
 
        \Xi_{\mathrm{seg}} 
 
-    is the vertices of the (refined) segmented surface
+    is the vertices of the (refined) segmented surface. 
+
+    The closest points are found with a KD-tree, with one query per
+    time point. If `exact` is True, the distance to the segmented
+    surface itself is used instead of the distance to the vertices of
+    a refined surface (see :func:`surface_distance`). The meshes are
+    moved in serial, and the distances for all time points are then
+    computed on `nprocs` processes.
 
     :param patient: Patient class
     :param us: list of displacemets
     :param vtk_output: directory were to save the output
+    :param bool exact: Use the exact distance to the surface
+    :param int nprocs: Number of processes used to compute the distances
+    :param bool write_vtk: Save the surfaces and distances as vtk files
     :returns: 
     :rtype: 
 
     """
 
     from . import vtk_utils
-    import vtk
+    import tempfile
+
+    write_vtk = write_vtk and vtk_output is not None
+    if vtk_output is None:
+        surfdir = tempfile.mkdtemp()
+    else:
+        surfdir = vtk_output
+        if not os.path.exists(surfdir):
+            os.makedirs(surfdir)
 
     V_cg1 = dolfin.VectorFunctionSpace(patient.mesh, "CG", 1)
     V_cg2 = dolfin.VectorFunctionSpace(patient.mesh, "CG", 2)
@@ -743,6 +1294,9 @@ def compute_geometric_distance(patient, us, vtk_output):
     max_dist = []
     std_dist = []
 
+    frames = []
+    submeshes = []
+
     for k, t in enumerate(
         np.roll(list(range(patient.num_points)), -patient.passive_filling_begins)
     ):
@@ -757,7 +1311,7 @@ def compute_geometric_distance(patient, us, vtk_output):
         ud = dolfin.interpolate(d, V_cg1)
         dolfin.ALE.move(mesh, ud)
 
-        endoname = vtk_utils.save_surface_to_dolfinxml(patient, t, vtk_output)
+        endoname = vtk_utils.save_surface_to_dolfinxml(patient, t, surfdir)
         endo_surf = dolfin.Mesh(endoname)
         endo_surf_apex = endo_surf.coordinates().T[0].max()
 
@@ -765,56 +1319,72 @@ def compute_geometric_distance(patient, us, vtk_output):
         u_apical = compute_apical_registration(mesh, patient, endo_surf_apex)
         dolfin.ALE.move(mesh, u_apical)
 
-        # Save unrefined surface for later visualization
-        surf_unrefined = vtk_utils.dolfin2polydata(endo_surf)
-        distname = "/".join([vtk_output, "echopac_{}.vtk".format(k)])
-        vtk_utils.write_to_polydata(distname, surf_unrefined)
+        if write_vtk:
+            # Save unrefined surface for later visualization
+            surf_unrefined = vtk_utils.dolfin2polydata(endo_surf)
+            distname = "/".join([vtk_output, "echopac_{}.vtk".format(k)])
+            vtk_utils.write_to_polydata(distname, surf_unrefined)
 
-        # Convert surface to dolfin format
-        # surf_unrefined = dolfin2vtu(endo_surf)
+        if exact:
+            surf = endo_surf
+            triangles = np.array(endo_surf.cells())
+        else:
+            # Refine surface for better accuracy
+            surf = dolfin.refine(
+                dolfin.refine(dolfin.refine(dolfin.refine(endo_surf)))
+            )
+            triangles = None
 
-        # Refine surface for better accuracy
-        endo_surf_refined = dolfin.refine(
-            dolfin.refine(dolfin.refine(dolfin.refine(endo_surf)))
-        )
         # Get endocardial mesh from original mesh
         endo_submesh = vtk_utils.get_submesh(mesh, patient.ENDO)
 
-        # Convert surfaces to polydata
-        endo_surf_vtk = vtk_utils.dolfin2polydata(endo_surf_refined)
-        endo_submesh_vtk = vtk_utils.dolfin2polydata(endo_submesh)
+        frames.append(
+            (
+                np.array(endo_submesh.coordinates()),
+                np.array(surf.coordinates()),
+                triangles,
+            )
+        )
+        submeshes.append((k, endo_submesh))
+
+        u_prev.assign(u_current)
 
-        # Build a Kd search tree
-        tree = vtk.vtkKdTreePointLocator()
-        tree.SetDataSet(endo_surf_vtk)
-        tree.BuildLocator()
+    if nprocs > 1 and len(frames) > 1:
+        import multiprocessing
 
-        distance = vtk.vtkDoubleArray()
-        distance_arr = []
-        for i in range(endo_submesh_vtk.GetNumberOfPoints()):
-            p = endo_submesh_vtk.GetPoint(i)
+        pool = multiprocessing.Pool(min(nprocs, len(frames)))
+        try:
+            distances = pool.map(_surface_distance_worker, frames)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        distances = [surface_distance(*frame) for frame in frames]
 
-            # Nearest neighbor
-            idx = tree.FindClosestPoint(p)
-            psurf = endo_surf_vtk.GetPoint(idx)
+    for (k, endo_submesh), distance_arr in zip(submeshes, distances):
 
-            # Compute di
-            dist = np.linalg.norm(np.subtract(psurf, p))
+        if write_vtk:
+            import vtk
 
-            distance.InsertNextValue(dist)
-            distance_arr.append(dist)
+            endo_submesh_vtk = vtk_utils.dolfin2polydata(endo_submesh)
+            distance = vtk.vtkDoubleArray()
+            for dist in distance_arr:
+                distance.InsertNextValue(dist)
 
-        # Set the distances as scalars in the vtk file
-        endo_submesh_vtk.GetPointData().SetScalars(distance)
+            # Set the distances as scalars in the vtk file
+            endo_submesh_vtk.GetPointData().SetScalars(distance)
 
-        distname = "/".join([vtk_output, "dist_{}.vtk".format(k)])
-        vtk_utils.write_to_polydata(distname, endo_submesh_vtk)
+            distname = "/".join([vtk_output, "dist_{}.vtk".format(k)])
+            vtk_utils.write_to_polydata(distname, endo_submesh_vtk)
 
         mean_dist.append(np.mean(distance_arr))
         std_dist.append(np.std(distance_arr))
         max_dist.append(np.max(distance_arr))
 
-        u_prev.assign(u_current)
+    if vtk_output is None:
+        import shutil
+
+        shutil.rmtree(surfdir, ignore_errors=True)
 
     d = {"mean_distance": mean_dist, "std_distance": std_dist, "max_distance": max_dist}
     return d
@@ -1032,9 +1602,13 @@ def compute_cardiac_work(patient, params, val, case, wp, e_k=None):
 
     cw.reset()
 
-    regions = [0] + list(set(patient.sfun.array()))
+    # All the processes need the same regions
+    regions = [0] + [
+        int(r) for r in sorted(set(numpy_mpi.gather_broadcast(patient.sfun.array())))
+    ]
     work_lst = {r: [] for r in regions}
     power_lst = {r: [] for r in regions}
+    powers, works = [], []
 
     # print(header.format(wp, case, region))
 
@@ -1110,19 +1684,23 @@ def compute_cardiac_work(patient, params, val, case, wp, e_k=None):
             first_time = False
             continue
 
-        for region in regions:
-            dx = dX if region == 0 else dX(int(region))
-            meshvol = dolfin.assemble(dolfin.Constant(1.0) * dx)
+        powers.append(cw.get_power().vector().array())
+        works.append(cw.get_work().vector().array())
 
-            power = cw.get_power()
-            work = cw.get_work()
+    # Compute the regional and global means for all time points at once
+    op = get_averaging_operator(dX, regions[1:])
+    if powers:
+        power_regional = op.regional(W, powers)
+        work_regional = op.regional(W, works)
 
-            power_ = dolfin.assemble(power * dx) / meshvol
-            work_ = dolfin.assemble(work * dx) / meshvol
-
-            work_lst[region].append(work_)
-            power_lst[region].append(power_)
+        power_lst[0] = list(op.volumes.dot(power_regional) / op.volume)
+        work_lst[0] = list(op.volumes.dot(work_regional) / op.volume)
+        for j, region in enumerate(regions[1:]):
+            power_lst[region] = list(power_regional[j])
+            work_lst[region] = list(work_regional[j])
 
+    for region in regions:
+        for power_, work_ in zip(power_lst[region], work_lst[region]):
             print(("\t{:<10}\t{:<10.3f}\t{:<10.3f}".format(region, power_, work_)))
 
     for region in regions:
@@ -1489,6 +2067,72 @@ def compute_emax(patient, params, val, valve_times):
         return None
 
 
+class FeatureExtractor(object):
+    """
+    Project scalar fields and compute their regional and global
+    averages for many fields and time points.
+
+    The mass matrix of each space is assembled and factorized once,
+    so that a projection is one assembly of the right hand side and
+    one solve. The averages are computed with a
+    :class:`RegionAveragingOperator`.
+
+    :param dx: Volume measure marked according to the regions
+    :param dict spaces: The function spaces (see :func:`get_feature_spaces`)
+    :param list regions: The regions
+
+    """
+
+    def __init__(self, dx, spaces, regions):
+
+        self.spaces = spaces
+        self.regions = regions
+        self.dx = dolfin.Measure("dx", domain=dx.ufl_domain())
+        self.operator = get_averaging_operator(dx, regions)
+
+        self._solvers = {}
+
+    def averages(self, fun):
+        """
+        Return the average of `fun` in each region, and
+        the average over all the regions
+        """
+        return self.operator.quad(fun)
+
+    def _solver(self, space):
+
+        if space not in self._solvers:
+
+            V = self.spaces[space]
+            u = dolfin.TrialFunction(V)
+            v = dolfin.TestFunction(V)
+            M = dolfin.assemble(dolfin.inner(u, v) * self.dx)
+
+            solver = dolfin.LUSolver(M)
+            try:
+                solver.parameters["reuse_factorization"] = True
+            except (KeyError, RuntimeError):
+                # Newer versions of dolfin reuse the factorization by default
+                pass
+
+            self._solvers[space] = (solver, v)
+
+        return self._solvers[space]
+
+    def project(self, fun, space):
+        """
+        Project `fun` onto the given space
+        """
+
+        solver, v = self._solver(space)
+        b = dolfin.assemble(dolfin.inner(fun, v) * self.dx)
+
+        f = dolfin.Function(self.spaces[space])
+        solver.solve(f.vector(), b)
+
+        return f
+
+
 def copmute_mechanical_features(patient, params, val, path, keys=None):
     """Compute mechanical features such as stress, strain, 
     works etc, save the output in dolfin vectors to a file, and 
@@ -1586,6 +2230,8 @@ def copmute_mechanical_features(patient, params, val, path, keys=None):
 
     e_f = get_fiber_field(patient)
 
+    extractor = FeatureExtractor(dx, spaces, regions)
+
     def get(feature, fun, space, project=True):
 
         assert space in list(spaces.keys()), "Invalid space: {}".format(space)
@@ -1593,7 +2239,7 @@ def copmute_mechanical_features(patient, params, val, path, keys=None):
 
         if project:
 
-            f = dolfin.project(fun, spaces[space], solver_type="cg")
+            f = extractor.project(fun, space)
             remove_extreme_outliers(f, 300, -300)
         else:
             f = fun
@@ -1606,8 +2252,7 @@ def copmute_mechanical_features(patient, params, val, path, keys=None):
                 regional = get_regional(dx, f, [f.vector().array()], regions)
                 scalar = get_global(dx, f, [f.vector().array()], regions)
             else:
-                regional = get_regional_quad(dx, fun, regions)
-                scalar = get_global_quad(dx, fun)
+                regional, scalar = extractor.averages(fun)
 
             for i, r in enumerate(regions):
                 features_scalar[feature][str(r)].append(regional[i])
@@ -1638,6 +2283,9 @@ def copmute_mechanical_features(patient, params, val, path, keys=None):
         F_ed = dolfin.Identity(3) + dolfin.grad(u_ed)
         F = dolfin.Identity(3) + dolfin.grad(u)
 
+        # Green strain tensor, shared by all directions
+        E = None
+
         for k in keys:
 
             k1, k2 = k.split(":")
@@ -1694,7 +2342,8 @@ def copmute_mechanical_features(patient, params, val, path, keys=None):
 
                 if k1 == "green_strain":
 
-                    E = dolfin.project(post.GreenLagrange(F_ref=F_ed), W)
+                    if E is None:
+                        E = dolfin.project(post.GreenLagrange(F_ref=F_ed), W)
                     Ef = dolfin.inner(E * e, e)
 
                     get(k, Ef, "cg2")
@@ -1735,30 +2384,98 @@ def get_solver(matparams, patient, gamma, params):
     return LVSolver(solver_parameters), pressure
 
 
+class CalibratedSolverPool(object):
+    """
+    Build the solver for a patient once, and reuse it for all the
+    time points. Only the state and gamma differ between the time
+    points, and they are swapped in using `solver.reinit`.
+
+    **Example of use**::
+
+      pool = CalibratedSolverPool(patient, params, matparams)
+      for state_arr, gamma_arr in zip(states, gammas):
+          solver, p_expr = pool.get(state_arr, gamma_arr)
+
+    :param patient: The patient
+    :param params: Adjoint contraction parameters
+    :param matparams: Material parameters
+
+    """
+
+    def __init__(self, patient, params, matparams):
+
+        self.patient = patient
+        self.params = params
+        self.matparams = matparams
+
+        if params["gamma_space"] == "regional":
+            sfun = merge_control(patient, params["merge_active_control"])
+            self.gamma = RegionalParameter(sfun)
+            self.gamma_tmp = RegionalParameter(sfun)
+        else:
+            gamma_space = dolfin.FunctionSpace(patient.mesh, "CG", 1)
+            self.gamma_tmp = dolfin.Function(
+                gamma_space, name="Contraction Parameter (tmp)"
+            )
+            self.gamma = dolfin.Function(gamma_space, name="Contraction Parameter")
+
+        self.solver, self.p_expr = get_solver(matparams, patient, self.gamma, params)
+        self.w = dolfin.Function(self.solver.get_state_space())
+
+    def matches(self, patient, params, matparams):
+        return (
+            self.patient is patient
+            and self.params is params
+            and self.matparams is matparams
+        )
+
+    def get(self, state_arr, gamma_arr):
+        """
+        Return the solver with the given state and gamma
+        """
+
+        self.gamma_tmp.vector()[:] = gamma_arr
+        self.gamma.assign(self.gamma_tmp)
+
+        self.w.vector()[:] = state_arr
+        self.solver.reinit(self.w)
+
+        return self.solver, self.p_expr
+
+
+# The solver pool for the last patient
+_solver_pool = None
+
+
 def get_calibrated_solver(
-    state_arr, pressure, gamma_arr, patient, params, matparams, rv_pressure=None
+    state_arr,
+    pressure,
+    gamma_arr,
+    patient,
+    params,
+    matparams,
+    rv_pressure=None,
+    reuse=True,
 ):
+    """
+    Get a solver with the given state and gamma.
 
-    if params["gamma_space"] == "regional":
-        sfun = merge_control(patient, params["merge_active_control"])
-        gamma = RegionalParameter(sfun)
-        gamma_tmp = RegionalParameter(sfun)
-    else:
-        gamma_space = dolfin.FunctionSpace(patient.mesh, "CG", 1)
-        gamma_tmp = dolfin.Function(gamma_space, name="Contraction Parameter (tmp)")
-        gamma = dolfin.Function(gamma_space, name="Contraction Parameter")
-
-    solver, p_expr = get_solver(matparams, patient, gamma, params)
+    If `reuse` is True, the solver is built once per patient (and
+    parameters), and reused in the following calls. Note that the
+    previously returned solver is then updated as well.
+    """
 
-    gamma_tmp.vector()[:] = gamma_arr
-    gamma.assign(gamma_tmp)
+    global _solver_pool
 
-    w = dolfin.Function(solver.get_state_space())
-    w.vector()[:] = state_arr
+    if not reuse:
+        return CalibratedSolverPool(patient, params, matparams).get(
+            state_arr, gamma_arr
+        )
 
-    solver.reinit(w)
+    if _solver_pool is None or not _solver_pool.matches(patient, params, matparams):
+        _solver_pool = CalibratedSolverPool(patient, params, matparams)
 
-    return solver, p_expr
+    return _solver_pool.get(state_arr, gamma_arr)
 
 
 def remove_extreme_outliers(fun, ub=None, lb=None):
@@ -1782,7 +2499,116 @@ def remove_extreme_outliers(fun, ub=None, lb=None):
     fun.vector()[fun.vector().array() < lb] = lb
 
 
-def smooth_from_points(V, f0, nsamples=10, method="interpolate"):
+def _batched_rbf(points, fvals, mask, x):
+    """
+    Evaluate gaussian radial basis function interpolants at the points x,
+    one for each row of points, in the same way as
+    `scipy.interpolate.Rbf(..., function="gaussian")`.
+
+    :param points: (n, k, 3) array with the samples
+    :param fvals: (n, k) array with the values at the samples
+    :param mask: (n, k) boolean array with the samples to use
+    :param x: (n, 3) array with the points to evaluate
+    :returns: (n) array with the values
+
+    """
+
+    val = np.zeros(len(x))
+    nsamples = mask.sum(axis=1)
+
+    # Solve all the systems of the same size together
+    for m in np.unique(nsamples):
+
+        rows = np.where(nsamples == m)[0]
+        if m == 1:
+            val[rows] = fvals[rows][mask[rows]]
+            continue
+
+        # Move the samples that are used to the front of each row
+        order = np.argsort(~mask[rows], axis=1, kind="mergesort")[:, :m]
+        p = np.take_along_axis(points[rows], order[:, :, None], axis=1)
+        f = np.take_along_axis(fvals[rows], order, axis=1)
+
+        # Same default shape parameter as scipy.interpolate.Rbf
+        edges = p.max(axis=1) - p.min(axis=1)
+        nonzero = edges != 0
+        edges[~nonzero] = 1.0
+        epsilon = np.power(
+            np.prod(edges, axis=1) / m, 1.0 / np.maximum(nonzero.sum(axis=1), 1)
+        )
+
+        r = np.linalg.norm(p[:, :, None, :] - p[:, None, :, :], axis=-1)
+        A = np.exp(-((r / epsilon[:, None, None]) ** 2))
+
+        try:
+            w = np.linalg.solve(A, f[:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError:
+            w = np.array([np.linalg.lstsq(Ai, fi, rcond=None)[0] for Ai, fi in zip(A, f)])
+
+        r0 = np.linalg.norm(p - x[rows][:, None, :], axis=-1)
+        val[rows] = np.sum(w * np.exp(-((r0 / epsilon[:, None]) ** 2)), axis=1)
+
+    return val
+
+
+def _smooth_values(coords, xyz, f0val, samples_idx, point_id, method):
+    """
+    Compute the smoothed values at the given coordinates, from the
+    indices of the samples at each coordinate and the id of the
+    unique points. See :func:`smooth_from_points`
+    """
+
+    nsamples = samples_idx.shape[1]
+
+    # Only use the first sample at each coordinate
+    ids = point_id[samples_idx]
+    earlier = np.tril(np.ones((nsamples, nsamples), dtype=bool), -1)
+    duplicate = np.any((ids[:, :, None] == ids[:, None, :]) & earlier, axis=2)
+    mask = ~duplicate
+
+    fvals = f0val[samples_idx]
+
+    if method == "interpolate":
+        return _batched_rbf(xyz[samples_idx], fvals, mask, coords)
+
+    fvals_ma = np.ma.masked_array(fvals, mask=~mask)
+    median = np.ma.median(fvals_ma, axis=1).filled(0.0)
+
+    if method == "median":
+        return median
+
+    elif method == "average":
+        # Remove outliers (include only the values within 1 std)
+        mean = fvals_ma.mean(axis=1)
+        std = fvals_ma.std(axis=1)
+        inliers = np.abs(fvals - mean.filled(0.0)[:, None]) < 2 * std.filled(0.0)[
+            :, None
+        ]
+        fvals_ = np.ma.masked_array(fvals, mask=~(mask & inliers))
+        val = fvals_.mean(axis=1)
+        return np.where(np.ma.getmaskarray(val), median, val.filled(0.0))
+
+    raise ValueError("Unknown method {}".format(method))
+
+
+# The data used by the workers in smooth_from_points. This is set
+# before the workers are forked, so that only the chunk indices
+# are sent to the workers
+_smooth_problem = None
+
+
+def _smooth_values_worker(chunk):
+
+    start, stop = chunk
+    coords, xyz, f0val, samples_idx, point_id, method = _smooth_problem
+    return _smooth_values(
+        coords[start:stop], xyz, f0val, samples_idx[start:stop], point_id, method
+    )
+
+
+def smooth_from_points(
+    V, f0, nsamples=10, method="interpolate", nprocs=1, chunksize=10000
+):
     """
     Smooth f0 by interpolating f0 into V by using radial basis functions
     for interpolating scattered data using nsamples.
@@ -1791,6 +2617,10 @@ def smooth_from_points(V, f0, nsamples=10, method="interpolate"):
     This is very useful is e.g f0 is a function in a
     quadrature space
 
+    The samples for all the dofs are found with one KD-tree
+    query, and the interpolants are solved in batches. This
+    only works in serial.
+
     Parameters
     ----------
 
@@ -1804,6 +2634,11 @@ def smooth_from_points(V, f0, nsamples=10, method="interpolate"):
     method : str (optional)
         Method for smoothing. Either `interpolate` using
         radial basis functions, or `average`, or `median`
+    nprocs : int (optional)
+        Number of processes. If larger than 1, the dofs are
+        split into chunks that are smoothed in parallel
+    chunksize : int (optional)
+        Number of dofs that are smoothed together
 
     Returns
     -------
@@ -1815,51 +2650,57 @@ def smooth_from_points(V, f0, nsamples=10, method="interpolate"):
     """
 
     from scipy.spatial import cKDTree
-    from scipy.interpolate import Rbf
-    import numpy as np
+
+    global _smooth_problem
+
+    # The values are assigned assuming the serial dof numbering
+    if dolfin.MPI.size(V.mesh().mpi_comm()) > 1:
+        raise RuntimeError("smooth_from_points only works in serial")
 
     # points for f0
     V0 = f0.function_space()
     # xyz = V0.dofmap().tabulate_all_coordinates(V0.mesh()).reshape(-1, 3)
     xyz = V0.tabulate_dof_coordinates().reshape((-1, 3))
-    f0val = f0.vector().array()
-    tree = cKDTree(xyz)
+    f0val = f0.vector().get_local()
 
     # coordinate of the dofs
     # coords = V.dofmap().tabulate_all_coordinates(V.mesh()).reshape(-1, 3)
     coords = V.tabulate_dof_coordinates().reshape((-1, 3))
     f = dolfin.Function(V)
 
-    for idx in range(0, V.dim()):
-        v = coords[idx, :]
-        samples_rad, samples_idx = tree.query(v, nsamples)
-        a = xyz[samples_idx, :]
-        b = np.ascontiguousarray(a).view(
-            np.dtype((np.void, a.dtype.itemsize * a.shape[1]))
-        )
-        _, inds = np.unique(b, return_index=True)
-        c = a[inds]
-        s_idx = samples_idx[inds]
-
-        xx, yy, zz = np.split(c, 3, axis=1)
-        fvals = f0val[s_idx]
-
-        if method == "interpolate":
-            rbf = Rbf(xx, yy, zz, fvals, function="gaussian")  # function='linear')
-            val = float(rbf(v[0], v[1], v[2]))
-
-        elif method == "average":
-            # Remove outliers (include only the values within 1 std)
-            fvals_ = fvals[abs(fvals - np.mean(fvals)) < 2 * np.std(fvals)]
-            if len(fvals_) > 0:
-                val = np.mean(fvals_)
-            else:
-                val = np.median(fvals)
+    # Find the samples for all the dofs at once
+    tree = cKDTree(xyz)
+    nsamples = min(nsamples, len(xyz))
+    _, samples_idx = tree.query(coords, nsamples)
+    samples_idx = np.reshape(samples_idx, (len(coords), nsamples))
+
+    # Give the points with the same coordinates the same id
+    b = np.ascontiguousarray(xyz).view(
+        np.dtype((np.void, xyz.dtype.itemsize * xyz.shape[1]))
+    ).ravel()
+    _, point_id = np.unique(b, return_inverse=True)
+
+    chunks = [
+        (i, min(i + chunksize, len(coords))) for i in range(0, len(coords), chunksize)
+    ]
 
-        elif method == "median":
-            val = np.median(fvals)
+    _smooth_problem = (coords, xyz, f0val, samples_idx, point_id, method)
+    try:
+        if nprocs > 1 and len(chunks) > 1:
+            import multiprocessing
+
+            pool = multiprocessing.Pool(min(nprocs, len(chunks)))
+            try:
+                vals = pool.map(_smooth_values_worker, chunks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            vals = [_smooth_values_worker(chunk) for chunk in chunks]
+    finally:
+        _smooth_problem = None
 
-        f.vector()[idx] = val
+    f.vector()[:] = np.concatenate(vals) if vals else np.zeros(0)
 
     return f
 
@@ -1891,6 +2732,42 @@ def localproject(fun, V):
     return res
 
 
+class LocalProjector(object):
+    """
+    Project onto a discontinuous space many times. Since the
+    projection is local to each cell, the local mass matrices
+    are factorized once, and each projection is one assembly
+    and one local solve. See :func:`localproject`.
+
+    Parameters
+    ----------
+    V : dolfin.FunctionSpace
+        The (discontinuous) space you want to project into
+
+    """
+
+    def __init__(self, V):
+
+        self.V = V
+        self._v = dolfin.TestFunction(V)
+        a = dolfin.inner(self._v, dolfin.TrialFunction(V)) * dolfin.dx
+        self._solver = dolfin.LocalSolver(a)
+        self._solver.factorize()
+
+    def __call__(self, fun, res=None):
+        """
+        Project fun into V. If res is given, the result
+        is stored in res, otherwise in a new function
+        """
+
+        if res is None:
+            res = dolfin.Function(self.V)
+
+        b = dolfin.assemble(dolfin.inner(self._v, fun) * dolfin.dx)
+        self._solver.solve_local(res.vector(), b, self.V.dofmap())
+        return res
+
+
 def setup_bullseye_sim(bullseye_mesh, fun_arr):
     V = FunctionSpace(bullseye_mesh, "DG", 0)
     dm = V.dofmap()
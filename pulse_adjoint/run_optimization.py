@@ -48,11 +48,18 @@ from .utils import (
     UnableToChangePressureExeption,
     get_simulated_pressure,
     check_group_exists,
+    result_file_lock,
+    locked_result_file,
 )
 from .forward_runner import ActiveForwardRunner, PassiveForwardRunner
 from .optimization_targets import *
 from .adjoint_contraction_args import *
-from .io import write_opt_results_to_h5
+from .io import (
+    write_opt_results_to_h5,
+    StateWriter,
+    get_async_writer,
+    flush_async_writes,
+)
 from .optimal_control import OptimalControl
 
 
@@ -107,7 +114,9 @@ def run_unloaded_optimization(params, patient):
         group = "/".join(
             [params["h5group"], PASSIVE_INFLATION_GROUP, "/optimal_control"]
         )
-        with dolfin.HDF5File(dolfin.mpi_comm_world(), params["sim_file"], "r") as h5file:
+        with result_file_lock, dolfin.HDF5File(
+            dolfin.mpi_comm_world(), params["sim_file"], "r"
+        ) as h5file:
             h5file.read(paramvec, group)
 
         # Load the initial guess
@@ -142,6 +151,9 @@ def run_unloaded_optimization(params, patient):
         pressures = patient.pressure[:pfd]
         volumes = patient.volume[:pfd]
 
+    # Make sure the initial passive results are written
+    flush_async_writes()
+
     from .unloading import UnloadedMaterial
 
     estimator = UnloadedMaterial(
@@ -191,6 +203,7 @@ def run_passive_optimization(params, patient):
 
     logger.info("\nSolve optimization problem.......")
     solve_oc_problem(params, rd, paramvec)
+    flush_async_writes()
 
 
 def run_passive_optimization_step(
@@ -243,7 +256,11 @@ def run_passive_optimization_step(
 
     # Initialize MyReducedFuctional
     rd = MyReducedFunctional(
-        for_run, paramvec, relax=params["passive_relax"], verbose=params["verbose"]
+        for_run,
+        paramvec,
+        relax=params["passive_relax"],
+        verbose=params["verbose"],
+        memo_size=params["Optimization_parameters"]["memo_size"],
     )
 
     return rd, paramvec
@@ -270,6 +287,10 @@ def run_active_optimization(params, patient):
     i = 0
     logger.info("Number of contract points: {}".format(patient.num_contract_points))
 
+    # Optimal gamma at the contract points solved in this run,
+    # used for the extrapolated initial guess
+    gamma_history = {}
+
     while i < patient.num_contract_points:
         params["active_contraction_iteration_number"] = i
 
@@ -350,10 +371,31 @@ def run_active_optimization(params, patient):
                         g.assign(c)
                         rd(g)
 
+                    elif params["initial_guess"] == "extrapolate" and i > 1:
+
+                        # Warm start: step up gamma to a linear prediction
+                        # from the two previous points, and start the
+                        # optimization from the prediction and the
+                        # converged state there
+                        g = extrapolate_gamma(params, gamma, i, gamma_history)
+                        try:
+                            rd(g)
+                        except SolverDidNotConverge:
+                            logger.info(
+                                "Unable to solve at extrapolated gamma. "
+                                "Use gamma from previous point"
+                            )
+                        else:
+                            gamma.assign(g)
+
                     logger.info("\nSolve optimization problem.......")
                     solve_oc_problem(params, rd, gamma)
                     dolfin_adjoint.adj_reset()
 
+                    gamma_history[i] = numpy_mpi.gather_broadcast(
+                        gamma.vector().get_local()
+                    )
+
             if not pressure_change:
                 raise RuntimeError("Unable to increasure")
 
@@ -368,6 +410,69 @@ def run_active_optimization(params, patient):
                 i -= 1
         i += 1
 
+    flush_async_writes()
+
+
+@locked_result_file
+def load_optimal_gamma(params, gamma, i):
+    """Load the optimal gamma for a given contract point
+
+    :param params: Application parameters
+    :param gamma: The active control parameter
+    :param int i: The contract point
+    :returns: The optimal gamma at contract point i
+    :rtype: :py:class`dolfin_adjoint.Function`
+
+    """
+
+    g_temp = dolfin_adjoint.Function(gamma.function_space())
+    with dolfin.HDF5File(dolfin.mpi_comm_world(), params["sim_file"], "r") as h5file:
+        h5file.read(
+            g_temp, "active_contraction/contract_point_{}/optimal_control".format(i)
+        )
+
+    return g_temp
+
+
+def extrapolate_gamma(params, gamma, i, gamma_history=None):
+    """Predict gamma at contract point i by linear extrapolation from
+    the optimal gamma at contract points i-2 and i-1. Here `gamma` is
+    expected to hold the optimal value at point i-1.
+
+    This is only a warm start for the optimization at point i. The
+    contract points are still solved one after the other.
+
+    :param params: Application parameters
+    :param gamma: The active control parameter at contract point i-1
+    :param int i: The contract point
+    :param dict gamma_history: Gathered optimal gamma at the contract
+                               points solved so far. Point i-2 is read
+                               from the result file if it is not here.
+    :returns: A prediction for gamma at contract point i
+    :rtype: :py:class`dolfin_adjoint.Function`
+
+    """
+
+    gamma_history = {} if gamma_history is None else gamma_history
+
+    g_arr = numpy_mpi.gather_broadcast(gamma.vector().get_local())
+    if i - 2 in gamma_history:
+        g_prev_arr = gamma_history[i - 2]
+    else:
+        g_prev = load_optimal_gamma(params, gamma, i - 2)
+        g_prev_arr = numpy_mpi.gather_broadcast(g_prev.vector().get_local())
+
+    opt_params = params["Optimization_parameters"]
+    g_new_arr = np.clip(
+        2 * g_arr - g_prev_arr,
+        float(opt_params["gamma_min"]),
+        float(opt_params["gamma_max"]),
+    )
+
+    g = dolfin_adjoint.Function(gamma.function_space())
+    numpy_mpi.assign_to_vector(g.vector(), g_new_arr)
+    return g
+
 
 def run_active_optimization_step(
     params, patient, solver_parameters, measurements, pressure, gamma
@@ -396,14 +501,9 @@ def run_active_optimization_step(
 
         # Use gamma from the previous point as initial guess
         # Load gamma from previous point
-        g_temp = dolfin_adjoint.Function(gamma.function_space())
-        with dolfin.HDF5File(dolfin.mpi_comm_world(), params["sim_file"], "r") as h5file:
-            h5file.read(
-                g_temp,
-                "active_contraction/contract_point_{}/optimal_control".format(
-                    params["active_contraction_iteration_number"] - 1
-                ),
-            )
+        g_temp = load_optimal_gamma(
+            params, gamma, params["active_contraction_iteration_number"] - 1
+        )
 
         gamma.assign(g_temp)
 
@@ -440,16 +540,23 @@ def run_active_optimization_step(
     logger.debug(Text.yellow("Stop annotating"))
     dolfin.parameters["adjoint"]["stop_annotating"] = True
 
+    # The active forward model steps up gamma and the state from the
+    # previously evaluated control, so an evaluation cannot be skipped
     rd = MyReducedFunctional(
-        for_run, gamma, relax=params["active_relax"], verbose=params["verbose"]
+        for_run,
+        gamma,
+        relax=params["active_relax"],
+        verbose=params["verbose"],
+        memo_size=0,
     )
     print(9)
     return rd, gamma
 
 
-def store(params, rd, opt_result):
-
-    solver = rd.for_run.cphm.solver
+def get_h5group(params):
+    """Return the group in the result file where the
+    results for the current phase are stored
+    """
 
     if params["phase"] == PHASES[0]:
 
@@ -465,7 +572,258 @@ def store(params, rd, opt_result):
             ]
         )
 
-    write_opt_results_to_h5(h5group, params, rd.for_res, solver, opt_result)
+    return h5group
+
+
+def store(params, rd, opt_result, state_writer=None):
+
+    solver = rd.for_run.cphm.solver
+    h5group = get_h5group(params)
+
+    async_writer = get_async_writer() if params["async_write"] else None
+
+    write_opt_results_to_h5(
+        h5group,
+        params,
+        rd.for_res,
+        solver,
+        opt_result,
+        state_writer=state_writer,
+        async_writer=async_writer,
+    )
+
+
+def solve_oc_problem_single(params, rd, paramvec, nvar):
+    """Solve the optimal control problem starting from the current
+    value of the control. If the solver fails, the step size
+    is reduced and we try again.
+
+    :param params: Application parameters
+    :param rd: The reduced functional
+    :param paramvec: The control parameter(s)
+    :param int nvar: Number of control variables
+    :returns: A flag indicating if the problem was solved, the
+              optimal control (or the best value found) and the
+              optimization results
+    :rtype: tuple
+
+    """
+
+    # Some flags
+    solved = False
+    done = False
+    paramvec_start = paramvec.copy(True)
+    state_start = rd.for_run.cphm.get_state()
+    niter = 0
+
+    par_max = np.max(numpy_mpi.gather_broadcast(paramvec_start.vector().get_local()))
+    par_min = np.min(numpy_mpi.gather_broadcast(paramvec_start.vector().get_local()))
+    gamma_max = float(params["Optimization_parameters"]["gamma_max"])
+    mat_max = float(params["Optimization_parameters"]["matparams_max"])
+    mat_min = float(params["Optimization_parameters"]["matparams_min"])
+
+    while not done and niter < 10:
+        # Evaluate the reduced functional in case the solver chrashes at the first point.
+        # If this is not done, and the solver crashes in the first point
+        # then Dolfin adjoit has no recording and will raise an exception.
+
+        # If this fails, there is no hope.
+        try:
+
+            rd(paramvec)
+        except SolverDidNotConverge:
+            print("NOOOO!")
+            if len(rd.controls_lst) > 0:
+                assign_to_vector(paramvec.vector(), rd.controls_lst[-1].array())
+            else:
+                msg = "Unable to converge. " + "Choose a different initial guess"
+                logger.error(msg)
+            try:
+                rd(paramvec)
+            except:
+                msg = "Unable to converge. " + "Try changing the scales and restart"
+                logger.error(msg)
+
+        # Create optimal control problem
+        oc_problem = OptimalControl()
+        oc_problem.build_problem(params, rd, paramvec)
+
+        try:
+            # Try to solve the problem
+            rd, opt_result = oc_problem.solve()
+
+        except SolverDidNotConverge:
+
+            logger.warning(Text.red("Solver failed - reduce step size"))
+            # If the solver did not converge assign the state from
+            # previous iteration and reduce the step size and try again
+            rd.reset()
+            rd.derivative_scale /= 2.0
+
+            # There might be many reasons for why the sovler is not converging,
+            # but most likely it happens because the optimization algorithms try to
+            # evaluate the function in a point in the parameter space, which is close
+            # to the boundary. One thing we can do is to reduce the mangnitude of the
+            # gradient (but keeping the direction) so that the step size reduces.
+            # Another thing we can do is to actually change the bounds so that
+            # the algorithm do not go into the nasty parts of the parameters space.
+            # Usually the main problem is that the optimziation tries an activation that
+            # is too strong (high gamma max) in the active phase, or at material parameter
+            # set that is too soft (low material parameters) in the passive phase
+            params["Optimization_parameters"]["gamma_max"] = np.max(
+                [par_max, 0.9 * params["Optimization_parameters"]["gamma_max"]]
+            )
+            params["Optimization_parameters"]["matparams_min"] = np.min(
+                [par_min, 2 * params["Optimization_parameters"]["matparams_min"]]
+            )
+
+        else:
+            params["Optimization_parameters"]["gamma_max"] = gamma_max
+            params["Optimization_parameters"]["matparams_min"] = mat_min
+            rd.derivative_scale = 1.0
+            done = True
+
+        niter += 1
+
+    if not done:
+        opt_result = {}
+        control_idx = np.argmin(rd.func_values_lst)
+        x = numpy_mpi.gather_broadcast(rd.controls_lst[control_idx].array())
+    else:
+        x = (
+            np.array([opt_result.pop("x")])
+            if nvar == 1
+            else numpy_mpi.gather_broadcast(opt_result.pop("x"))
+        )
+
+    return done, x, opt_result
+
+
+def _get_bounds(params):
+
+    opt_params = params["Optimization_parameters"]
+    if params["phase"] == PHASES[0]:
+        return float(opt_params["matparams_min"]), float(opt_params["matparams_max"])
+    return float(opt_params["gamma_min"]), float(opt_params["gamma_max"])
+
+
+def get_multistart_guesses(x0, lb, ub, perturbation, nstarts):
+    """Return the initial guesses for the multi-start optimization.
+    The first guess is `x0`, and the others are perturbed with
+    uniform noise scaled by the range of the bounds, so that zero
+    controls are perturbed as well.
+
+    :param x0: The initial guess
+    :param float lb: Lower bound
+    :param float ub: Upper bound
+    :param float perturbation: Size of the perturbation relative
+                               to the range of the bounds
+    :param int nstarts: Number of initial guesses
+    :returns: The initial guesses
+    :rtype: list
+
+    """
+    x0 = np.asarray(x0, dtype=float)
+    guesses = [x0]
+    for i in range(1, nstarts):
+        rand = np.random.RandomState(i)
+        x = x0 + perturbation * (ub - lb) * rand.uniform(-1, 1, x0.shape)
+        guesses.append(np.clip(x, lb, ub))
+
+    return guesses
+
+
+# The problem solved by the multi-start workers. This is set
+# before the workers are forked, since the reduced functional
+# and the controls cannot be pickled
+_multistart_problem = None
+
+
+def _multistart_worker(args):
+
+    i, x0 = args
+    params, rd, paramvec, nvar = _multistart_problem
+
+    numpy_mpi.assign_to_vector(paramvec.vector(), x0)
+    try:
+        done, x, opt_result = solve_oc_problem_single(params, rd, paramvec, nvar)
+        func_value = rd(x)
+    except Exception as ex:
+        logger.warning("Start {} failed: {}".format(i, ex))
+        return i, False, np.inf, x0, {}
+
+    # Make sure that everyting can be sent back to the main process
+    if "controls" in opt_result:
+        opt_result["controls"] = [
+            numpy_mpi.gather_broadcast(c.get_local()) for c in opt_result["controls"]
+        ]
+
+    return i, done, func_value, x, opt_result
+
+
+def solve_oc_problem_multistart(params, rd, paramvec):
+    """Solve the optimal control problem from several perturbed
+    initial guesses in parallel, and return the best solution.
+    The first start is the unperturbed initial guess.
+
+    Each start is solved in a separate (forked) process with its own
+    recording of the forward model, so this only works in serial.
+
+    :param params: Application parameters
+    :param rd: The reduced functional
+    :param paramvec: The control parameter(s)
+    :returns: A flag indicating if the problem was solved, the
+              optimal control and the optimization results
+    :rtype: tuple
+
+    """
+    import multiprocessing
+
+    global _multistart_problem
+
+    opt_params = params["Optimization_parameters"]
+    nstarts = opt_params["nstarts"]
+    nprocs = opt_params["nprocs"]
+    nprocs = multiprocessing.cpu_count() if nprocs < 1 else nprocs
+    nprocs = min(nprocs, nstarts)
+
+    # Evaluate the functional at the initial guess first, so that
+    # all the starts share the same initial results
+    rd(paramvec)
+
+    x0 = numpy_mpi.gather_broadcast(paramvec.vector().get_local())
+    nvar = len(x0)
+    lb, ub = _get_bounds(params)
+    pert = opt_params["start_perturbation"]
+
+    starts = list(enumerate(get_multistart_guesses(x0, lb, ub, pert, nstarts)))
+
+    logger.info(
+        "Solve optimization problem from {} starts using {} processes".format(
+            nstarts, nprocs
+        )
+    )
+
+    _multistart_problem = (params, rd, paramvec, nvar)
+    pool = multiprocessing.Pool(nprocs)
+    try:
+        results = pool.map(_multistart_worker, starts)
+    finally:
+        pool.close()
+        pool.join()
+        _multistart_problem = None
+
+    i, done, func_value, x, opt_result = min(results, key=lambda r: r[2])
+    logger.info(
+        "Best start: {} (functional value {:.4e})".format(i, func_value)
+    )
+    opt_result["nstarts"] = nstarts
+    opt_result["best_start"] = i
+    opt_result["start_func_values"] = [r[2] for r in results]
+
+    numpy_mpi.assign_to_vector(paramvec.vector(), x)
+
+    return done and np.isfinite(func_value), x, opt_result
 
 
 def solve_oc_problem(params, rd, paramvec, return_solution=False, store_solution=True):
@@ -503,100 +861,44 @@ def solve_oc_problem(params, rd, paramvec, return_solution=False, store_solution
         logger.info("Solve optimal contol problem".center(72, "-"))
         logger.info("".center(72, "-"))
 
-        # Some flags
-        solved = False
-        done = False
-        paramvec_start = paramvec.copy(True)
-        state_start = rd.for_run.cphm.get_state()
-        niter = 0
-
-        par_max = np.max(numpy_mpi.gather_broadcast(paramvec_start.vector().get_local()))
-        par_min = np.min(numpy_mpi.gather_broadcast(paramvec_start.vector().get_local()))
-        gamma_max = float(params["Optimization_parameters"]["gamma_max"])
-        mat_max = float(params["Optimization_parameters"]["matparams_max"])
-        mat_min = float(params["Optimization_parameters"]["matparams_min"])
-
-        while not done and niter < 10:
-            # Evaluate the reduced functional in case the solver chrashes at the first point.
-            # If this is not done, and the solver crashes in the first point
-            # then Dolfin adjoit has no recording and will raise an exception.
-
-            # If this fails, there is no hope.
-            try:
-
-                rd(paramvec)
-            except SolverDidNotConverge:
-                print("NOOOO!")
-                if len(rd.controls_lst) > 0:
-                    assign_to_vector(paramvec.vector(), rd.controls_lst[-1].array())
-                else:
-                    msg = "Unable to converge. " + "Choose a different initial guess"
-                    logger.error(msg)
-                try:
-                    rd(paramvec)
-                except:
-                    msg = "Unable to converge. " + "Try changing the scales and restart"
-                    logger.error(msg)
-
-            # Create optimal control problem
-            oc_problem = OptimalControl()
-            oc_problem.build_problem(params, rd, paramvec)
-
-            try:
-                # Try to solve the problem
-                rd, opt_result = oc_problem.solve()
-
-            except SolverDidNotConverge:
-
-                logger.warning(Text.red("Solver failed - reduce step size"))
-                # If the solver did not converge assign the state from
-                # previous iteration and reduce the step size and try again
-                rd.reset()
-                rd.derivative_scale /= 2.0
-
-                # There might be many reasons for why the sovler is not converging,
-                # but most likely it happens because the optimization algorithms try to
-                # evaluate the function in a point in the parameter space, which is close
-                # to the boundary. One thing we can do is to reduce the mangnitude of the
-                # gradient (but keeping the direction) so that the step size reduces.
-                # Another thing we can do is to actually change the bounds so that
-                # the algorithm do not go into the nasty parts of the parameters space.
-                # Usually the main problem is that the optimziation tries an activation that
-                # is too strong (high gamma max) in the active phase, or at material parameter
-                # set that is too soft (low material parameters) in the passive phase
-                params["Optimization_parameters"]["gamma_max"] = np.max(
-                    [par_max, 0.9 * params["Optimization_parameters"]["gamma_max"]]
-                )
-                params["Optimization_parameters"]["matparams_min"] = np.min(
-                    [par_min, 2 * params["Optimization_parameters"]["matparams_min"]]
-                )
-
-            else:
-                params["Optimization_parameters"]["gamma_max"] = gamma_max
-                params["Optimization_parameters"]["matparams_min"] = mat_min
-                rd.derivative_scale = 1.0
-                done = True
+        if opt_params["nstarts"] > 1 and dolfin.mpi_comm_world().size > 1:
+            logger.warning(
+                "Multi-start is only supported in serial. Use a single start"
+            )
 
-            niter += 1
+        if opt_params["nstarts"] > 1 and dolfin.mpi_comm_world().size == 1:
+            done, x, opt_result = solve_oc_problem_multistart(params, rd, paramvec)
+        else:
+            done, x, opt_result = solve_oc_problem_single(params, rd, paramvec, nvar)
 
         if not done:
-            opt_result = {}
-            control_idx = np.argmin(rd.func_values_lst)
-            x = numpy_mpi.gather_broadcast(rd.controls_lst[control_idx].array())
             msg = "Unable to solve problem. Choose the best value"
             logger.warning(msg)
-        else:
-            x = (
-                np.array([opt_result.pop("x")])
-                if nvar == 1
-                else numpy_mpi.gather_broadcast(opt_result.pop("x"))
-            )
 
         optimum = dolfin_adjoint.Function(paramvec.function_space())
         numpy_mpi.assign_to_vector(optimum.vector(), numpy_mpi.gather_broadcast(x))
 
         logger.info(Text.blue("\nForward solution at optimal parameters"))
-        val = rd.for_run(optimum, False)
+        state_writer = None
+        if store_solution and params["stream_states"]:
+            # Write the states to file while solving
+            state_writer = StateWriter(
+                params["sim_file"],
+                get_h5group(params),
+                rd.for_run.cphm.solver,
+                params["state_buffer_size"],
+            )
+            state_writer.start()
+
+        rd.for_run.state_writer = state_writer
+        try:
+            rd.for_res, crash = rd.for_run(optimum, False)
+        except Exception:
+            if state_writer is not None:
+                state_writer.discard()
+            raise
+        finally:
+            rd.for_run.state_writer = None
 
         numpy_mpi.assign_to_vector(paramvec.vector(), numpy_mpi.gather_broadcast(x))
 
@@ -613,7 +915,7 @@ def solve_oc_problem(params, rd, paramvec, return_solution=False, store_solution
         )
 
         if store_solution:
-            store(params, rd, opt_result)
+            store(params, rd, opt_result, state_writer)
 
         if return_solution:
             return params, rd, opt_result
@@ -807,7 +1109,9 @@ def get_optimization_targets(params, solver_parameters, mshfun=None):
             )
 
             logger.debug("Load displacement from state number {}.".format(group))
-            with dolfin.HDF5File(dolfin.mpi_comm_world(), params["sim_file"], "r") as h5file:
+            with result_file_lock, dolfin.HDF5File(
+                dolfin.mpi_comm_world(), params["sim_file"], "r"
+            ) as h5file:
 
                 # Get previous state
                 group = "/".join(
@@ -842,6 +1146,7 @@ def get_optimization_targets(params, solver_parameters, mshfun=None):
             F_ref=F_ref,
             approx=params["strain_approx"],
             map_strain=params["map_strain"],
+            batched=params["batch_regional_strain"],
         )
 
     return targets
@@ -24,6 +24,8 @@
 # SIMULA RESEARCH LABORATORY MAKES NO REPRESENTATIONS AND EXTENDS NO
 # WARRANTIES OF ANY KIND, EITHER IMPLIED OR EXPRESSED, INCLUDING, BUT
 # NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY OR FITNESS
+import collections
+import hashlib
 import numpy as np
 import logging
 import pulse
@@ -737,6 +739,15 @@ def setup_simulation(params, patient):
     return measurements, solver_parameters, pressure, controls
 
 
+def control_key(control):
+    """
+    Return a hash of the gathered values of the control,
+    which can be used as a key for a control
+    """
+    arr = numpy_mpi.gather_broadcast(control.vector().get_local())
+    return hashlib.sha1(np.ascontiguousarray(arr, dtype=float).tobytes()).hexdigest()
+
+
 class MyReducedFunctional(dolfin_adjoint.ReducedFunctional):
     """
     A modified reduced functional of the `dolfin_adjoint.ReducedFuctionl`
@@ -753,11 +764,19 @@ class MyReducedFunctional(dolfin_adjoint.ReducedFunctional):
     relax: float
         Scale factor for the derivative. Note the total scale factor for the 
         derivative will be scale*relax
+    memo_size: int
+        Number of evaluated controls to keep in memory. If the functional
+        is evaluated at a control that is already in memory the forward
+        model is not solved again. Only the functional value, the values
+        of the targets and the gradient are stored, so `for_res` always
+        belongs to the last forward solve. The forward model must not
+        depend on the previous evaluation. Set to 0 to turn this off.
 
 
     """
 
-    def __init__(self, for_run, paramvec, scale=1.0, relax=1.0, verbose=False):
+    def __init__(self, for_run, paramvec, scale=1.0, relax=1.0, verbose=False,
+                 memo_size=0):
 
         self.log_level = logger.level
         self.reset()
@@ -768,13 +787,27 @@ class MyReducedFunctional(dolfin_adjoint.ReducedFunctional):
         self.scale = scale
         self.derivative_scale = relax
 
+        self.memo_size = memo_size
+        self.memo = collections.OrderedDict()
+        self.memo_hits = 0
+        self.memo_misses = 0
+        # Number of times the forward model had to be recorded again
+        # to compute the gradient of a control found in memory
+        self.memo_rerecords = 0
+        # The control that was last evaluated, and the
+        # control that the current recording belongs to
+        self._current_key = None
+        self._current_control = None
+        self._tape_key = None
+        # The last gradient computed with the current recording
+        self._gradient_memo = None
+
         self.verbose = verbose
         from .optimal_control import has_scipy016
 
     def __call__(self, value, return_fail=False):
 
         logger.debug("\nEvaluate functional...")
-        dolfin_adjoint.adj_reset()
         self.iter += 1
 
         paramvec_new = dolfin_adjoint.Function(self.paramvec.function_space(), name="new control")
@@ -790,6 +823,38 @@ class MyReducedFunctional(dolfin_adjoint.ReducedFunctional):
         else:
             numpy_mpi.assign_to_vector(paramvec_new.vector(), numpy_mpi.gather_broadcast(value))
 
+        key = control_key(paramvec_new)
+        self._current_key = key
+        self._current_control = paramvec_new
+
+        entry = self.memo_lookup(key)
+        if entry is None:
+            func_value, crash = self._evaluate(paramvec_new, key)
+            target_values = self.memo_store(key, func_value, crash)
+        else:
+            logger.debug("Control found in memory. Skip forward solve")
+            func_value = entry["func_value"]
+            crash = entry["crash"]
+            target_values = entry["target_values"]
+
+        self.func_values_lst.append(func_value * self.scale)
+        self.controls_lst.append(dolfin.Vector(paramvec_new.vector()))
+
+        self.print_line(func_value, target_values)
+
+        if return_fail:
+            return self.scale * func_value, crash
+
+        return self.scale * func_value
+
+    def _evaluate(self, paramvec_new, key):
+        """
+        Run the forward model and record it so that
+        dolfin-adjoint can compute the gradient
+        """
+
+        dolfin_adjoint.adj_reset()
+
         logger.debug(Text.yellow("Start annotating"))
         dolfin.parameters["adjoint"]["stop_annotating"] = False
 
@@ -847,6 +912,9 @@ class MyReducedFunctional(dolfin_adjoint.ReducedFunctional):
         dolfin_adjoint.ReducedFunctional.__init__(
             self, dolfin_adjoint.Functional(self.for_res["total_functional"]), control
         )
+        self._tape_key = key
+        # A new recording invalidates the last gradient
+        self._gradient_memo = None
 
         if crash:
             # This exection is thrown if the solver uses more than x steps.
@@ -864,22 +932,55 @@ class MyReducedFunctional(dolfin_adjoint.ReducedFunctional):
         else:
             func_value = self.for_res["func_value"]
 
-        grad_norm = (
-            None if len(self.grad_norm_scaled) == 0 else self.grad_norm_scaled[-1]
-        )
-
-        self.func_values_lst.append(func_value * self.scale)
-        self.controls_lst.append(dolfin.Vector(paramvec_new.vector()))
-
         logger.debug(Text.yellow("Stop annotating"))
         dolfin.parameters["adjoint"]["stop_annotating"] = True
 
-        self.print_line()
+        return func_value, crash
+
+    def memo_lookup(self, key):
+        """
+        Return the stored evaluation for the given control
+        key, or None if it is not in memory
+        """
+
+        if self.memo_size < 1:
+            return None
+
+        if key in self.memo:
+            self.memo_hits += 1
+            # Mark as most recently used
+            entry = self.memo.pop(key)
+            self.memo[key] = entry
+            return entry
+
+        self.memo_misses += 1
+        return None
+
+    def memo_store(self, key, func_value, crash):
+        """
+        Store the result of the last forward solve. The
+        targets in `for_res` are overwritten by the next
+        solve, so only a copy of their values are kept.
+        Return the stored target values.
+        """
+
+        target_values = {
+            k: float(v) for k, v in self.for_res["target_values"].items()
+        }
+
+        if self.memo_size < 1:
+            return target_values
+
+        self.memo[key] = dict(
+            func_value=float(func_value),
+            crash=bool(crash),
+            target_values=target_values,
+            gradient=None,
+        )
+        while len(self.memo) > self.memo_size:
+            self.memo.popitem(last=False)
 
-        if return_fail:
-            return self.scale * func_value, crash
-
-        return self.scale * func_value
+        return target_values
 
     def reset(self):
 
@@ -891,6 +992,7 @@ class MyReducedFunctional(dolfin_adjoint.ReducedFunctional):
             self.nr_crashes = 0
             self.iter = 0
             self.nr_der_calls = 0
+            self.nr_saved_der_calls = 0
             self.func_values_lst = []
             self.controls_lst = []
             self.forward_times = []
@@ -907,14 +1009,24 @@ class MyReducedFunctional(dolfin_adjoint.ReducedFunctional):
             if len(self.grad_norm_scaled):
                 self.grad_norm_scaled.pop()
 
-    def print_line(self):
+    def print_line(self, func_value=None, target_values=None):
         grad_norm = (
             None if len(self.grad_norm_scaled) == 0 else self.grad_norm_scaled[-1]
         )
 
-        func_value = self.for_res["func_value"]
-
-        logger.info(print_line(self.for_res, self.iter, grad_norm, func_value))
+        if func_value is None:
+            func_value = self.for_res["func_value"]
+        if target_values is None:
+            target_values = self.for_res["target_values"]
+
+        logger.info(
+            print_line(
+                {"target_values": dict(target_values)},
+                self.iter,
+                grad_norm,
+                func_value,
+            )
+        )
 
     def derivative(self, *args, **kwargs):
 
@@ -925,23 +1037,59 @@ class MyReducedFunctional(dolfin_adjoint.ReducedFunctional):
         t = dolfin.Timer("Backward run")
         t.start()
 
-        out = dolfin_adjoint.ReducedFunctional.derivative(self, forget=False)
-        back_time = t.stop()
-        logger.debug(
-            (
-                "Evaluating gradient done. "
-                + "Time to evaluate = {} seconds".format(back_time)
+        entry = self.memo.get(self._current_key)
+        if (
+            self._gradient_memo is not None
+            and self._gradient_memo[0] == self._current_key
+        ):
+            logger.debug("Gradient already computed for this recording")
+            gathered_out = self._gradient_memo[1]
+
+        elif entry is not None and entry["gradient"] is not None:
+            logger.debug("Gradient found in memory. Skip backward solve")
+            gathered_out = entry["gradient"]
+
+        else:
+            gathered_out = None
+
+        if gathered_out is not None:
+            # Counted separately, so that the timings are
+            # only from actual backward solves
+            t.stop()
+            self.nr_saved_der_calls += 1
+
+        else:
+            if self._tape_key != self._current_key:
+                # The functional value was found in memory, so the
+                # current recording belongs to a different control.
+                # The forward solve is timed as a forward run.
+                t.stop()
+                logger.debug("Record the forward model again")
+                self.memo_rerecords += 1
+                self._evaluate(self._current_control, self._current_key)
+                t = dolfin.Timer("Backward run")
+                t.start()
+
+            out = dolfin_adjoint.ReducedFunctional.derivative(self, forget=False)
+            back_time = t.stop()
+            logger.debug(
+                (
+                    "Evaluating gradient done. "
+                    + "Time to evaluate = {} seconds".format(back_time)
+                )
             )
-        )
-        self.backward_times.append(back_time)
+            self.backward_times.append(back_time)
 
-        for num in out[0].vector().get_local():
-            if math.isnan(num):
-                raise Exception("NaN in adjoint gradient calculation.")
+            for num in out[0].vector().get_local():
+                if math.isnan(num):
+                    raise Exception("NaN in adjoint gradient calculation.")
 
-        # Multiply with some small number to that we take smaller steps
-        gathered_out = numpy_mpi.gather_broadcast(out[0].vector().get_local())
+            gathered_out = numpy_mpi.gather_broadcast(out[0].vector().get_local())
+            if entry is not None:
+                entry["gradient"] = gathered_out.copy()
+            self._gradient_memo = (self._tape_key, gathered_out.copy())
 
+        # Multiply with some small number to that we take smaller steps
         self.grad_norm.append(np.linalg.norm(gathered_out))
         self.grad_norm_scaled.append(
             np.linalg.norm(gathered_out) * self.scale * self.derivative_scale
@@ -449,9 +449,24 @@ def setup_application_parameters(material_model="holzapfel_ogden"):
     # 0 = active only along fiber, 1 = equal force in all directions (default=0.0).
     params.add("eta", 0.0)
 
-    # If you want to use a zero initial guess for gamma (False),
-    # or use gamma from previous iteration as initial guess (True)
-    params.add("initial_guess", "previous", ["previous", "zero", "smooth"])
+    # If you want to use a zero initial guess for gamma (zero),
+    # use gamma from previous iteration as initial guess (previous),
+    # a constant with the mean value of the previous gamma (smooth)
+    # or a linear extrapolation from the two previous points (extrapolate).
+    # The extrapolation is a warm start. It costs one extra forward
+    # solve per contract point, and the points are still solved in order
+    params.add(
+        "initial_guess", "previous", ["previous", "zero", "smooth", "extrapolate"]
+    )
+
+    # Number of states and gammas from the continuation in the active
+    # phase that are kept in memory and used as initial guesses
+    params.add("active_state_store_size", 20)
+    # Write states that does not fit in memory to active_state_{n}.h5
+    params.add("active_state_spill_to_disk", False)
+    # Only use the stored states with gamma closest to the
+    # new gamma as initial guesses (0 = use all)
+    params.add("active_state_nearest", 5)
 
     # Log level
     params.add("log_level", logging.INFO)
@@ -469,6 +484,15 @@ def setup_application_parameters(material_model="holzapfel_ogden"):
     params.add("passive_relax", 1.0)
     params.add("active_relax", 1.0)
 
+    # Reuse the passive heart problem between functional evaluations
+    # and use the converged states from the closest previously evaluated
+    # material parameters as initial guess for the newton solver.
+    # The number of evaluations kept in memory is given by the cache size.
+    # This changes the initial guesses of the newton solver, and hence the
+    # path of the passive forward solve, so it is off by default
+    params.add("passive_warm_start", False)
+    params.add("passive_warm_start_cache_size", 5)
+
     # When computing the volume/strain, do you want to the project or  interpolate
     # the diplacement onto a CG 1 space, or do you want to keep the original
     # displacement (default CG2)
@@ -477,6 +501,28 @@ def setup_application_parameters(material_model="holzapfel_ogden"):
 
     params.add("strain_tensor", "gradu", ["E", "gradu"])
     params.add("map_strain", False)
+    # Compute the regional strains and the strain functional in all
+    # regions with one solve each, instead of one solve per region
+    params.add("batch_regional_strain", False)
+
+    # Write the states of the final forward solve to the result file
+    # while solving, instead of keeping all of them in memory.
+    # At most state_buffer_size states are kept in memory
+    params.add("stream_states", False)
+    params.add("state_buffer_size", 5)
+
+    # Write the results dictionary to the result file in a background
+    # thread, so that the next contract point can start right away.
+    # All writes are finished at the end of each phase.
+    # Only used in serial, in parallel the results are written right away
+    params.add("async_write", False)
+
+    # Layout of the results in the result file. With 'packed', series
+    # such as the controls at each iteration or the strains at each
+    # time are stored in one chunked, compressed 2D dataset instead
+    # of one dataset per entry. Compression is 'gzip' or 'lzf'
+    params.add("h5_layout", "default", ["default", "packed"])
+    params.add("h5_compression", "gzip", ["gzip", "lzf"])
 
     # e.g merge region 1,2 into one region -> "1,2"
     # e.g merge region 1,2 into one region and
@@ -577,6 +623,21 @@ def setup_optimization_parameters():
     params.add("adapt_scale", True)
     params.add("disp", False)
 
+    # Number of evaluated controls kept in memory, so that
+    # the forward model is not solved twice for the same control.
+    # Only used in the passive phase. Set to 0 to turn off
+    params.add("memo_size", 10)
+
+    # Number of optimizations to run from randomly perturbed initial
+    # guesses. The starts are solved in parallel in separate processes
+    # (only in serial), and the best result is kept.
+    params.add("nstarts", 1)
+    # Size of the perturbation of the initial guess, relative
+    # to the range of the bounds
+    params.add("start_perturbation", 0.2)
+    # Number of processes used for the starts (0 = number of cpus)
+    params.add("nprocs", 0)
+
     # Add indices seprated with comma,
     # e.g fix first and third control "1,3"
     params.add("fixed_matparams", "")
@@ -51,6 +51,7 @@ from ..setup_optimization import (
 )
 from ..run_optimization import run_passive_optimization_step, solve_oc_problem, store
 from ..heart_problem import create_mechanics_problem
+from ..utils import update_manifest
 
 
 
@@ -257,6 +258,7 @@ class UnloadedMaterial(object):
             h5name=self.params["sim_file"],
             h5group="unloaded"
         )
+        update_manifest(self.params["sim_file"], new_geometry.mesh.mpi_comm())
 
         return HeartGeometry.from_file(
             h5name=self.params["sim_file"],
@@ -401,11 +403,14 @@ class UnloadedMaterial(object):
     def exist(self, key="unloaded"):
 
         import h5py
-        from pulse_adjoint.utils import Text
+        from pulse_adjoint.utils import Text, lookup_manifest
 
         group = "/".join([str(self.it), key])
-        with h5py.File(self.params["sim_file"]) as h5file:
-            exist = group in h5file
+        exist = lookup_manifest(self.params["sim_file"], group)
+        if exist is None:
+            with h5py.File(self.params["sim_file"]) as h5file:
+                exist = group in h5file
+        exist = exist is not False
 
         MPI.barrier(mpi_comm_world())
         if exist:
@@ -431,7 +436,7 @@ class UnloadedMaterial(object):
                 if not "passive_inflation" in h5file:
                     h5file.copy(group, "passive_inflation")
 
-        MPI.barrier(df.mpi_comm_world())
+        update_manifest(self.params["sim_file"])
 
     def compute_residual(self, it):
 
@@ -24,6 +24,11 @@
 # SIMULA RESEARCH LABORATORY MAKES NO REPRESENTATIONS AND EXTENDS NO
 # WARRANTIES OF ANY KIND, EITHER IMPLIED OR EXPRESSED, INCLUDING, BUT
 # NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY OR FITNESS
+import os
+import json
+import functools
+import threading
+import numpy as np
 from pprint import pformat
 from .adjoint_contraction_args import logger, PHASES
 
@@ -105,32 +110,216 @@ def print_line(for_res, it=None, grad_norm=None, func_value=None):
     return line
 
 
-def passive_inflation_exists(params):
-    import h5py, os
-    from .adjoint_contraction_args import PASSIVE_INFLATION_GROUP
+# Serializes access to the result file between the main
+# thread and the asynchronous result writer. The HDF5 library
+# is not thread safe, so it is needed for other HDF5 files too
+result_file_lock = threading.RLock()
 
-    if not os.path.exists(params["sim_file"]):
-        return False
 
-    h5file = h5py.File(params["sim_file"])
-    key = PASSIVE_INFLATION_GROUP
+def locked_result_file(f):
+    """
+    Decorator for functions that open the result file, so that they
+    wait for any write to the file in the background to finish.
+    """
 
-    # Check if pv point is already computed
-    if key in list(h5file.keys()):
-        logger.info(Text.green("Passive inflation, {}".format("fetched from database")))
-        h5file.close()
-        return True
-    logger.info(Text.blue("Passive inflation, {}".format("Run Optimization")))
-    h5file.close()
-    return False
+    @functools.wraps(f)
+    def wrapped(*args, **kwargs):
+        with result_file_lock:
+            return f(*args, **kwargs)
+
+    return wrapped
+
+
+# Groups in the result file down to this depth are listed in the manifest
+MANIFEST_DEPTH = 2
+
+
+def manifest_name(h5name):
+    """
+    Name of the manifest that lists the groups in the result file
+    """
+    return "{}.manifest.json".format(os.path.splitext(h5name)[0])
+
+
+def _h5_stat(h5name):
+    """
+    The size and modification time (in nanoseconds) of the
+    result file, used to check that the manifest is up to date
+    """
+    st = os.stat(h5name)
+    mtime_ns = getattr(st, "st_mtime_ns", int(st.st_mtime * 1e9))
+    return [int(st.st_size), int(mtime_ns)]
+
+
+def _mpi4py_comm(comm):
+
+    if comm is None:
+        from dolfin import mpi_comm_world
+
+        comm = mpi_comm_world()
+
+    if hasattr(comm, "tompi4py"):
+        comm = comm.tompi4py()
+
+    return comm
+
+
+def _read_manifest(h5name):
+
+    fname = manifest_name(h5name)
+    try:
+        with open(fname, "r") as f:
+            manifest = json.load(f)
+
+        if manifest["h5stat"] != _h5_stat(h5name):
+            # The result file has been changed
+            return None
+
+        return manifest["groups"]
+
+    except (OSError, IOError, ValueError, KeyError):
+        return None
+
+
+def load_manifest(h5name, comm=None):
+    """
+    Load the manifest of the result file. Return None if the
+    manifest does not exist, or if the size or modification time
+    of the result file differ from when the manifest was written.
+
+    The manifest is read on rank 0 and broadcasted, so that all
+    processes agree. This has to be called on all processes.
+
+    :param str h5name: Name of the result file
+    :param comm: MPI communicator
+    :returns: The groups in the file with their info
+    :rtype: dict
+
+    """
+
+    comm = _mpi4py_comm(comm)
+    if comm.size == 1:
+        return _read_manifest(h5name)
+
+    groups = _read_manifest(h5name) if comm.rank == 0 else None
+    return comm.bcast(groups, root=0)
+
+
+def lookup_manifest(h5name, h5group, comm=None):
+    """
+    Check if a group is in the result file using the manifest.
+    This has to be called on all processes.
+
+    :param str h5name: Name of the result file
+    :param str h5group: The group
+    :param comm: MPI communicator
+    :returns: The info about the group if it exist, False if it does not
+              exist, and None if the manifest cannot tell
+    
+    """
+
+    group = h5group.strip("/")
+    if group == "" or len(group.split("/")) > MANIFEST_DEPTH:
+        return None
+
+    groups = load_manifest(h5name, comm)
+    if groups is None:
+        return None
+
+    return groups.get(group, False)
+
+
+@locked_result_file
+def update_manifest(h5name, comm=None):
+    """
+    Write the manifest of the result file. This should be called
+    every time something is written to or deleted from the file, on
+    all processes. The manifest is written by rank 0 to a temporary
+    file that is renamed, so readers never see a partially written
+    manifest.
+
+    :param str h5name: Name of the result file
+    :param comm: MPI communicator
+
+    """
+
+    comm = _mpi4py_comm(comm)
+
+    if comm.rank == 0:
+        _write_manifest(h5name)
+
+    if comm.size > 1:
+        comm.Barrier()
+
+
+def _write_manifest(h5name):
+
+    import h5py
+
+    if not os.path.isfile(h5name):
+        return
+
+    groups = {}
+
+    def visit(h5group, path, depth):
+
+        for key, item in h5group.items():
+            if not isinstance(item, h5py.Group):
+                continue
+
+            name = "/".join([path, key]) if path else key
+            info = {}
+            if "bcs" in item and "pressure" in item["bcs"]:
+                pressure = np.array(item["bcs"]["pressure"]).flatten()
+                if pressure.size > 0:
+                    info["pressure"] = float(pressure[-1])
+
+            groups[name] = info
+            if depth < MANIFEST_DEPTH:
+                visit(item, name, depth + 1)
+
+    try:
+        with h5py.File(h5name, "r") as h5file:
+            visit(h5file, "", 1)
+    except (OSError, IOError):
+        return
+
+    fname = manifest_name(h5name)
+    tmpname = "{}.{}.tmp".format(fname, os.getpid())
+    with open(tmpname, "w") as f:
+        json.dump(
+            {
+                "h5name": os.path.basename(h5name),
+                "h5stat": _h5_stat(h5name),
+                "groups": groups,
+            },
+            f,
+            indent=2,
+        )
+    os.rename(tmpname, fname)
 
 
+def passive_inflation_exists(params):
+    """
+    Check if the passive inflation is in the result file.
+    See :func:`pulse_adjoint.io.passive_inflation_exists`
+    """
+    from .io.utils import passive_inflation_exists as exists
+
+    return exists(params)
+
+
+@locked_result_file
 def check_group_exists(h5name, h5group):
     import h5py, os
 
     if not os.path.exists(h5name):
         return False
 
+    exist = lookup_manifest(h5name, h5group)
+    if exist is not None:
+        return exist is not False
+
     try:
         h5file = h5py.File(h5name)
     except:
@@ -145,66 +334,16 @@ def check_group_exists(h5name, h5group):
 
 
 def contract_point_exists(params):
-    import h5py, os
-    import numpy as np
-    from .adjoint_contraction_args import (
-        ACTIVE_CONTRACTION,
-        CONTRACTION_POINT,
-        PASSIVE_INFLATION_GROUP,
-        PHASES,
-    )
-
-    if not os.path.exists(params["sim_file"]):
-        logger.info(Text.red("Run passive inflation before systole"))
-        raise IOError("Need state from passive inflation")
-        return False
-
-    h5file = h5py.File(params["sim_file"])
-    key1 = ACTIVE_CONTRACTION
-    key2 = CONTRACTION_POINT.format(params["active_contraction_iteration_number"])
-    key3 = PASSIVE_INFLATION_GROUP
-
-    if not key3 in list(h5file.keys()):
-        logger.info(Text.red("Run passive inflation before systole"))
-        raise IOError("Need state from passive inflation")
-
-    if params["phase"] == PHASES[0]:
-        h5file.close()
-        return False
-
-    if not key1 in list(h5file.keys()):
-        h5file.close()
-        return False
-
-    try:
+    """
+    Check if the current contract point is in the result file.
+    See :func:`pulse_adjoint.io.contract_point_exists`
+    """
+    from .io.utils import contract_point_exists as exists
 
-        # Check if pv point is already computed
-        if key1 in list(h5file.keys()) and key2 in list(h5file[key1].keys()):
-            pressure = np.array(h5file[key1][key2]["bcs"]["pressure"])[-1]
-            logger.info(
-                Text.green(
-                    "Contract point {}, pressure = {:.3f} {}".format(
-                        params["active_contraction_iteration_number"],
-                        pressure,
-                        "fetched from database",
-                    )
-                )
-            )
-            h5file.close()
-            return True
-        logger.info(
-            Text.blue(
-                "Contract point {}, {}".format(
-                    params["active_contraction_iteration_number"], "Run Optimization"
-                )
-            )
-        )
-        h5file.close()
-        return False
-    except KeyError:
-        return False
+    return exists(params)
 
 
+@locked_result_file
 def get_simulated_pressure(params):
     """
     Get the last simulated pressure stored in
@@ -228,6 +367,10 @@ def get_simulated_pressure(params):
     key2 = CONTRACTION_POINT.format(params["active_contraction_iteration_number"])
     key3 = PASSIVE_INFLATION_GROUP
 
+    info = lookup_manifest(params["sim_file"], "/".join([key1, key2]))
+    if info and "pressure" in info:
+        return info["pressure"]
+
     with h5py.File(params["sim_file"], "r") as h5file:
         try:
             pressure = numpy.array(h5file[key1][key2]["bcs"]["pressure"])[-1]
@@ -237,6 +380,82 @@ def get_simulated_pressure(params):
     return pressure
 
 
+class StateCache(object):
+    """
+    A bounded cache of converged states keyed by the control
+    vector that produced them. The states of the control closest
+    (in the l2 norm) to a new control can be used as initial
+    guesses for the newton solver.
+
+    **Example of use**::
+
+      cache = StateCache(maxsize=5)
+      cache.add(control_arr, states)
+      initial_guesses = cache.nearest(new_control_arr)
+
+    :param int maxsize: Maximum number of entries kept in the cache.
+                        The oldest entry is discarded first.
+
+    """
+
+    def __init__(self, maxsize=5):
+
+        self.maxsize = maxsize
+        self.clear()
+
+    def __len__(self):
+        return len(self._controls)
+
+    def clear(self):
+
+        self._controls = []
+        self._values = []
+
+    def add(self, control, value):
+        """Add a new entry to the cache
+
+        :param control: The control vector (gathered on all processes)
+        :param value: The object to cache, e.g a list of states
+
+        """
+        if self.maxsize < 1:
+            return
+
+        self._controls.append(np.array(control, dtype=float).flatten())
+        self._values.append(value)
+
+        if len(self._controls) > self.maxsize:
+            self._controls.pop(0)
+            self._values.pop(0)
+
+    def distances(self, control):
+        """Return the l2 distance from the given control
+        to all the controls in the cache
+        """
+        control = np.array(control, dtype=float).flatten()
+        return np.array(
+            [
+                np.linalg.norm(c - control) if c.shape == control.shape else np.inf
+                for c in self._controls
+            ]
+        )
+
+    def nearest(self, control):
+        """Return the cached value for the control closest to
+        the given control, or None if the cache is empty.
+        """
+
+        if len(self) == 0:
+            return None
+
+        dist = self.distances(control)
+        idx = int(np.argmin(dist))
+        if not np.isfinite(dist[idx]):
+            return None
+
+        return self._values[idx]
+
+
 def list_sum(l):
     """
     Return the sum of a list, when the convetiional
@@ -1,4 +1,5 @@
 
+import numpy as np
 import dolfin as df
 
 from pulse_adjoint import LVTestPatient
@@ -71,13 +72,13 @@ def main():
             F_ref = df.grad(u_int) + df.Identity(3)
             
 
-            print "\nApprox = {}:".format(approx)
+            print("\nApprox = {}:".format(approx))
             target_vol = VolumeTarget(patient.mesh, dS, "LV", approx)
             target_vol.set_target_functions()
             target_vol.assign_simulated(u)
             
             vol = target_vol.simulated_fun.vector().array()[0]
-            print "Volume = ", vol
+            print("Volume = ", vol)
 
 
             target_strain = RegionalStrainTarget(patient.mesh,
@@ -93,9 +94,97 @@ def main():
 
             strain = [target_strain.simulated_fun[i].vector().array() \
                       for i in range(nregions)]
-            print "Regional strain = ", strain
+            print("Regional strain = ", strain)
         
 
 
+def get_basis():
+    # Any set of unit vector fields will do here
+    return {"circumferential": patient.fiber,
+            "radial": patient.sheet,
+            "longitudinal": patient.sheet_normal}
+
+
+def get_displacement():
+    V = df.VectorFunctionSpace(patient.mesh, "CG", 2)
+    return df.interpolate(df.Expression(("0.1*x[0]", "-0.05*x[1]",
+                                         "0.02*x[0]*x[2]"), degree=2), V)
+
+
+def test_batched_regional_strain():
+
+    u = get_displacement()
+    dX = df.Measure("dx", subdomain_data=patient.sfun, domain=patient.mesh)
+    nregions = len(set(patient.sfun.array()))
+
+    targets = []
+    for batched in [False, True]:
+        target = RegionalStrainTarget(patient.mesh, get_basis(), dX,
+                                      nregions=nregions, batched=batched)
+        target.set_target_functions()
+        target.assign_target(0.01 * np.ones((nregions, target.nbasis)))
+        target.assign_simulated(u)
+        target.assign_functional()
+        targets.append(target)
+
+    target, target_batched = targets
+
+    strain = np.array([target.simulated_fun[i].vector().get_local()
+                       for i in range(nregions)])
+    strain_batched = target_batched.simulated_fun.vector().get_local()
+    assert np.allclose(strain, strain_batched.reshape(strain.shape))
+    assert np.isclose(target.get_value(), target_batched.get_value())
+
+
+def test_cavity_volume_evaluator():
+
+    from pulse_adjoint.postprocess.utils import (CavityVolumeEvaluator,
+                                                 compute_inner_cavity_volume)
+
+    u = get_displacement()
+    marker = patient.markers["ENDO"][0]
+
+    for approx in ["project", "interpolate", "original"]:
+        vol = compute_inner_cavity_volume(patient.mesh, patient.ffun,
+                                          marker, u, approx)
+
+        evaluator = CavityVolumeEvaluator(patient.mesh, patient.ffun,
+                                          marker, approx)
+        assert np.isclose(evaluator(u.vector().get_local()), vol)
+
+
+def test_regional_strain_evaluator():
+
+    from pulse_adjoint.postprocess.utils import RegionalStrainEvaluator
+
+    u = get_displacement()
+    basis = get_basis()
+    dX = df.Measure("dx", subdomain_data=patient.sfun, domain=patient.mesh)
+
+    for approx in ["project", "interpolate", "original"]:
+        for tensor in ["gradu", "E"]:
+            target = RegionalStrainTarget(patient.mesh, basis, dX,
+                                          tensor=tensor, approx=approx)
+            target.set_target_functions()
+            target.assign_simulated(u)
+
+            # The evaluator expects the regions sorted
+            regions = sorted(int(r) for r in target.regions)
+            evaluator = RegionalStrainEvaluator(
+                patient.mesh, dX,
+                [basis[l] for l in ["circumferential", "radial",
+                                    "longitudinal"]],
+                regions, approx=approx, tensor=tensor)
+            strain = evaluator(u.vector().get_local())
+
+            for i, r in enumerate(target.regions):
+                strain_target = target.simulated_fun[i].vector().get_local()
+                assert np.allclose(strain[regions.index(int(r))],
+                                   strain_target)
+
+
 if __name__ == "__main__":
     main()
+    test_batched_regional_strain()
+    test_cavity_volume_evaluator()
+    test_regional_strain_evaluator()
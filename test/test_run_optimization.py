@@ -0,0 +1,27 @@
+"""
+Test the helpers for running the optimization
+"""
+import numpy as np
+
+from pulse_adjoint.run_optimization import get_multistart_guesses
+
+
+def test_multistart_guesses_zero():
+
+    x0 = np.zeros(10)
+    guesses = get_multistart_guesses(x0, 0.0, 1.0, 0.2, 3)
+
+    assert len(guesses) == 3
+    assert np.all(guesses[0] == x0)
+
+    # All the starts should differ, also when the initial guess is zero
+    for i in range(3):
+        for j in range(i + 1, 3):
+            assert not np.allclose(guesses[i], guesses[j])
+
+    for x in guesses:
+        assert np.all(x >= 0.0) and np.all(x <= 1.0)
+
+
+if __name__ == "__main__":
+    test_multistart_guesses_zero()
@@ -75,5 +75,47 @@ def test_store():
                             opt_result)
     
 
+def test_packed_layout(tmpdir):
+
+    import h5py
+    import numpy as np
+    from pulse_adjoint.io.utils import write_numpy_dict
+    from pulse_adjoint.postprocess.load import load_dict_from_h5
+
+    d = {"states": {str(i): np.random.rand(10) for i in range(5)},
+         "func_vals": np.random.rand(7),
+         "nfev": np.array(3),
+         "target": {"0": np.random.rand(3), "1": np.random.rand(4)},
+         "empty": {str(i): np.zeros(0) for i in range(3)}}
+
+    loaded = {}
+    for layout in ["default", "packed"]:
+        h5name = str(tmpdir.join("{}.h5".format(layout)))
+        with h5py.File(h5name, "w") as h5file:
+            write_numpy_dict(h5file, d, "active", layout=layout)
+
+        loaded[layout] = load_dict_from_h5(h5name, "active")
+
+    with h5py.File(str(tmpdir.join("packed.h5")), "r") as h5file:
+        assert h5file["active/states"].attrs["packed"]
+        assert h5file["active/states"].shape == (5, 10)
+        # Not a time series, so this is not packed
+        assert "0" in h5file["active/target"]
+        # Empty series are not packed either
+        assert "0" in h5file["active/empty"]
+
+    for layout in ["default", "packed"]:
+        t = loaded[layout]
+        assert sorted(t.keys()) == sorted(d.keys())
+        for i in range(5):
+            assert np.allclose(t["states"][str(i)], d["states"][str(i)])
+        assert np.allclose(t["func_vals"], d["func_vals"])
+        assert int(t["nfev"]) == 3
+        for k in ["0", "1"]:
+            assert np.allclose(t["target"][k], d["target"][k])
+        for i in range(3):
+            assert t["empty"][str(i)].shape == (0,)
+
+
 if __name__ == "__main__":
     test_store()
@@ -0,0 +1,74 @@
+"""
+Test the helper utilities
+"""
+import os
+import json
+import numpy as np
+
+from pulse_adjoint.utils import (
+    StateCache,
+    manifest_name,
+    load_manifest,
+    lookup_manifest,
+    _h5_stat,
+)
+
+
+def test_state_cache_nearest():
+
+    cache = StateCache(maxsize=2)
+    assert cache.nearest(np.zeros(2)) is None
+
+    cache.add(np.array([1.0, 1.0]), "a")
+    cache.add(np.array([2.0, 2.0]), "b")
+
+    assert cache.nearest(np.array([1.1, 0.9])) == "a"
+    assert cache.nearest(np.array([3.0, 3.0])) == "b"
+
+    # The oldest entry should be discarded
+    cache.add(np.array([5.0, 5.0]), "c")
+    assert len(cache) == 2
+    assert cache.nearest(np.array([1.0, 1.0])) == "b"
+
+
+def test_state_cache_disabled():
+
+    cache = StateCache(maxsize=0)
+    cache.add(np.array([1.0]), "a")
+    assert cache.nearest(np.array([1.0])) is None
+
+
+def test_lookup_manifest(tmpdir):
+
+    h5name = str(tmpdir.join("results.h5"))
+    assert lookup_manifest(h5name, "passive_inflation") is None
+
+    with open(h5name, "w") as f:
+        f.write("")
+    with open(manifest_name(h5name), "w") as f:
+        groups = {
+            "passive_inflation": {},
+            "active_contraction/contract_point_0": {"pressure": 1.5},
+        }
+        json.dump({"h5stat": _h5_stat(h5name), "groups": groups}, f)
+
+    assert lookup_manifest(h5name, "passive_inflation") == {}
+    assert lookup_manifest(h5name, "active_contraction/contract_point_0") == {
+        "pressure": 1.5
+    }
+    assert lookup_manifest(h5name, "active_contraction/contract_point_1") is False
+    # Deeper groups are not in the manifest
+    assert lookup_manifest(h5name, "passive_inflation/states/0") is None
+
+    # The result file is changed after the manifest was written,
+    # within the resolution of the file system timestamps
+    st = os.stat(h5name)
+    with open(h5name, "a") as f:
+        f.write("new data")
+    os.utime(h5name, (st.st_atime, st.st_mtime))
+    assert load_manifest(h5name) is None
+
+
+if __name__ == "__main__":
+    test_state_cache_nearest()
+    test_state_cache_disabled()